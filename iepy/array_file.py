@@ -0,0 +1,130 @@
+"""
+Binary files of named numpy arrays, read with memory maps.
+
+A file has a magic string, a JSON header and the arrays, each one aligned to
+8 bytes. Loading a file is instant no matter its size, and every process
+reading the same file shares the same physical memory.
+"""
+from array import array
+import json
+import struct
+
+import numpy
+
+_ALIGNMENT = 8
+
+
+def _aligned(n):
+    return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def array_bytes(array):
+    """The raw bytes of a numpy array. ndarray.tobytes is only on numpy 1.9
+    or newer, and numpy 2 removed ndarray.tostring."""
+    array = numpy.ascontiguousarray(array)
+    if hasattr(array, 'tobytes'):
+        return array.tobytes()
+    return array.tostring()
+
+
+def write_array_file(path, magic, header, arrays):
+    """Writes a file with the given header (a JSON serializable dict) and
+    arrays, a list of (name, 1-dimensional numpy array).
+    """
+    names = [name for name, _ in arrays]
+    if len(set(names)) != len(names):
+        raise ValueError('Repeated array names: %r' % names)
+    header = dict(header, arrays=[])
+    offset = 0
+    for name, array in arrays:
+        header['arrays'].append([name, array.dtype.str, len(array), offset])
+        offset += _aligned(array.nbytes)
+    header = json.dumps(header).encode('utf8')
+    start = _aligned(len(magic) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for _, array in arrays:
+            f.write(b'\0' * (start - f.tell()))
+            f.write(array_bytes(array))
+            start += _aligned(array.nbytes)
+
+
+def read_array_file(path, magic):
+    """Returns the header and a dict {name: array} of a file written by
+    write_array_file with the same magic. Arrays are read only memory maps.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError('%s is not a %r file' % (path, magic))
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf8'))
+    start = _aligned(len(magic) + 8 + size)
+    arrays = {}
+    for name, dtype, length, offset in header.pop('arrays'):
+        if length:
+            arrays[name] = numpy.memmap(path, dtype=dtype, mode='r',
+                                        offset=start + offset, shape=(length,))
+        else:
+            arrays[name] = numpy.zeros(0, dtype=dtype)
+    return header, arrays
+
+
+class StringsBuilder(object):
+    """Accumulates strings, each one identified by its insertion order, to be
+    written as two arrays: the utf-8 bytes of all of them, one after the
+    other, and where each one starts.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.data = bytearray()
+        self.ends = array('q')
+
+    def __len__(self):
+        return len(self.ends)
+
+    def add(self, value):
+        self.data.extend(value.encode('utf8'))
+        self.ends.append(len(self.data))
+        return len(self.ends) - 1
+
+    def arrays(self):
+        starts = numpy.zeros(len(self.ends) + 1, dtype=numpy.int64)
+        starts[1:] = self.ends
+        return [(self.name + '_start', starts),
+                (self.name + '_bytes', numpy.frombuffer(bytes(self.data), dtype=numpy.uint8))]
+
+
+class Strings(object):
+    """Reads the strings written by a StringsBuilder"""
+
+    def __init__(self, arrays, name):
+        self.starts = arrays[name + '_start']
+        self.data = arrays[name + '_bytes']
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        return self.encoded(i).decode('utf8')
+
+    def encoded(self, i):
+        """The utf-8 bytes of the i-th string"""
+        return bytes(self.data[self.starts[i]:self.starts[i + 1]])
+
+    def find(self, value):
+        """Index of value, or -1 if it's not there. Only for strings added
+        sorted by their utf-8 encoding."""
+        value = value.encode('utf8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.encoded(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.encoded(low) == value:
+            return low
+        return -1
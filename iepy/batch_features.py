@@ -0,0 +1,472 @@
+"""
+Vectorization of whole batches of evidence.
+
+featureforge's Vectorizer evaluates each feature of iepy.fact_extractor on
+each evidence on its own: the tokens of a segment are lowercased again by
+every feature that uses them, and every value goes through python sets and
+dicts one evidence at a time. BatchVectorizer computes the same features for
+a batch of evidence at once. The tokens, POS tags and verbs of each segment
+are turned into arrays of integer ids only once. The bag, bigram and
+in-between features of every evidence are then gathered from those arrays
+with array operations, and the result is built directly as a scipy CSR
+matrix.
+
+Segment features (see iepy.feature_cache.segment_feature) are computed once
+per segment and the resulting rows are repeated for each evidence of it.
+
+The columns are the ones of featureforge's Vectorizer with the same features:
+one per numeric feature and one per (bag feature, value) seen on fit (see
+`column_to_feature`), though bag values may get their columns in a
+different order. POS tags beyond the last token of a (malformed) segment are
+ignored, while featureforge's bag_of_pos would count them.
+"""
+from string import punctuation
+
+import numpy
+from scipy import sparse
+
+from future.builtins import str
+
+from iepy import fact_extractor as fe
+from iepy.feature_cache import is_segment_feature
+
+BATCH_SIZE = 5000
+
+_PUNCTUATION = set(punctuation)
+
+# Bag features, as (sequence of values, in between the entities or not)
+_BAGS = {
+    fe.bag_of_words: ('words', False),
+    fe.bag_of_pos: ('pos', False),
+    fe.bag_of_word_bigrams: ('word_bigrams', False),
+    fe.bag_of_wordpos: ('wordpos', False),
+    fe.bag_of_wordpos_bigrams: ('wordpos_bigrams', False),
+    fe.bag_of_words_in_between: ('words', True),
+    fe.bag_of_pos_in_between: ('pos', True),
+    fe.bag_of_word_bigrams_in_between: ('word_bigrams', True),
+    fe.bag_of_wordpos_in_between: ('wordpos', True),
+    fe.bag_of_wordpos_bigrams_in_between: ('wordpos_bigrams', True),
+}
+
+_BIGRAMS = ('word_bigrams', 'wordpos_bigrams')
+
+_NUMBERS = (
+    fe.entity_order,
+    fe.entity_distance,
+    fe.other_entities_in_between,
+    fe.in_same_sentence,
+    fe.verbs_count_in_between,
+    fe.verbs_count,
+    fe.total_number_of_entities,
+    fe.symbols_in_between,
+    fe.number_of_tokens,
+)
+
+
+def is_supported(feature):
+    """True if `feature` can be computed by a BatchVectorizer"""
+    return (feature in _BAGS or feature in _NUMBERS or
+            isinstance(feature, fe.BaseBagOfVerbs))
+
+
+class BatchVectorizer(object):
+    """Drop-in replacement of featureforge's Vectorizer for the features of
+    iepy.fact_extractor, evaluating them on batches of evidence.
+    """
+
+    def __init__(self, features, batch_size=BATCH_SIZE):
+        features = list(features)
+        for feature in features:
+            if not is_supported(feature):
+                raise ValueError("Feature %r can't be computed in batches" %
+                                 (feature,))
+        self.features = features
+        self.batch_size = batch_size
+        self.columns = None
+
+    def fit(self, X, y=None):
+        self.fit_transform(X)
+        return self
+
+    def fit_transform(self, X, y=None):
+        X = list(X)
+        if not X:
+            raise ValueError("Cannot fit with an empty dataset")
+        # Numeric features come first, as in featureforge
+        self.columns = [None] * len(self.features)
+        self.reverse = []
+        for i, feature in enumerate(self.features):
+            if feature in _NUMBERS:
+                self.columns[i] = len(self.reverse)
+                self.reverse.append((i, None))
+            else:
+                self.columns[i] = {}
+        return self._transform(X, fit=True)
+
+    def transform(self, X, y=None):
+        if self.columns is None:
+            raise ValueError("The vectorizer is not fitted")
+        return self._transform(list(X), fit=False)
+
+    def column_to_feature(self, i):
+        """Returns the (feature, value) of the i-th column. `value` is None
+        for numeric features."""
+        index, value = self.reverse[i]
+        return self.features[index], value
+
+    def _transform(self, X, fit):
+        blocks = []
+        for start in range(0, len(X), self.batch_size):
+            batch = _Batch(X[start:start + self.batch_size], self.features)
+            # Segment features get a matrix of their own with a row per
+            # segment, that is repeated for each evidence of the segment
+            parts = {False: ([], [], []), True: ([], [], [])}
+            self._numbers(batch, parts)
+            self._bags(batch, parts, fit)
+            blocks.append((batch, parts))
+        # Later blocks may have added columns when fitting
+        n = len(self.reverse)
+        result = []
+        for batch, parts in blocks:
+            pairs = _csr(len(batch.rows), n, *parts[False])
+            segments = _csr(batch.segments, n, *parts[True])
+            result.append(pairs + segments[batch.rows])
+        if not result:
+            return sparse.csr_matrix((0, n))
+        return sparse.vstack(result, format='csr')
+
+    def _numbers(self, batch, parts):
+        for i, feature in enumerate(self.features):
+            if feature in _NUMBERS:
+                rows, cols, values = parts[is_segment_feature(feature)]
+                value = batch.number(feature)
+                nonzero = numpy.flatnonzero(value)
+                rows.append(nonzero)
+                cols.append(numpy.full(len(nonzero), self.columns[i]))
+                values.append(value[nonzero].astype(float))
+
+    def _bags(self, batch, parts, fit):
+        bags = []
+        for i, feature in enumerate(self.features):
+            if feature not in _NUMBERS:
+                owners, ids = batch.bag(feature)
+                # Each value counts once per owner, as bags are sets
+                size = batch.size(feature) + 1
+                keys = numpy.unique(owners * size + ids)
+                bags.append((i, feature, owners, ids, keys // size, keys % size))
+        if fit:
+            self._add_columns(batch, bags)
+        for i, feature, _, _, owners, ids in bags:
+            present = numpy.unique(ids)
+            mapping = numpy.full(batch.size(feature), -1, dtype=numpy.int64)
+            columns = self.columns[i]
+            for k, value in zip(present, batch.values(feature, present)):
+                mapping[k] = columns.get(value, -1)
+            col = mapping[ids]
+            known = col >= 0
+            rows, cols, values = parts[is_segment_feature(feature)]
+            rows.append(owners[known])
+            cols.append(col[known])
+            values.append(numpy.ones(known.sum()))
+
+    def _add_columns(self, batch, bags):
+        # New values get columns in order of first appearance
+        first_rows, indexes, firsts, news = [], [], [], []
+        for i, feature, owners, ids, _, _ in bags:
+            present, first = numpy.unique(ids, return_index=True)
+            columns = self.columns[i]
+            values = batch.values(feature, present)
+            new = numpy.array([value not in columns for value in values],
+                              dtype=bool)
+            first_owners = owners[first[new]]
+            if is_segment_feature(feature):
+                first_owners = batch.first_rows[first_owners]
+            first_rows.append(first_owners)
+            indexes.append(numpy.full(new.sum(), i))
+            firsts.append(first[new])
+            news.extend((i, value) for value, n in zip(values, new) if n)
+        if not news:
+            return
+        first_rows = numpy.concatenate(first_rows)
+        indexes = numpy.concatenate(indexes)
+        firsts = numpy.concatenate(firsts)
+        for k in numpy.lexsort((firsts, indexes, first_rows)):
+            i, value = news[k]
+            if value not in self.columns[i]:
+                self.columns[i][value] = len(self.reverse)
+                self.reverse.append((i, value))
+
+
+def _csr(size, n, rows, cols, values):
+    rows = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=int)
+    cols = numpy.concatenate(cols) if cols else numpy.zeros(0, dtype=int)
+    values = numpy.concatenate(values) if values else numpy.zeros(0)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(size, n))
+
+
+class _Ids(object):
+    """Consecutive int ids of the values of a batch"""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __call__(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+def _pairs(left, right):
+    """Returns the ids of the pairs (left[k], right[k]), -1 where any of them
+    is -1, and the arrays of left and right values of each id.
+    """
+    valid = (left >= 0) & (right >= 0)
+    ids = numpy.full(len(left), -1, dtype=numpy.int64)
+    m = max(int(right.max()) + 1, 1) if len(right) else 1
+    unique, inverse = numpy.unique(left[valid] * m + right[valid],
+                                   return_inverse=True)
+    ids[valid] = inverse
+    return ids, unique // m, unique % m
+
+
+def _ranges(starts, ends):
+    """Returns the row and the position of every position of the ranges
+    [starts[r], ends[r]) of each row r.
+    """
+    lengths = numpy.maximum(ends - starts, 0)
+    rows = numpy.repeat(numpy.arange(len(starts)), lengths)
+    offsets = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+    return rows, numpy.arange(lengths.sum()) + offsets
+
+
+def _count(keys, lows, highs):
+    """Counts the elements of the sorted array keys in [lows[r], highs[r])"""
+    counts = (numpy.searchsorted(keys, highs, 'left') -
+              numpy.searchsorted(keys, lows, 'left'))
+    return numpy.maximum(counts, 0)
+
+
+class _Batch(object):
+    """The segments of a batch of evidence, as arrays of int ids with one
+    element per token of every segment, one segment after the other.
+    """
+
+    def __init__(self, evidences, features):
+        raw = _Ids()
+        words = _Ids()
+        pos = _Ids()
+        segments = []
+        index = {}
+        self.rows = []  # The segment of each evidence
+        self.first_rows = []  # The first evidence of each segment
+        for evidence in evidences:
+            key = id(evidence.segment)
+            if key not in index:
+                index[key] = len(segments)
+                segments.append(evidence.segment)
+                self.first_rows.append(len(self.rows))
+            self.rows.append(index[key])
+        self.segments = len(segments)
+        self.rows = numpy.array(self.rows, dtype=numpy.int64)
+        self.first_rows = numpy.array(self.first_rows, dtype=numpy.int64)
+
+        raw_ids, pos_ids, starts = [], [], [0]
+        for segment in segments:
+            tokens, tags = segment.tokens, segment.postags[:len(segment.tokens)]
+            raw_ids.extend(raw(token) for token in tokens)
+            pos_ids.extend(pos(str(tag)) for tag in tags)
+            pos_ids.extend([-1] * (len(tokens) - len(tags)))
+            starts.append(len(raw_ids))
+        self.starts = numpy.array(starts, dtype=numpy.int64)
+        self.raw = raw
+        self.raw_ids = numpy.array(raw_ids, dtype=numpy.int64)
+        self.words = words
+        self.pos = pos
+        self.pos_ids = numpy.array(pos_ids, dtype=numpy.int64)
+        word_of_raw = numpy.array([words(token.lower()) for token in raw.values],
+                                  dtype=numpy.int64)
+        self.word_ids = word_of_raw[self.raw_ids]
+        verb_pos = numpy.array([tag.startswith(u'VB') for tag in pos.values] + [False])
+        self.verb = verb_pos[self.pos_ids]  # -1 takes the last one, False
+        symbol = numpy.array([bool(_PUNCTUATION.intersection(token))
+                              for token in raw.values], dtype=bool)
+        self.symbol = symbol[self.raw_ids]
+
+        # The entities and sentences of each segment, as sorted arrays of
+        # keys segment * stride + offset
+        self.stride = int(max([len(s.tokens) for s in segments] + [0])) + 1
+        entities, sentences = [], []
+        A, B = [], []
+        for k, segment in enumerate(segments):
+            base = k * self.stride
+            entities.extend(base + e.offset for e in segment.entities)
+            sentences.extend(base + s for s in segment.sentences)
+        for evidence in evidences:
+            a, b = fe.get_AB(evidence)
+            A.append((a.offset, a.offset_end))
+            B.append((b.offset, b.offset_end))
+        self.entities = numpy.sort(numpy.array(entities, dtype=numpy.int64))
+        self.sentences = numpy.sort(numpy.array(sentences, dtype=numpy.int64))
+        self.number_of_entities = numpy.array(
+            [len(segment.entities) for segment in segments], dtype=numpy.int64)
+        A = numpy.array(A, dtype=numpy.int64).reshape(-1, 2)
+        B = numpy.array(B, dtype=numpy.int64).reshape(-1, 2)
+        self.a_first = A[:, 0] < B[:, 0]
+        # Offsets of the in-between tokens, relative to their segment
+        self.i = numpy.where(self.a_first, A[:, 1], B[:, 1])
+        self.j = numpy.where(self.a_first, B[:, 0], A[:, 0])
+
+        self.sequences = {}
+        self.decoders = {}
+        self._verb_bags = {}
+        for feature in features:
+            if isinstance(feature, fe.BaseBagOfVerbs):
+                self._add_verbs(feature)
+
+    # Token positions
+
+    def _segment_ranges(self):
+        return self.starts[:-1], self.starts[1:]
+
+    def _row_ranges(self):
+        return self.starts[self.rows], self.starts[self.rows + 1]
+
+    def _between_ranges(self):
+        starts, ends = self._row_ranges()
+        n = ends - starts
+        i = numpy.clip(self.i, 0, n)
+        j = numpy.clip(self.j, i, n)
+        return starts + i, starts + j
+
+    def _cumulative(self, flags):
+        return numpy.concatenate([[0], numpy.cumsum(flags)])
+
+    # Sequences of values
+
+    def _next(self, ids):
+        """The ids of the following token, -1 for the last of a segment"""
+        following = numpy.full(len(ids), -1, dtype=numpy.int64)
+        if len(ids):
+            following[:-1] = ids[1:]
+            following[self.starts[1:] - 1] = -1
+        return following
+
+    def sequence(self, name):
+        if name not in self.sequences:
+            self.sequences[name] = getattr(self, '_' + name)()
+        return self.sequences[name]
+
+    def _words(self):
+        self.decoders['words'] = lambda k: self.words.values[k]
+        return self.word_ids
+
+    def _pos(self):
+        self.decoders['pos'] = lambda k: self.pos.values[k]
+        return self.pos_ids
+
+    def _wordpos(self):
+        ids, left, right = _pairs(self.word_ids, self.pos_ids)
+        self.decoders['wordpos'] = lambda k: (self.words.values[left[k]],
+                                              self.pos.values[right[k]])
+        return ids
+
+    def _word_bigrams(self):
+        ids, left, right = _pairs(self.word_ids, self._next(self.word_ids))
+        self.decoders['word_bigrams'] = lambda k: (self.words.values[left[k]],
+                                                   self.words.values[right[k]])
+        return ids
+
+    def _wordpos_bigrams(self):
+        wordpos = self.sequence('wordpos')
+        ids, left, right = _pairs(wordpos, self._next(wordpos))
+        decode = self.decoders['wordpos']
+        self.decoders['wordpos_bigrams'] = lambda k: (decode(left[k]),
+                                                      decode(right[k]))
+        return ids
+
+    def _add_verbs(self, feature):
+        values = _Ids()
+        of_raw = numpy.full(len(self.raw) + 1, -1, dtype=numpy.int64)
+        verb_raw = numpy.unique(self.raw_ids[self.verb])
+        for k in verb_raw:
+            of_raw[k] = values(feature.do(self.raw.values[k]))
+        ids = of_raw[numpy.where(self.verb, self.raw_ids, -1)]
+        self._verb_bags[feature] = (ids, values)
+
+    # Features
+
+    def size(self, feature):
+        """Number of different ids of a bag feature"""
+        if isinstance(feature, fe.BaseBagOfVerbs):
+            return len(self._verb_bags[feature][1])
+        ids = self.sequence(_BAGS[feature][0])
+        return int(ids.max()) + 1 if len(ids) else 0
+
+    def values(self, feature, ids):
+        """Values of a bag feature with the given ids"""
+        if isinstance(feature, fe.BaseBagOfVerbs):
+            values = self._verb_bags[feature][1].values
+            return [values[k] for k in ids]
+        decode = self.decoders[_BAGS[feature][0]]
+        return [decode(k) for k in ids]
+
+    def bag(self, feature):
+        """Returns the owner and the id of every value of a bag feature, in
+        order of owners and token positions. Ids may be repeated. Owners are
+        segments for segment features and evidence rows otherwise.
+        """
+        if isinstance(feature, fe.BaseBagOfVerbs):
+            ids = self._verb_bags[feature][0]
+            in_between = feature.in_between
+        else:
+            name, in_between = _BAGS[feature]
+            ids = self.sequence(name)
+        if in_between:
+            starts, ends = self._between_ranges()
+            if not isinstance(feature, fe.BaseBagOfVerbs) and name in _BIGRAMS:
+                # Both tokens of a bigram must be in between
+                ends = numpy.maximum(ends - 1, starts)
+        else:
+            starts, ends = self._segment_ranges()
+        rows, positions = _ranges(starts, ends)
+        ids = ids[positions]
+        valid = ids >= 0
+        return rows[valid], ids[valid]
+
+    def number(self, feature):
+        """Returns the array of values of a numeric feature, one per segment
+        for segment features and one per evidence row otherwise.
+        """
+        starts, ends = self._segment_ranges()
+        between_starts, between_ends = self._between_ranges()
+        base = self.rows * self.stride
+        if feature is fe.entity_order:
+            return self.a_first.astype(numpy.int64)
+        if feature is fe.entity_distance:
+            return self.j - self.i
+        if feature is fe.other_entities_in_between:
+            return _count(self.entities, base + self.i,
+                          base + numpy.maximum(self.j, self.i))
+        if feature is fe.in_same_sentence:
+            return (_count(self.sentences, base + self.i,
+                           base + numpy.maximum(self.j, self.i)) == 0).astype(numpy.int64)
+        if feature is fe.verbs_count_in_between:
+            verbs = self._cumulative(self.verb)
+            return verbs[between_ends] - verbs[between_starts]
+        if feature is fe.verbs_count:
+            verbs = self._cumulative(self.verb)
+            return verbs[ends] - verbs[starts]
+        if feature is fe.total_number_of_entities:
+            return self.number_of_entities
+        if feature is fe.symbols_in_between:
+            symbols = self._cumulative(self.symbol)
+            return (symbols[between_ends] > symbols[between_starts]).astype(numpy.int64)
+        if feature is fe.number_of_tokens:
+            return ends - starts
+        raise ValueError("Unknown feature %r" % (feature,))
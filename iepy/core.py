@@ -45,14 +45,22 @@
         Brin 1999
 """
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 import itertools
 import logging
+import multiprocessing
+import pickle
+import threading
 
-from colorama import Fore, Style
+from mongoengine.connection import disconnect, get_db
+import numpy
 
 from iepy import db
+from iepy.evidence_store import (
+    CertaintyRanking, Evidence, EvidenceStore, Fact, load_evidence, sorted_top)
 from iepy.fact_extractor import FactExtractorFactory
+from iepy.feature_cache import offline_cache
+from iepy.utils import chunks
 
 from iepy.fact_extractor import (
     bag_of_words,
@@ -75,100 +83,6 @@ from iepy.fact_extractor import (
 
 logger = logging.getLogger(__name__)
 
-# A fact is a triple with two Entity() instances and a relation label
-Fact = namedtuple("Fact", "e1 relation e2")
-BaseEvidence = namedtuple("Evidence", "fact segment o1 o2")
-
-
-class Evidence(BaseEvidence):
-    """
-    An Evidence is a pair of a Fact and a TextSegment and occurrence indices.
-    Evicence instances are tipically constructed whitin a
-    BootstrappedIEPipeline and it attributes are meant to be used directly (no
-    getters or setters) in a read-only fashion (it's an inmutable after all).
-
-    Evidence instances are dense information and follow strict invariants so
-    here is a small cheatsheet of its contents:
-
-    -e                           # Evidence instance
-        -fact                    # Fact instance
-            -relation            # A `str` naming the relation of the fact
-            -e1                  # Entity instance (an abstract entity, not an entity occurrence)
-                -kind            # A `str` naming the kind/type of entity
-                -key             # A `str` that uniquely identifies this entity
-                -canonical_form  # A `str` that's the human-friendly way to represent this entity
-            -e2                  # Entity instance (an abstract entity, not an entity occurrence)
-                -kind            # A `str` naming the kind/type of entity
-                -key             # A `str` that uniquely identifies this entity
-                -canonical_form  # A `str` that's the human-friendly way to represent this entity
-        -segment                 # A Segment instance
-            -tokens              # A list of `str` representing the tokens in the segment
-            -text                # The original text `str` of this document
-            -sentences           # A list of token indexes denoting the start of the syntactic sentences on the segment
-            -postags             # A list of `str` POS tags, in 1-on-1 relation with tokens
-            -offset              # An `int`, the offset of the segment, in tokens, from the document start
-            -entities            # A list of entity occurrences
-                -kind            # A `str` naming the kind/type of entity
-                -key             # A `str` that uniquely identifies this entity
-                -canonical_form  # A `str` that's the human-friendly way to represent this entity
-                -offset          # An `int`, the offset to the entity occurrence start, in tokens, from the segment start
-                -offset_end      # An `int`, the offset to the entity occurrence end, in tokens, from the segment start
-                -alias           # A `str`, the literal text manifestation of the entity occurrence
-        -o1                      # The index in segment.entities occurrence of the first entity
-        -o2                      # The index in segment.entities occurrence of the second entity
-
-
-    And a commonly needed recipe:
-        e.segment.entities[e.o1]  # The occurrence of the first entity
-        e.segment.entities[e.o2]  # The occurrence of the second entity
-
-
-    The segment+indices can be left out (as None)
-    The following invariants apply
-     - e.segment == None iff e.o1 == None
-     - e.segment == None iff e.o2 == None
-     - e.o1 != None implies e.fact.e1.kind == e.segment.entities[e.o1].kind and e.fact.e1.key == e.segment.entities[e.o1].key
-     - e.o2 != None implies e.fact.e2.kind == e.segment.entities[e.o2].kind and e.fact.e2.key == e.segment.entities[e.o2].key
-    """
-    __slots__ = []
-
-    def colored_text(self, color_1, color_2):
-        """Will return a naive formated text with entities remarked.
-        Assumes that occurrences does not overlap.
-        """
-        occurr1 = self.segment.entities[self.o1]
-        occurr2 = self.segment.entities[self.o2]
-        tkns = self.segment.tokens[:]
-        if self.o1 < self.o2:
-            tkns.insert(occurr2.offset_end, Style.RESET_ALL)
-            tkns.insert(occurr2.offset, color_2)
-            tkns.insert(occurr1.offset_end, Style.RESET_ALL)
-            tkns.insert(occurr1.offset, color_1)
-        else:  # must be solved in the reverse order
-            tkns.insert(occurr1.offset_end, Style.RESET_ALL)
-            tkns.insert(occurr1.offset, color_1)
-            tkns.insert(occurr2.offset_end, Style.RESET_ALL)
-            tkns.insert(occurr2.offset, color_2)
-        return u' '.join(tkns)
-
-    def colored_fact(self, color_1, color_2):
-        return u'(%s <%s>, %s, %s <%s>)' % (
-            color_1 + self.fact.e1.key + Style.RESET_ALL,
-            self.fact.e1.kind,
-            self.fact.relation,
-            color_2 + self.fact.e2.key + Style.RESET_ALL,
-            self.fact.e2.kind,
-        )
-
-    def colored_fact_and_text(self):
-        color_1 = Fore.RED
-        color_2 = Fore.GREEN
-        return (
-            self.colored_fact(color_1, color_2),
-            self.colored_text(color_1, color_2)
-        )
-
-
 def certainty(p):
     return 0.5 + abs(p - 0.5) if p is not None else 0.5
 
@@ -180,17 +94,18 @@ class Knowledge(dict):
     """
     __slots__ = ()
 
-    def by_certainty(self):
+    def by_certainty(self, n=None):
         """
         Returns an iterable over the evidence, with the most certain evidence
         at the front and the least certain evidence at the back. "Certain"
         means a score close to 0 or 1, and "uncertain" a score closer to 0.5.
-        Note that a score of 'None' is considered as 0.5 here
+        Note that evidence scored 'None' is placed at the back.
+        If n is given only the n most certain items are returned, without
+        sorting the rest.
         """
-        def key_funct(e_s):
-            e = e_s[0]
-            return (certainty(self[e]) if self[e] is not None else 0, e)
-        return sorted(self.items(), key=key_funct, reverse=True)
+        items = list(self.items())
+        key = numpy.array([certainty(s) if s is not None else 0 for _, s in items])
+        return [items[i] for i in sorted_top(key, n)]
 
     def per_relation(self):
         """
@@ -202,6 +117,167 @@ class Knowledge(dict):
             result[e.fact.relation][e] = s
         return result
 
+    def above(self, threshold):
+        """
+        Returns a Knowledge with only the evidence scored over threshold
+        """
+        return Knowledge((e, s) for e, s in self.items() if s > threshold)
+
+    def certain(self, threshold):
+        """
+        Returns a Knowledge with only the evidence with certainty over threshold
+        """
+        return Knowledge((e, s) for e, s in self.items()
+                         if certainty(s) > threshold)
+
+    def matching_facts(self, facts):
+        """
+        Returns a Knowledge with only the evidence of the given facts
+        """
+        facts = set(facts)
+        return Knowledge((e, s) for e, s in self.items() if e.fact in facts)
+
+    def without(self, evidences):
+        """
+        Returns a Knowledge without the given evidences
+        """
+        return Knowledge((e, s) for e, s in self.items() if e not in evidences)
+
+
+class Questions(list):
+    """List of (evidence, score) questions, tagged with the version of the
+    questions they were taken from. The version changes each time the
+    pipeline generates new questions.
+    """
+
+    def __init__(self, items=(), version=0):
+        super(Questions, self).__init__(items)
+        self.version = version
+
+
+def build_evidence(segment, o1, o2, relation):
+    """Builds the Evidence of relation between the o1-th and o2-th entity
+    occurrences of the segment.
+    """
+    o1, o2 = int(o1), int(o2)
+    e1 = db.get_entity(segment.entities[o1].kind, segment.entities[o1].key)
+    e2 = db.get_entity(segment.entities[o2].kind, segment.entities[o2].key)
+    return Evidence(Fact(e1, relation, e2), segment, o1, o2)
+
+
+def prefetch_entities(segments):
+    """Loads on the entity cache, with a single query, the entities of every
+    occurrence of the given segments, so build_evidence doesn't query them
+    one by one.
+    """
+    db.get_entities((e.kind, e.key) for s in segments for e in s.entities)
+
+
+def has_candidates(segment, relations):
+    """Tells if candidate_evidence would find some evidence on the segment.
+    Only needs the entities of the segment.
+    """
+    return any(segment.kind_occurrence_pairs(lkind, rkind)
+               for lkind, rkind in relations.values())
+
+
+def load_candidate_segments(manager, segments, relations, fields):
+    """
+    Takes segments with at least their entities loaded (see
+    db.CANDIDATE_FIELDS), and returns the ones with candidate evidence of
+    the given relations, loaded again with the given fields (or complete, if
+    fields is None) with a single query. Their entities are prefetched.
+    """
+    ids = [s.id for s in segments if has_candidates(s, relations)]
+    loaded = manager.segments_by_id(ids, fields=fields)
+    result = [loaded[i] for i in ids]
+    prefetch_entities(result)
+    return result
+
+
+def candidate_evidence(segment, relations):
+    """Yields pairs (relation, evidence) for every pair of entity occurrences
+    of the segment that matches the kinds of some of the relations, given as
+    a dict {relation: (left kind, right kind)}.
+    """
+    for r, (lkind, rkind) in relations.items():
+        for o1, o2 in segment.kind_occurrence_pairs(lkind, rkind):
+            yield r, build_evidence(segment, o1, o2, r)
+
+
+def score_evidence(extractor, evidence):
+    """
+    Returns the probabilities of the given list of evidence being true,
+    as estimated by extractor. If there's no extractor (there was no
+    evidence to train it) every score is 0.5, the maximum uncertainty.
+    """
+    if not evidence:
+        return []
+    if extractor is None:
+        return [0.5 for _ in evidence]
+    classifier = extractor.predictor.named_steps["classifier"]
+    true_index = list(classifier.classes_).index(True)
+    ps = extractor.predictor.predict_proba(evidence)
+    return ps[:, true_index]
+
+
+def _compact(relation, evidence, extractor):
+    ps = score_evidence(extractor, evidence)
+    return (relation, [e.segment.id for e in evidence],
+            [e.o1 for e in evidence], [e.o2 for e in evidence],
+            [(e.fact.e1.kind, e.fact.e1.key) for e in evidence],
+            [(e.fact.e2.kind, e.fact.e2.key) for e in evidence], ps)
+
+
+# State of the scoring worker processes, set up by _init_scoring_worker
+_worker = {}
+
+
+def _init_scoring_worker(db_name, segments, relations, fields, pickled_extractors):
+    if db_name is not None:
+        # A connection can't be shared with the parent process
+        disconnect()
+        segments = db.connect(db_name).segments
+    else:
+        # An offline segment manager, like a snapshot's
+        db.set_entity_source(segments.entities)
+    _worker['segments'] = segments
+    _worker['relations'] = relations
+    _worker['fields'] = fields
+    _worker['extractors'] = pickle.loads(pickled_extractors)
+
+
+def _score_segments(segment_ids):
+    """
+    Runs on a worker process. Reads, featurizes and scores the candidate
+    evidence of the given segments.
+    Returns the segment ids and a dict
+    {relation: (indexes, o1s, o2s, e1s, e2s, ps)}, where indexes are positions
+    in segment_ids and e1s, e2s are lists of (kind, key) of the fact entities.
+    """
+    manager, relations = _worker['segments'], _worker['relations']
+    partial = manager.segments_by_id(segment_ids, fields=db.CANDIDATE_FIELDS)
+    positions = dict((s, i) for i, s in enumerate(segment_ids))
+    segments = load_candidate_segments(
+        manager, [partial[s] for s in segment_ids], relations, _worker['fields'])
+    candidates = defaultdict(list)
+    for segment in segments:
+        for r, e in candidate_evidence(segment, relations):
+            candidates[r].append((positions[segment.id], e))
+    result = {}
+    for r, items in candidates.items():
+        evidence = [e for _, e in items]
+        ps = score_evidence(_worker['extractors'].get(r), evidence)
+        result[r] = (
+            numpy.array([i for i, _ in items], dtype=numpy.int32),
+            numpy.array([e.o1 for e in evidence], dtype=numpy.int32),
+            numpy.array([e.o2 for e in evidence], dtype=numpy.int32),
+            [(e.fact.e1.kind, e.fact.e1.key) for e in evidence],
+            [(e.fact.e2.kind, e.fact.e2.key) for e in evidence],
+            numpy.array(ps, dtype=numpy.float64),
+        )
+    return segment_ids, result
+
 
 class BootstrappedIEPipeline(object):
     """
@@ -217,6 +293,11 @@ class BootstrappedIEPipeline(object):
                 p.add_answer(question, answer)
             p.force_process()
         facts = p.get_facts()  # profit
+
+    If `asynchronous` is set to True, `start` and `force_process` don't block:
+    the iteration runs on a background thread, and in the meantime the
+    questions of the previous iteration keep being available. Use `wait` to
+    block until the background iteration ends.
     """
 
     def __init__(self, db_connector, seed_facts):
@@ -227,8 +308,33 @@ class BootstrappedIEPipeline(object):
         self.knowledge = Knowledge({Evidence(f, None, None, None): 1 for f in seed_facts})
         self.evidence_threshold = 0.99
         self.fact_threshold = 0.99
-        self.questions = Knowledge()
+        # Number of candidate evidences of a relation scored at once
+        self.extraction_batch_size = 1000
+        # Number of processes used for scoring the corpus
+        self.extraction_processes = 1
+        # Fields of the segments loaded for featurizing candidate evidence.
+        # Custom features needing other fields may need more, or None (all)
+        self.segment_fields = db.FEATURE_FIELDS
+        self.questions = EvidenceStore(db_connector.segments)
+        self.questions_ranking = CertaintyRanking(self.questions)
         self.answers = {}
+        # If True, on each iteration relations without new answers keep their
+        # fact extractor and their scores from the previous iteration, and
+        # extractors that support it are updated instead of trained again.
+        self.incremental = False
+        self.extractors = {}
+        self._training = {}  # relation -> Knowledge its extractor learnt
+        self._answered_relations = set()  # relations with new answers
+        self._updated_relations = set()  # answered ones being processed
+        self._kept_relations = set()  # relations not to be scored again
+        self._scores = None  # EvidenceStore of the last extract_facts
+        # If True, iterations run on a background thread
+        self.asynchronous = False
+        self.questions_version = 0
+        self._lock = threading.RLock()
+        self._worker = None
+        self._rerun = False
+        self._error = None
 
         self.steps = [
                 self.generalize_knowledge,   # Step 1
@@ -256,6 +362,9 @@ class BootstrappedIEPipeline(object):
             "dimensionality_reduction": None,
             "scaler": False,
             "column_filter": False,
+            # A FeatureCache, for reusing evaluated features between
+            # iterations (and between runs, if persistent)
+            "feature_cache": None,
             "features": [
                 bag_of_words,
                 bag_of_pos,
@@ -290,29 +399,46 @@ class BootstrappedIEPipeline(object):
 
     def start(self):
         """
-        Blocking.
+        Blocking, unless the pipeline is asynchronous.
         """
+        self._run(self._start)
+
+    def _start(self):
         logger.info(u'Starting pipeline with {} seed '
                     u'facts'.format(len(self.knowledge)))
-        evidences = Knowledge(
-            (Evidence(fact, segment, o1, o2), 0.5)
-            for fact, _s, _o1, _o2 in self.knowledge
-            for segment in self.db_con.segments.segments_with_both_entities(fact.e1, fact.e2)
-            for o1, o2 in segment.entity_occurrence_pairs(fact.e1, fact.e2)
-        )
-        
+        segments = self.db_con.segments
+        evidences = EvidenceStore(segments)
+        facts = [fact for fact, _s, _o1, _o2 in self.knowledge]
+        for chunk in chunks(facts, self.extraction_batch_size):
+            # One lookup on the pair index, and one load of segments, for
+            # each chunk of seeds
+            ids = segments.segment_ids_with_entity_pairs([(f.e1, f.e2) for f in chunk])
+            loaded = segments.segments_by_id(set(itertools.chain.from_iterable(ids)))
+            evidences.add_items(
+                (Evidence(fact, loaded[segment_id], o1, o2), 0.5)
+                for fact, segment_ids in zip(chunk, ids)
+                for segment_id in segment_ids
+                for o1, o2 in loaded[segment_id].entity_occurrence_pairs(fact.e1, fact.e2)
+            )
+
         self.do_iteration(evidences)
 
-    def questions_available(self):
+    def questions_available(self, n=None):
         """
         Not blocking.
         Returned value won't change until a call to `add_answer` or
-        `force_process`.
-        If `id` of the returned value hasn't changed the returned value is the
-        same.
-        The questions avaiable are a list of evidence.
+        `force_process` (or, if the pipeline is asynchronous, until the
+        background iteration ends).
+        The questions avaiable are a Questions list of (evidence, score) not
+        answered yet, most certain first, with the `version` of the questions
+        they come from. If n is given, only the first n are returned (and the
+        rest of the questions are neither sorted nor loaded). Without n every
+        question is loaded, which is slow on big corpora.
         """
-        return self.questions.by_certainty()
+        with self._lock:
+            store, version = self.questions, self.questions_version
+            rows = self.questions_ranking.top(n)
+        return Questions(store.evidence(rows), version)
 
     def add_answer(self, evidence, answer):
         """
@@ -320,15 +446,43 @@ class BootstrappedIEPipeline(object):
         After calling this method the values returned by `questions_available`
         and `known_facts` might change.
         """
-        self.answers[evidence] = int(answer)
+        with self._lock:
+            self.answers[evidence] = int(answer)
+            self._answered_relations.add(evidence.fact.relation)
+            row = self.questions.row_of(evidence)
+            if row is not None:
+                self.questions_ranking.remove(row)
 
     def force_process(self):
         """
-        Blocking.
+        Blocking, unless the pipeline is asynchronous.
         After calling this method the values returned by `questions_available`
         and `known_facts` might change.
+        If the pipeline is asynchronous and an iteration is already running,
+        another one is run after it, using the answers given meanwhile.
+        """
+        self._run(self.do_iteration, None)
+
+    def is_processing(self):
+        """
+        Not blocking.
+        True while an asynchronous iteration is running.
+        """
+        return self._worker is not None
+
+    def wait(self):
+        """
+        Blocking.
+        Waits for the asynchronous iterations to end. Errors raised while
+        processing are raised here.
         """
-        self.do_iteration(None)
+        worker = self._worker
+        while worker is not None:
+            worker.join()
+            worker = self._worker
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
 
     def known_facts(self):
         """
@@ -338,7 +492,8 @@ class BootstrappedIEPipeline(object):
         If `len` of the returned value hasn't changed the returned value is the
         same.
         """
-        return self.knowledge
+        with self._lock:
+            return self.knowledge
 
     ###
     ### Pipeline steps
@@ -352,7 +507,7 @@ class BootstrappedIEPipeline(object):
         """
         logger.debug(u'running generalize_knowledge')
         facts = set(ent.fact for ent in self.knowledge)
-        k = Knowledge(x for x in evidence.items() if x[0].fact in facts)
+        k = evidence.matching_facts(facts)
         logger.info(u'Found {} potential evidences where the known facts could'
                     u' be manifest'.format(len(k)))
         return k
@@ -366,7 +521,10 @@ class BootstrappedIEPipeline(object):
         Stores questions in self.questions and stops
         """
         logger.debug(u'running generate_questions')
-        self.questions = Knowledge((e, s) for e, s in evidence.items() if e not in self.answers)
+        with self._lock:
+            self.questions = evidence.without(self.answers)
+            self.questions_ranking = CertaintyRanking(self.questions)
+            self.questions_version += 1
 
     def filter_evidence(self, _):
         """
@@ -375,15 +533,15 @@ class BootstrappedIEPipeline(object):
         answers is {(segment, (a, b, relation)): is_evidence, ...}
         """
         logger.debug(u'running filter_evidence')
-        evidence = Knowledge(self.answers)
+        with self._lock:
+            evidence = Knowledge(self.answers)
+            self._updated_relations = self._answered_relations
+            self._answered_relations = set()
         n = len(evidence)
-        evidence.update(
-            (e, score > 0.5)
-            for e, score in self.questions.items()
-            if certainty(score) > self.evidence_threshold and e not in self.answers
-        )
+        confident = self.questions.without(evidence).certain(self.evidence_threshold)
+        evidence.update((e, score > 0.5) for e, score in confident.items())
         logger.info(u'Filtering returns {} human-built evidences and {} '
-                    u'over-threshold evidences'.format(n, n - len(evidence)))
+                    u'over-threshold evidences'.format(n, len(evidence) - n))
         # Answers + questions with a strong prediction
         return evidence
 
@@ -394,49 +552,82 @@ class BootstrappedIEPipeline(object):
         """
         logger.debug(u'running learn_fact_extractors')
         classifiers = {}
+        self._kept_relations = set()
+        if self.incremental and self._scores is not None:
+            self._kept_relations = set(self.relations) - self._updated_relations
         for rel, k in evidence.per_relation().items():
+            if rel in self._kept_relations:
+                if rel in self.extractors:
+                    logger.info(u'Keeping the "{}" relation fact extractor, '
+                                u'there are no new answers'.format(rel))
+                    classifiers[rel] = self.extractors[rel]
+                continue
             yesno = set(k.values())
             if True not in yesno or False not in yesno:
                 logger.warning(u'Not enough evidence to train a fact extractor'
                                u' for the "{}" relation'.format(rel))
                 continue  # Not enough data to train a classifier
             assert len(yesno) == 2, "Evidence is not binary!"
-            logger.info(u'Training "{}" relation with {} '
-                        u'evidences'.format(rel, len(k)))
-            classifiers[rel] = FactExtractorFactory(self.extractor_config, k)
+            previous = self.extractors.get(rel)
+            if (self.incremental and previous is not None and
+                    previous.supports_partial_fit()):
+                learnt = self._training[rel]
+                new = Knowledge((e, s) for e, s in k.items() if learnt.get(e) != s)
+                logger.info(u'Updating "{}" relation with {} new '
+                            u'evidences'.format(rel, len(new)))
+                previous.partial_fit(new)
+                classifiers[rel] = previous
+            else:
+                logger.info(u'Training "{}" relation with {} '
+                            u'evidences'.format(rel, len(k)))
+                classifiers[rel] = FactExtractorFactory(self._extractor_config(), k)
+            self._training[rel] = k
+        self.extractors = classifiers
         return classifiers
 
     def extract_facts(self, extractors):
         """
         Stage 5 of pipeline.
         extractors is a dict {relation: classifier, ...}
+
+        The corpus is read only once: each segment is checked against every
+        relation, and the candidate evidence of each relation is scored in
+        batches of `extraction_batch_size` items. If `extraction_processes` is
+        more than 1, batches of segments are scored on a pool of processes.
+        On incremental mode, relations without new answers are not scored
+        again: their scores are taken from the previous iteration.
+
+        Returns an EvidenceStore, filled one batch at a time.
         """
-        # TODO: this probably is smarter as an outer iteration through segments
-        # and then an inner iteration over relations
         logger.debug(u'running extract_facts')
-        result = Knowledge()
-
-        for r, (lkind, rkind) in self.relations.items():
-            evidence = []
-            for segment in self.db_con.segments.segments_with_both_kinds(lkind, rkind):
-                for o1, o2 in segment.kind_occurrence_pairs(lkind, rkind):
-                    e1 = db.get_entity(segment.entities[o1].kind, segment.entities[o1].key)
-                    e2 = db.get_entity(segment.entities[o2].kind, segment.entities[o2].key)
-                    f = Fact(e1, r, e2)
-                    e = Evidence(f, segment, o1, o2)
-                    evidence.append(e)
-            if r in extractors:
-                classifier = extractors[r].predictor.named_steps["classifier"]
-                true_index = list(classifier.classes_).index(True)
-                ps = extractors[r].predictor.predict_proba(evidence)
-                ps = ps[:, true_index]
+        result = EvidenceStore(self.db_con.segments)
+        counts = defaultdict(int)
+        if self._kept_relations:
+            previous = self._scores.per_relation()
+            for r in self._kept_relations:
+                if r in previous:
+                    result.extend(previous[r])
+                    counts[r] += len(previous[r])
+        relations = dict((r, kinds) for r, kinds in self.relations.items()
+                         if r not in self._kept_relations)
+        if self._offline():
+            # Extractors may be pickled to workers that have no connection
+            for extractor in extractors.values():
+                extractor.drop_persistent_cache()
+        if relations:
+            if self.extraction_processes > 1:
+                scored = self._score_in_parallel(extractors, relations)
             else:
-                # There was no evidence to train this classifier
-                ps = [0.5 for _ in evidence]  # Maximum uncertainty
+                scored = self._score_serially(extractors, relations)
+            for r, segment_ids, o1s, o2s, e1s, e2s, ps in scored:
+                result.add(r, segment_ids, o1s, o2s, e1s, e2s, ps)
+                counts[r] += len(ps)
+        self._scores = result
+
+        for r in self.relations:
             logger.info(u'Estimated fact manifestation probabilities for {} '
                         u'potential evidences for "{}" '
-                        u'relation'.format(len(ps), r))
-            result.update(zip(evidence, ps))
+                        u'relation'.format(counts[r], r))
         return result
 
     def filter_facts(self, facts):
@@ -445,17 +636,117 @@ class BootstrappedIEPipeline(object):
         facts is [((a, b, relation), confidence), ...]
         """
         logger.debug(u'running filter_facts')
-        n = len(self.knowledge)
-        self.knowledge.update((e, s) for e, s in facts.items()
-                              if s > self.fact_threshold)
+        # Updated on a copy, known_facts is read meanwhile without waiting
+        knowledge = Knowledge(self.knowledge)
+        knowledge.update(facts.above(self.fact_threshold).items())
         logger.info(u'Learnt {} new facts this iteration (adding to a total '
-                    u'of {} facts)'.format(len(self.knowledge) - n,
-                                           len(self.knowledge)))
+                    u'of {} facts)'.format(len(knowledge) - len(self.knowledge),
+                                           len(knowledge)))
+        with self._lock:
+            self.knowledge = knowledge
         return facts
 
     ###
     ### Aux methods
     ###
+    def _run(self, function, *args):
+        """
+        Calls function, on a background thread if the pipeline is
+        asynchronous.
+        """
+        if not self.asynchronous:
+            function(*args)
+            return
+        with self._lock:
+            if self._worker is not None:
+                self._rerun = True
+                return
+            self._worker = threading.Thread(
+                target=self._work, args=(function,) + args)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _work(self, function, *args):
+        while True:
+            try:
+                function(*args)
+            except Exception as error:
+                logger.exception(u'Background iteration failed')
+                with self._lock:
+                    self._error = error
+                    self._rerun = False
+            with self._lock:
+                if not self._rerun:
+                    self._worker = None
+                    return
+                self._rerun = False
+            function, args = self.do_iteration, (None,)
+
+    def _offline(self):
+        """True if the segment manager needs no database connection"""
+        return getattr(self.db_con.segments, 'offline', False)
+
+    def _extractor_config(self):
+        """
+        Returns extractor_config, with an in-memory feature cache in place of
+        a persistent one when running offline.
+        """
+        config = self.extractor_config
+        if self._offline():
+            config = dict(config, feature_cache=offline_cache(config.get("feature_cache")))
+        return config
+
+    def _score_serially(self, extractors, relations):
+        """
+        Yields tuples (relation, segment ids, o1s, o2s, e1s, e2s,
+        probabilities) with the scored candidate evidence of the given
+        relations found on the corpus, where e1s and e2s are (kind, key)
+        pairs of the fact entities.
+        """
+        pending = defaultdict(list)
+        manager = self.db_con.segments
+        segments = manager.segments_with_kind_pairs(set(relations.values()),
+                                                    fields=db.CANDIDATE_FIELDS)
+        for chunk in chunks(segments, self.extraction_batch_size):
+            # Only the entities of the segments were read, the rest of
+            # their fields are loaded only for the ones with candidates
+            chunk = load_candidate_segments(manager, chunk, relations, self.segment_fields)
+            for segment in chunk:
+                for r, e in candidate_evidence(segment, relations):
+                    evidence = pending[r]
+                    evidence.append(e)
+                    if len(evidence) >= self.extraction_batch_size:
+                        yield _compact(r, evidence, extractors.get(r))
+                        pending[r] = []
+        for r, evidence in pending.items():
+            yield _compact(r, evidence, extractors.get(r))
+
+    def _score_in_parallel(self, extractors, relations):
+        """
+        Same as _score_serially, but the segments are split in chunks that are
+        scored on a pool of `extraction_processes` worker processes.
+        """
+        manager = self.db_con.segments
+        ids = manager.segment_ids_with_kind_pairs(set(relations.values()))
+        batches = chunks(ids, self.extraction_batch_size)
+        if self._offline():
+            db_name, segments = None, manager
+        else:
+            db_name, segments = get_db().name, None
+        pool = multiprocessing.Pool(
+            self.extraction_processes,
+            _init_scoring_worker,
+            (db_name, segments, relations, self.segment_fields,
+             pickle.dumps(extractors, protocol=2))
+        )
+        try:
+            for chunk, scores in pool.imap_unordered(_score_segments, batches):
+                for r, (indexes, o1s, o2s, e1s, e2s, ps) in scores.items():
+                    yield r, [chunk[i] for i in indexes], o1s, o2s, e1s, e2s, ps
+        finally:
+            pool.close()
+            pool.join()
+
     def _confidence(self, evidence):
         """
         Returns a probability estimation of segment being an manifestation of
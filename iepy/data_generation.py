@@ -1,5 +1,6 @@
 from iepy.db import TextSegmentManager, get_entity
 from iepy.core import Evidence, Fact
+from iepy.utils import chunks
 
 
 def label_evidence_from_oracle(kind_a, kind_b, relation, oracle):
@@ -11,7 +12,7 @@ def label_evidence_from_oracle(kind_a, kind_b, relation, oracle):
     manager = TextSegmentManager()
     ss = manager.segments_with_both_kinds(kind_a, kind_b)
     result = []
-    for s in ss:
+    for s in _segments(manager, ss):
         # cartesian product of all k1 and k2 combinations in the sentence:
         ka_entities = [e for e in s.entities if e.kind == kind_a]
         kb_entities = [e for e in s.entities if e.kind == kind_b]
@@ -38,3 +39,11 @@ def label_evidence_from_oracle(kind_a, kind_b, relation, oracle):
                 elif answer == 'stop':
                     return result
     return result
+
+
+def _segments(manager, segments, chunk_size=100):
+    # Compact segments are expanded a chunk at a time, not one by one
+    for chunk in chunks(segments, chunk_size):
+        manager.expand(chunk)
+        for s in chunk:
+            yield s
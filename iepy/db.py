@@ -1,20 +1,40 @@
-from collections import namedtuple
-try:
-    from functools import lru_cache
-except:
-    from functools32 import lru_cache
+from collections import namedtuple, OrderedDict
+import threading
 
-from mongoengine import connect as mongoconnect
-from mongoengine.connection import get_db
+import numpy
+from mongoengine import connect as mongoconnect, Q
 
 from iepy.models import (
-    IEDocument, PreProcessSteps, InvalidPreprocessSteps, TextSegment, Entity)
+    IEDocument, PreProcessSteps, InvalidPreprocessSteps, TextSegment, Entity,
+    EntityPairIndex, kind_pair, insert_ignoring_duplicates)
+from iepy import vocabulary
+from iepy.utils import chunks
 
 
 IEPYDBConnector = namedtuple('IEPYDBConnector', 'connector segments documents')
 
+# Number of entity pairs looked for on each query of the pair index
+PAIR_LOOKUP_BATCH_SIZE = 1000
+
+# Fields of TextSegment needed for finding the candidate evidence of a
+# segment, and for featurizing it with the default features. Segments can be
+# loaded with only some fields with the `fields` argument of the
+# TextSegmentManager methods.
+CANDIDATE_FIELDS = ('entities',)
+FEATURE_FIELDS = ('entities', 'tokens', 'postags', 'sentences',
+                  # Needed for expanding compact segments
+                  'document', 'offset', 'offset_end', 'compact')
+
 # Number of entities that will be cached on get_entity function.
-ENTITY_CACHE_SIZE = 20  # reasonable compromise
+# Can be changed with entity_cache.resize
+ENTITY_CACHE_SIZE = 10000
+
+
+class MissingSegmentIndexes(Exception):
+    """There are segments created before the kind pairs or the entity pair
+    index existed. They can be added with
+    TextSegmentManager.rebuild_segment_indexes.
+    """
 
 
 def connect(db_name):
@@ -25,6 +45,24 @@ def connect(db_name):
     )
 
 
+def _only(queryset, fields):
+    return queryset if fields is None else queryset.only(*fields)
+
+
+def _reference_id(document, field):
+    # The id of a reference, without dereferencing it
+    value = document._data[field]
+    return getattr(value, 'id', value)
+
+
+def _decoder(vocab, id_arrays):
+    """Dict id -> string of all the ids in the given arrays"""
+    if not id_arrays:
+        return {}
+    ids = numpy.unique(numpy.concatenate(id_arrays)).tolist()
+    return dict(zip(ids, vocab.values(ids)))
+
+
 class DocumentManager(object):
     """Wrapper to the db-access, so it's not that impossible to switch
     from mongodb to something else if desired.
@@ -67,39 +105,345 @@ class DocumentManager(object):
         query = {'preprocess_metadata__%s__exists' % step.name: False}
         return IEDocument.objects(**query).timeout(False)
 
+    def get_documents_lacking_any_preprocess(self, steps):
+        """Returns an iterator of documents that shall be processed on at
+        least one of the given steps."""
+        query = None
+        for step in steps:
+            if not isinstance(step, PreProcessSteps):
+                raise InvalidPreprocessSteps
+            q = Q(**{'preprocess_metadata__%s__exists' % step.name: False})
+            query = q if query is None else query | q
+        if query is None:
+            return IEDocument.objects.none()
+        return IEDocument.objects(query).timeout(False)
+
+    def get_document_ids_lacking_any_preprocess(self, steps):
+        """Same as get_documents_lacking_any_preprocess, but only the
+        document ids are returned."""
+        return self.get_documents_lacking_any_preprocess(steps).scalar('id')
+
+    def get_document_ids(self):
+        """Returns an iterator over the ids of all the documents"""
+        return IEDocument.objects.timeout(False).scalar('id')
+
+    def get_document_ids_lacking_preprocess(self, step):
+        """Same as get_documents_lacking_preprocess, but only the document
+        ids are returned."""
+        return self.get_documents_lacking_preprocess(step).scalar('id')
+
+    def documents_by_id(self, ids):
+        """Returns a dict {id: document} with the documents of the given ids,
+        fetched with a single query.
+        """
+        return IEDocument.objects.in_bulk(list(ids))
+
 
 class TextSegmentManager(object):
 
     def segments_with_both_entities(self, entity_a, entity_b):
-        key_a, key_b = entity_a.key, entity_b.key
-        return TextSegment.objects(entities__key=key_a)(entities__key=key_b)
+        """Returns a list of the segments where both entities occur. Entities
+        are matched by kind and key.
+        Raises MissingSegmentIndexes if the entity pair index is empty but
+        there are segments that should be on it.
+        """
+        ids, = self.segment_ids_with_entity_pairs([(entity_a, entity_b)])
+        return list(self.segments_by_id(ids).values())
+
+    def segment_ids_with_entity_pairs(self, pairs):
+        """Takes a list of pairs of entities and returns a list with, for
+        each pair, the ids of the segments where both entities occur.
+        The pair index is queried in batches, not once per pair.
+        Raises MissingSegmentIndexes if the entity pair index is empty but
+        there are segments that should be on it.
+        """
+        pairs = [((a.kind, a.key), (b.kind, b.key)) for a, b in pairs]
+        found = {}
+        collection = EntityPairIndex._get_collection()
+        for start in range(0, len(pairs), PAIR_LOOKUP_BATCH_SIZE):
+            queries = [EntityPairIndex.pair_query(a, b)
+                       for a, b in pairs[start:start + PAIR_LOOKUP_BATCH_SIZE]]
+            for item in collection.find({'$or': queries}, {'_id': 0}):
+                pair = ((item['kind_a'], item['key_a']),
+                        (item['kind_b'], item['key_b']))
+                found.setdefault(pair, []).append(item['segment'])
+        if not found:
+            self._check_pair_index()
+        return [sorted(found.get(tuple(sorted(pair)), [])) for pair in pairs]
+
+    def _check_pair_index(self):
+        # Segments created before the pair index existed would be silently
+        # missed
+        if EntityPairIndex.objects.only('id').first():
+            return
+        paired = {'entities.1': {'$exists': True}}
+        if TextSegment._get_collection().find_one(paired, {'_id': 1}):
+            raise MissingSegmentIndexes(
+                "The entity pair index is empty, it can be built with "
+                "TextSegmentManager().rebuild_segment_indexes()")
+
+    def rebuild_segment_indexes(self, batch_size=1000):
+        """Builds from scratch the entity pair index and the kind pairs of
+        every segment. Only needed for segments created before they existed.
+        """
+        EntityPairIndex.drop_collection()
+        EntityPairIndex.ensure_indexes()
+        segments = TextSegment.objects.only('entities').timeout(False)
+        for batch in chunks(segments, batch_size):
+            EntityPairIndex.add_segments(batch)
+            collection = TextSegment._get_collection()
+            for segment in batch:
+                segment.update_kind_pairs()
+                collection.update({'_id': segment.id},
+                                  {'$set': {'kind_pairs': segment.kind_pairs}})
+
+    def segments_with_both_kinds(self, kind_a, kind_b, fields=None):
+        """Returns an iterator over the segments with occurrences of both
+        kinds (at least two occurrences, if both kinds are the same).
+        If fields is given, only those fields of the segments are loaded.
+        Raises MissingSegmentIndexes if there are segments with no kind
+        pairs, that would be silently left out.
+        """
+        return self.segments_with_kind_pairs([(kind_a, kind_b)], fields)
+
+    def segments_with_kind_pairs(self, pairs, fields=None):
+        """Returns an iterator over the segments with occurrences of both
+        kinds of at least one of the given pairs of kinds, found with the
+        kind pairs index. Useful for walking the corpus only once when
+        several pairs of kinds are wanted.
+        If fields is given, only those fields of the segments are loaded.
+        Raises MissingSegmentIndexes if there are segments with no kind
+        pairs, that would be silently left out.
+        """
+        if TextSegment.objects(kind_pairs__exists=False).only('id').first():
+            raise MissingSegmentIndexes(
+                "Some segments have no kind pairs, they can be added with "
+                "TextSegmentManager().rebuild_segment_indexes()")
+        query = TextSegment.objects(kind_pairs__in=[kind_pair(a, b) for a, b in pairs])
+        return _only(query, fields).timeout(False)
+
+    def segment_ids_with_kind_pairs(self, pairs):
+        """Same as segments_with_kind_pairs, but only the segment ids are
+        returned.
+        """
+        return self.segments_with_kind_pairs(pairs).scalar('id')
+
+    def segments_by_id(self, ids, fields=None):
+        """Returns a dict {id: segment} with the segments of the given ids,
+        fetched with a single query. If fields is given, only those fields
+        of the segments are loaded. Compact segments are expanded.
+        """
+        segments = _only(TextSegment.objects, fields).in_bulk(list(ids))
+        self.expand(segments.values())
+        return segments
+
+    def get_segment(self, document_identifier, offset):
+        """Returns the segment of the given document starting at offset,
+        expanded if compact"""
+        segment = get_segment(document_identifier, offset)
+        self.expand([segment])
+        return segment
+
+    def expand(self, segments):
+        """Fills the tokens and postags of the given compact segments, from
+        the token ids of their documents, loaded with a single query.
+        Other segments are left untouched.
+        """
+        pending = [s for s in segments if s.compact and not s.tokens]
+        if not pending:
+            return
+        document_ids = set(_reference_id(s, 'document') for s in pending)
+        documents = IEDocument.objects.only('token_ids', 'postag_ids').in_bulk(list(document_ids))
+        slices = []
+        for s in pending:
+            d = documents[_reference_id(s, 'document')]
+            slices.append((vocabulary.unpack_ids(d.token_ids)[s.offset:s.offset_end],
+                           vocabulary.unpack_ids(d.postag_ids)[s.offset:s.offset_end]))
+        tokens = _decoder(vocabulary.tokens, [t for t, _ in slices])
+        postags = _decoder(vocabulary.postags, [p for _, p in slices])
+        for s, (t, p) in zip(pending, slices):
+            # Set on _data, so they are not taken as changes to be saved
+            s._data['tokens'] = [tokens[i] for i in t]
+            s._data['postags'] = [postags[i] for i in p]
+
+
+class EntityRegistry(object):
+    """Finds or creates the entities found by the NERs, keeping an
+    in-process cache of the last `maxsize` used entities, so known entities
+    take no database queries. The entities not cached are looked for, and
+    the missing ones created, in bulk.
+    """
+
+    def __init__(self, maxsize=ENTITY_CACHE_SIZE):
+        self._cache = EntityCache(maxsize)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def warm_up(self, kinds=None):
+        """Loads into the cache the entities already on the database (only
+        the ones of the given kinds, if any), up to the cache size"""
+        query = Entity.objects
+        if kinds is not None:
+            query = query(kind__in=list(kinds))
+        for entity in query.only('key', 'kind', 'canonical_form').timeout(False):
+            self._cache.put((entity.kind, entity.key), entity)
+
+    def resolve(self, items):
+        """Takes a list of (key, kind, canonical_form) and returns the list
+        of their Entity instances, creating the ones that don't exist (with
+        the given canonical form).
+        """
+        found = {}
+        missing = {}
+        for key, kind, canonical_form in items:
+            k = (kind, key)
+            if k in found or k in missing:
+                continue
+            entity = self._cache.get(k)
+            if entity is None:
+                missing[k] = canonical_form
+            else:
+                found[k] = entity
+        if missing:
+            found.update(self._fetch(missing))
+            not_found = dict((k, v) for k, v in missing.items() if k not in found)
+            if not_found:
+                entities = [Entity(key=key, kind=kind, canonical_form=canonical_form)
+                            for (kind, key), canonical_form in not_found.items()]
+                # Written without mongoengine, so validated here
+                for entity in entities:
+                    entity.validate()
+                # Entities created meanwhile by other processes are skipped,
+                # and fetched below all the same
+                insert_ignoring_duplicates(Entity._get_collection(),
+                                           [e.to_mongo() for e in entities])
+                found.update(self._fetch(not_found))
+        return [found[(kind, key)] for key, kind, _ in items]
+
+    def _fetch(self, keys):
+        """Fetches and caches the entities of the given (kind, key) pairs.
+        Returns a dict {(kind, key): Entity} of the found ones."""
+        result = _query_entities(keys)
+        for k, entity in result.items():
+            self._cache.put(k, entity)
+        return result
+
+
+class EntityCache(object):
+    """Least recently used cache of Entity instances by (kind, key), with
+    statistics of hits and misses. Thread safe.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Neither the lock nor the cached entities are worth to be transferred
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Returns the cached entity, or None"""
+        with self._lock:
+            entity = self._items.pop(key, None)
+            if entity is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items[key] = entity  # Now it's the most recently used
+            return entity
+
+    def put(self, key, entity):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = entity
+            self._shrink()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._shrink()
+
+    def _shrink(self):
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """Returns a dict with the hits, misses, current size and maxsize"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._items), 'maxsize': self.maxsize}
+
+
+entity_cache = EntityCache(ENTITY_CACHE_SIZE)
+
+
+def _query_entities(keys):
+    """Fetches the entities of the given set of (kind, key) pairs with a
+    single query. Returns a dict {(kind, key): Entity} of the found ones.
+    """
+    query = Entity.objects(kind__in=list(set(kind for kind, _ in keys)),
+                           key__in=list(set(key for _, key in keys)))
+    return dict(((e.kind, e.key), e) for e in query if (e.kind, e.key) in keys)
+
+
+# Function used for loading the entities not cached, see set_entity_source
+_entity_source = _query_entities
+
+
+def set_entity_source(source):
+    """Changes where get_entity and get_entities find the entities not
+    cached (the database, by default). source is a function that takes a set
+    of (kind, key) pairs and returns a dict {(kind, key): Entity} with the
+    ones found. None restores the default. The cache is cleared.
+    """
+    global _entity_source
+    _entity_source = _query_entities if source is None else source
+    entity_cache.clear()
+
 
-    def segments_with_both_kinds(self, kind_a, kind_b):
-        if kind_a != kind_b:
-            return TextSegment.objects(entities__kind=kind_a)(entities__kind=kind_b)
-        else:
-            # Need a different query here, we need to check that the type
-            # appears twice
-            db = get_db()
-            pipeline = [
-                {'$match': {"entities.kind": kind_a}},
-                {'$unwind': "$entities"},
-                {'$group': {
-                    '_id': {'_id': "$_id", 'k': "$entities.kind"},
-                    'count': {'$sum': 1}
-                }},
-                {'$match': {'_id.k': kind_a, 'count': {'$gte': 2}}},
-                {'$project': {'_id': 0, 'id': "$_id._id"}},
-            ]
-
-            objects = db.text_segment.aggregate(pipeline)
-            segments = list(TextSegment.objects.in_bulk([c['id'] for c in objects[u'result']]).values())
-            return segments
-
-
-@lru_cache(maxsize=ENTITY_CACHE_SIZE)
 def get_entity(kind, literal):
-    return Entity.objects.get(kind=kind, key=literal)
+    entity = entity_cache.get((kind, literal))
+    if entity is None:
+        entity = _entity_source(set([(kind, literal)])).get((kind, literal))
+        if entity is None:
+            raise Entity.DoesNotExist('Entity %s (%s) not found' % (literal, kind))
+        entity_cache.put((kind, literal), entity)
+    return entity
+
+
+def get_entities(keys):
+    """Takes an iterable of (kind, key) pairs and returns a dict
+    {(kind, key): Entity} with their entities. The ones not cached are
+    fetched with a single query, and cached. Missing entities are left out.
+    """
+    result = {}
+    missing = set()
+    for k in set(keys):
+        entity = entity_cache.get(k)
+        if entity is None:
+            missing.add(k)
+        else:
+            result[k] = entity
+    if missing:
+        for k, entity in _entity_source(missing).items():
+            entity_cache.put(k, entity)
+            result[k] = entity
+    return result
 
 
 def get_segment(document_identifier, offset):
@@ -0,0 +1,492 @@
+"""
+Columnar storage of scored evidence.
+
+Evidence instances are heavy: they hold Entity and TextSegment documents, and
+hashing or comparing them means comparing those documents. An EvidenceStore
+keeps the same information as a Knowledge, but as parallel numpy arrays of
+integers (segment, o1, o2, relation, e1, e2) plus an array of scores, so
+filtering, sorting and grouping are vectorised operations. Evidence instances
+are built only when asked for, loading their segments in bulk.
+
+Fact and Evidence are defined here, and re-exported by iepy.core.
+"""
+from collections import defaultdict, namedtuple
+import itertools
+
+from colorama import Fore, Style
+import numpy
+
+from iepy import db
+from iepy.utils import ValueTable
+
+
+# A fact is a triple with two Entity() instances and a relation label
+Fact = namedtuple("Fact", "e1 relation e2")
+BaseEvidence = namedtuple("Evidence", "fact segment o1 o2")
+
+
+class Evidence(BaseEvidence):
+    """
+    An Evidence is a pair of a Fact and a TextSegment and occurrence indices.
+    Evicence instances are tipically constructed whitin a
+    BootstrappedIEPipeline and it attributes are meant to be used directly (no
+    getters or setters) in a read-only fashion (it's an inmutable after all).
+
+    Evidence instances are dense information and follow strict invariants so
+    here is a small cheatsheet of its contents:
+
+    -e                           # Evidence instance
+        -fact                    # Fact instance
+            -relation            # A `str` naming the relation of the fact
+            -e1                  # Entity instance (an abstract entity, not an entity occurrence)
+                -kind            # A `str` naming the kind/type of entity
+                -key             # A `str` that uniquely identifies this entity
+                -canonical_form  # A `str` that's the human-friendly way to represent this entity
+            -e2                  # Entity instance (an abstract entity, not an entity occurrence)
+                -kind            # A `str` naming the kind/type of entity
+                -key             # A `str` that uniquely identifies this entity
+                -canonical_form  # A `str` that's the human-friendly way to represent this entity
+        -segment                 # A Segment instance
+            -tokens              # A list of `str` representing the tokens in the segment
+            -text                # The original text `str` of this document
+            -sentences           # A list of token indexes denoting the start of the syntactic sentences on the segment
+            -postags             # A list of `str` POS tags, in 1-on-1 relation with tokens
+            -offset              # An `int`, the offset of the segment, in tokens, from the document start
+            -entities            # A list of entity occurrences
+                -kind            # A `str` naming the kind/type of entity
+                -key             # A `str` that uniquely identifies this entity
+                -canonical_form  # A `str` that's the human-friendly way to represent this entity
+                -offset          # An `int`, the offset to the entity occurrence start, in tokens, from the segment start
+                -offset_end      # An `int`, the offset to the entity occurrence end, in tokens, from the segment start
+                -alias           # A `str`, the literal text manifestation of the entity occurrence
+        -o1                      # The index in segment.entities occurrence of the first entity
+        -o2                      # The index in segment.entities occurrence of the second entity
+
+
+    And a commonly needed recipe:
+        e.segment.entities[e.o1]  # The occurrence of the first entity
+        e.segment.entities[e.o2]  # The occurrence of the second entity
+
+
+    The segment+indices can be left out (as None)
+    The following invariants apply
+     - e.segment == None iff e.o1 == None
+     - e.segment == None iff e.o2 == None
+     - e.o1 != None implies e.fact.e1.kind == e.segment.entities[e.o1].kind and e.fact.e1.key == e.segment.entities[e.o1].key
+     - e.o2 != None implies e.fact.e2.kind == e.segment.entities[e.o2].kind and e.fact.e2.key == e.segment.entities[e.o2].key
+    """
+    __slots__ = []
+
+    def colored_text(self, color_1, color_2):
+        """Will return a naive formated text with entities remarked.
+        Assumes that occurrences does not overlap.
+        """
+        occurr1 = self.segment.entities[self.o1]
+        occurr2 = self.segment.entities[self.o2]
+        tkns = self.segment.tokens[:]
+        if self.o1 < self.o2:
+            tkns.insert(occurr2.offset_end, Style.RESET_ALL)
+            tkns.insert(occurr2.offset, color_2)
+            tkns.insert(occurr1.offset_end, Style.RESET_ALL)
+            tkns.insert(occurr1.offset, color_1)
+        else:  # must be solved in the reverse order
+            tkns.insert(occurr1.offset_end, Style.RESET_ALL)
+            tkns.insert(occurr1.offset, color_1)
+            tkns.insert(occurr2.offset_end, Style.RESET_ALL)
+            tkns.insert(occurr2.offset, color_2)
+        return u' '.join(tkns)
+
+    def colored_fact(self, color_1, color_2):
+        return u'(%s <%s>, %s, %s <%s>)' % (
+            color_1 + self.fact.e1.key + Style.RESET_ALL,
+            self.fact.e1.kind,
+            self.fact.relation,
+            color_2 + self.fact.e2.key + Style.RESET_ALL,
+            self.fact.e2.kind,
+        )
+
+    def colored_fact_and_text(self):
+        color_1 = Fore.RED
+        color_2 = Fore.GREEN
+        return (
+            self.colored_fact(color_1, color_2),
+            self.colored_text(color_1, color_2)
+        )
+
+
+def load_evidence(segments, items, chunk_size=1000):
+    """
+    Takes compact items (segment id, o1, o2, relation, e1 key, e2 key, score)
+    where entity keys are (kind, key) pairs, and yields the corresponding
+    (evidence, score) pairs. Segments are loaded from `segments` (a
+    TextSegmentManager) and entities from the entity cache in bulk, one
+    chunk of items at a time, so memory usage doesn't depend on how many
+    items there are.
+    """
+    items = iter(items)
+    chunk = list(itertools.islice(items, chunk_size))
+    while chunk:
+        loaded = segments.segments_by_id(set(item[0] for item in chunk))
+        entities = db.get_entities(set(k for item in chunk for k in item[4:6]))
+        for segment_id, o1, o2, relation, k1, k2, score in chunk:
+            e1, e2 = entities.get(k1), entities.get(k2)
+            # Not found in bulk, get_entity raises the proper error
+            e1 = db.get_entity(*k1) if e1 is None else e1
+            e2 = db.get_entity(*k2) if e2 is None else e2
+            fact = Fact(e1, relation, e2)
+            yield Evidence(fact, loaded[segment_id], int(o1), int(o2)), score
+        chunk = list(itertools.islice(items, chunk_size))
+
+
+def _entity_key(entity):
+    return (entity.kind, entity.key)
+
+
+class EvidenceStore(object):
+    """
+    Knowledge-like collection of scored evidence, stored on columns.
+
+    - segment: index on `segment_ids` of the id of the segment
+    - o1, o2: indexes of the occurrences on the segment
+    - relation: index on `relations` of the relation name
+    - e1, e2: indexes on `entities` of the (kind, key) of the fact entities
+    - score: the score, NaN meaning None
+
+    Stores returned by filtering methods share the tables of the store they
+    come from. `segments` is a TextSegmentManager used for loading segments
+    when Evidence instances are needed.
+    """
+    columns = ('segment', 'o1', 'o2', 'relation', 'e1', 'e2')
+    load_size = 1000  # Number of segments loaded at once
+
+    def __init__(self, segments, _tables=None):
+        self.segments = segments
+        if _tables is None:
+            _tables = (ValueTable(), ValueTable(), ValueTable())
+        self._tables = _tables
+        self.segment_ids, self.relations, self.entities = _tables
+        self._pending = []
+        self._data = dict((c, numpy.zeros(0, dtype=numpy.int64)) for c in self.columns)
+        self._data['score'] = numpy.zeros(0, dtype=numpy.float64)
+        self._row_index = None  # (segment, o1, o2, relation) -> row, see row_of
+
+    ###
+    ### Filling
+    ###
+
+    def add(self, relation, segment_ids, o1s, o2s, e1s, e2s, scores):
+        """
+        Adds a chunk of evidence of relation. All the arguments but relation
+        are sequences of the same length: e1s and e2s of (kind, key) pairs,
+        scores of floats or None.
+        """
+        n = len(o1s)
+        if not n:
+            return
+        scores = [numpy.nan if x is None else x for x in scores]
+        self._pending.append({
+            'segment': self.segment_ids.ids_of(segment_ids),
+            'o1': numpy.asarray(o1s, dtype=numpy.int64),
+            'o2': numpy.asarray(o2s, dtype=numpy.int64),
+            'relation': numpy.repeat(self.relations.id_of(relation), n),
+            'e1': self.entities.ids_of(e1s),
+            'e2': self.entities.ids_of(e2s),
+            'score': numpy.asarray(scores, dtype=numpy.float64),
+        })
+
+    def add_items(self, items):
+        """
+        Adds (evidence, score) pairs. Evidence segments must be saved.
+        """
+        chunks = defaultdict(lambda: ([], [], [], [], [], []))
+        for e, s in items:
+            chunk = chunks[e.fact.relation]
+            for column, value in zip(chunk, (
+                    e.segment.id, e.o1, e.o2,
+                    _entity_key(e.fact.e1), _entity_key(e.fact.e2), s)):
+                column.append(value)
+        for relation, chunk in chunks.items():
+            self.add(relation, *chunk)
+
+    def extend(self, store):
+        """Adds all the evidence of another EvidenceStore, without loading
+        any of it.
+        """
+        d = store.data
+        chunk = dict(d)
+        if store._tables is not self._tables:
+            for column, table, other in (
+                    ('segment', self.segment_ids, store.segment_ids),
+                    ('relation', self.relations, store.relations),
+                    ('e1', self.entities, store.entities),
+                    ('e2', self.entities, store.entities)):
+                mapping = table.ids_of(other.values)
+                chunk[column] = mapping[d[column]] if len(mapping) else d[column]
+        self._pending.append(chunk)
+
+    @property
+    def data(self):
+        """dict of column name -> numpy array"""
+        if self._pending:
+            chunks = [self._data] + self._pending
+            self._data = dict(
+                (c, numpy.concatenate([x[c] for x in chunks]))
+                for c in self._data
+            )
+            self._pending = []
+            self._row_index = None
+        return self._data
+
+    def __len__(self):
+        return len(self.data['score'])
+
+    ###
+    ### Vectorised operations
+    ###
+
+    def scores(self):
+        return self.data['score']
+
+    def certainty(self):
+        """Array with the certainty of each score, see iepy.core.certainty"""
+        scores = self.scores()
+        result = 0.5 + numpy.abs(scores - 0.5)
+        result[numpy.isnan(scores)] = 0.5
+        return result
+
+    def select(self, rows):
+        """Returns a new store with the given rows (indexes or boolean mask)"""
+        result = EvidenceStore(self.segments, self._tables)
+        result._data = dict((c, v[rows]) for c, v in self.data.items())
+        return result
+
+    def above(self, threshold):
+        """Returns a store with only the evidence scored over threshold"""
+        with numpy.errstate(invalid='ignore'):
+            return self.select(self.scores() > threshold)
+
+    def certain(self, threshold):
+        """Returns a store with only the evidence with certainty over threshold
+        """
+        return self.select(self.certainty() > threshold)
+
+    def per_relation(self):
+        """
+        Returns a dictionary: relation -> EvidenceStore, where each value is
+        only the evidence for that specific relation
+        """
+        relation = self.data['relation']
+        order = numpy.argsort(relation, kind='mergesort')
+        ids, starts = numpy.unique(relation[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        return dict(
+            (self.relations.values[i], self.select(order[start:end]))
+            for i, start, end in zip(ids, starts, bounds)
+        )
+
+    def matching_facts(self, facts):
+        """
+        Returns a store with only the evidence of the given facts
+        """
+        wanted = []
+        for f in facts:
+            r = self.relations.index.get(f.relation)
+            e1 = self.entities.index.get(_entity_key(f.e1))
+            e2 = self.entities.index.get(_entity_key(f.e2))
+            if None not in (r, e1, e2):
+                wanted.append((r, e1, e2))
+        d = self.data
+        mask = _isin_rows((d['relation'], d['e1'], d['e2']), wanted)
+        return self.select(mask)
+
+    def without(self, evidences):
+        """
+        Returns a store without the given evidences (any iterable of Evidence,
+        like a Knowledge or a dict)
+        """
+        unwanted = []
+        for e in evidences:
+            if e.segment is None:
+                continue
+            s = self.segment_ids.index.get(e.segment.id)
+            r = self.relations.index.get(e.fact.relation)
+            if None not in (s, r):
+                unwanted.append((s, e.o1, e.o2, r))
+        d = self.data
+        mask = _isin_rows((d['segment'], d['o1'], d['o2'], d['relation']), unwanted)
+        return self.select(~mask)
+
+    def certainty_key(self):
+        """
+        Array with the value used for sorting by certainty: the certainty,
+        or 0 for evidence scored None (as in Knowledge.by_certainty)
+        """
+        certainty = self.certainty()
+        certainty[numpy.isnan(self.scores())] = 0
+        return certainty
+
+    def certainty_order(self, n=None):
+        """
+        Array of row indexes, from the most certain evidence to the least
+        certain one. If n is given, only the first n rows are returned, and
+        no full sort is done.
+        """
+        return sorted_top(self.certainty_key(), n)
+
+    def row_of(self, evidence):
+        """Returns the row index of the given evidence, or None. The first
+        call builds an index of the rows, so later ones take constant time.
+        """
+        if evidence.segment is None:
+            return None
+        s = self.segment_ids.index.get(evidence.segment.id)
+        r = self.relations.index.get(evidence.fact.relation)
+        if s is None or r is None:
+            return None
+        d = self.data
+        if self._row_index is None:
+            keys = zip(d['segment'].tolist(), d['o1'].tolist(),
+                       d['o2'].tolist(), d['relation'].tolist())
+            self._row_index = {}
+            for row, key in enumerate(keys):
+                self._row_index.setdefault(key, row)
+        return self._row_index.get((s, evidence.o1, evidence.o2, r))
+
+    ###
+    ### Evidence views
+    ###
+
+    def evidence(self, rows):
+        """Yields (evidence, score) for each of the given row indexes, in
+        order, loading their segments and entities in bulk.
+        """
+        return load_evidence(self.segments, self._load_items(rows),
+                             self.load_size)
+
+    def items(self):
+        """Iterates over (evidence, score) pairs, like Knowledge.items()"""
+        return self.evidence(numpy.arange(len(self)))
+
+    def __iter__(self):
+        return (e for e, _ in self.items())
+
+    def values(self):
+        return [None if numpy.isnan(s) else float(s) for s in self.scores()]
+
+    def by_certainty(self, n=None):
+        """
+        Same as Knowledge.by_certainty, but evidence is loaded as the result
+        is iterated.
+        """
+        return self.evidence(self.certainty_order(n))
+
+    def compact_items(self):
+        """
+        Iterates over (segment id, o1, o2, relation, score) tuples, without
+        loading any segment.
+        """
+        d = self.data
+        for s, o1, o2, r, score in zip(d['segment'], d['o1'], d['o2'],
+                                       d['relation'], d['score']):
+            score = None if numpy.isnan(score) else float(score)
+            yield (self.segment_ids.values[s], int(o1), int(o2),
+                   self.relations.values[r], score)
+
+    def _load_items(self, rows):
+        """(segment id, o1, o2, relation, e1 key, e2 key, score) of the given
+        row indexes, as taken by load_evidence"""
+        d = self.data
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        columns = [d[c][rows] for c in self.columns] + [d['score'][rows]]
+        for s, o1, o2, r, e1, e2, score in zip(*columns):
+            score = None if numpy.isnan(score) else float(score)
+            yield (self.segment_ids.values[s], o1, o2, self.relations.values[r],
+                   self.entities.values[e1], self.entities.values[e2], score)
+
+
+class CertaintyRanking(object):
+    """
+    Order by certainty of the rows of an EvidenceStore, computed
+    incrementally: rows are ranked `page_size` at a time, only as they are
+    asked for, and removed rows (ie, answered questions) are just skipped.
+    """
+    page_size = 1000
+
+    def __init__(self, store):
+        self.store = store
+        self._key = store.certainty_key()
+        self._unranked = numpy.ones(len(self._key), dtype=bool)
+        self._removed = numpy.zeros(len(self._key), dtype=bool)
+        self._ranked = numpy.zeros(0, dtype=numpy.int64)
+
+    def remove(self, row):
+        self._removed[row] = True
+
+    def __len__(self):
+        return int(len(self._removed) - self._removed.sum())
+
+    def top(self, n=None):
+        """
+        Array of the indexes of the n most certain rows not removed (or all
+        of them if n is None), most certain first.
+        """
+        if n is None:
+            n = len(self._key)
+        while True:
+            ranked = self._ranked[~self._removed[self._ranked]]
+            if len(ranked) >= n or not self._unranked.any():
+                return ranked[:n]
+            candidates = numpy.flatnonzero(self._unranked)
+            page = max(self.page_size, n - len(ranked))
+            new = candidates[sorted_top(self._key[candidates], page)]
+            self._unranked[new] = False
+            self._ranked = numpy.concatenate([self._ranked, new])
+
+    def items(self, n=None):
+        """(evidence, score) of the n most certain rows not removed"""
+        return self.store.evidence(self.top(n))
+
+
+def sorted_top(key, n=None):
+    """
+    Returns the indexes of the n biggest values of the array key, sorted from
+    biggest to smallest, and ties by index. This is the same as the first n
+    items of a full stable sort, but done with a partial selection. If n is
+    None all the indexes are sorted.
+    """
+    if n is None or n >= len(key):
+        return numpy.argsort(-key, kind='mergesort')
+    if n <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    kth = key[numpy.argpartition(-key, n - 1)[:n]].min()
+    bigger = numpy.flatnonzero(key > kth)
+    ties = numpy.flatnonzero(key == kth)[:n - len(bigger)]
+    rows = numpy.concatenate([bigger, ties])
+    return rows[numpy.argsort(-key[rows], kind='mergesort')]
+
+
+def _isin_rows(columns, rows):
+    """
+    Returns a boolean mask telling which positions of the given int columns
+    form a tuple that's in rows.
+    """
+    n = len(columns[0])
+    if not rows or not n:
+        return numpy.zeros(n, dtype=bool)
+    # Pack each tuple into a single integer, and look them up with a binary
+    # search on the sorted wanted ones
+    wanted = numpy.array(rows, dtype=numpy.int64).T
+    bases = [max(int(c.max()) if len(c) else 0, int(w.max())) + 1
+             for c, w in zip(columns, wanted)]
+    if numpy.prod([float(b) for b in bases]) >= 2 ** 62:
+        rows = set(rows)
+        return numpy.array([t in rows for t in zip(*columns)], dtype=bool)
+    keys = numpy.zeros(n, dtype=numpy.int64)
+    wanted_keys = numpy.zeros(wanted.shape[1], dtype=numpy.int64)
+    for c, w, base in zip(columns, wanted, bases):
+        keys = keys * base + c
+        wanted_keys = wanted_keys * base + w
+    wanted_keys = numpy.unique(wanted_keys)
+    positions = numpy.searchsorted(wanted_keys, keys)
+    positions[positions == len(wanted_keys)] = 0
+    return wanted_keys[positions] == keys
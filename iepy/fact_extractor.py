@@ -16,6 +16,10 @@ from sklearn.linear_model import LogisticRegression
 
 from future.builtins import map, str
 
+from iepy.feature_cache import (CachedFeatureEvaluator, SegmentFeatureEvaluator,
+                                offline_cache, segment_feature)
+from iepy.feature_hashing import HashingVectorizer, BUCKETS
+
 
 __all__ = ["FactExtractorFactory"]
 
@@ -33,6 +37,41 @@ _classifiers = {
 }
 
 
+def _featureforge_vectorizer(features, config):
+    vectorizer = Vectorizer(features)
+    cache = config.get("feature_cache")
+    if cache is not None:
+        vectorizer.evaluator = CachedFeatureEvaluator(
+            vectorizer.evaluator, cache, features)
+    else:
+        vectorizer.evaluator = SegmentFeatureEvaluator(vectorizer.evaluator)
+    return vectorizer
+
+
+def _batch_vectorizer(features, config):
+    # Imported here because iepy.batch_features uses the features of this
+    # module. Batches are fast to compute, so the feature cache is not used.
+    from iepy.batch_features import BatchVectorizer
+    return BatchVectorizer(features)
+
+
+def _hashing_vectorizer(features, config):
+    non_negative = config.get("hashing_non_negative", False)
+    if not non_negative and (config.get("classifier") == "naivebayes_m" or
+                             config.get("column_filter")):
+        raise ValueError("Hashed values may be negative, naivebayes_m and "
+                         "column_filter need hashing_non_negative")
+    return HashingVectorizer(features, config.get("hashing_buckets", BUCKETS),
+                             config.get("feature_cache"), non_negative)
+
+
+_vectorizers = {
+    "featureforge": _featureforge_vectorizer,
+    "batch": _batch_vectorizer,
+    "hashing": _hashing_vectorizer,
+}
+
+
 class FactExtractor(object):
 
     def __init__(self, config):
@@ -62,8 +101,10 @@ class FactExtractor(object):
             BagOfVerbLemmas(in_between=False)
         ])
         classifier = _classifiers[config.get("classifier", "sgd")]
+        vectorizer = _vectorizers[config.get("vectorizer", "featureforge")]
+        vectorizer = vectorizer(features, config)
         steps = [
-            ('vectorizer', Vectorizer(features)),
+            ('vectorizer', vectorizer),
             ('filter', ColumnFilter(2)) if config.get("column_filter") else None,
             ('scaler', StandardScaler()) if config.get("scaler") else None,
             ('classifier', classifier(**config.get('classifier_args', {})))
@@ -77,16 +118,49 @@ class FactExtractor(object):
         self.predictor = p
 
     def fit(self, data):
-        X = []
-        y = []
-        for evidence, score in data.items():
-            X.append(evidence)
-            y.append(int(score))
+        X, y = _split(data)
         self.predictor.fit(X, y)
 
+    def supports_partial_fit(self):
+        """True if the classifier can be updated with more data (via
+        `partial_fit`) instead of trained again from scratch.
+        """
+        classifier = self.predictor.steps[-1][1]
+        return hasattr(classifier, "partial_fit")
+
+    def partial_fit(self, data):
+        """Updates an already fitted extractor with more evidence. The
+        vectorizer and the other steps keep the columns learnt on `fit`, so
+        features not seen before are ignored; only the classifier is updated.
+        """
+        X, y = _split(data)
+        if not X:
+            return
+        for _, step in self.predictor.steps[:-1]:
+            X = step.transform(X)
+        self.predictor.steps[-1][1].partial_fit(X, y)
+
     def predict(self, evidences):
         return self.predictor.predict(evidences)
 
+    def drop_persistent_cache(self):
+        """Keeps the evaluated features in memory instead of on the database
+        from now on, so the extractor can be used with no connection.
+        """
+        vectorizer = self.predictor.steps[0][1]
+        owner = getattr(vectorizer, 'evaluator', vectorizer)
+        if getattr(owner, 'cache', None) is not None:
+            owner.cache = offline_cache(owner.cache)
+
+
+def _split(data):
+    X = []
+    y = []
+    for evidence, score in data.items():
+        X.append(evidence)
+        y.append(int(score))
+    return X, y
+
 
 def FactExtractorFactory(config, data):
     """Instantiates and trains a classifier."""
@@ -99,30 +173,55 @@ def FactExtractorFactory(config, data):
 # FEATURES
 ###
 
+# Output validators. Defined as functions (instead of lambdas) so features,
+# and fact extractors that use them, can be pickled.
 
+def _all_pairs(v):
+    return all(len(x) == 2 for x in v)
+
+
+def _all_pairs_of_pairs(v):
+    return all(len(x) == 2 and all(len(y) == 2 for y in x) for x in v)
+
+
+def _is_binary(x):
+    return x in (0, 1)
+
+
+def _is_non_negative(x):
+    return x >= 0
+
+
+def _is_two_or_more(x):
+    return x >= 2
+
+
+@segment_feature
 @output_schema({str})
 def bag_of_words(datapoint):
     return set(words(datapoint))
 
 
+@segment_feature
 @output_schema({str})
 def bag_of_pos(datapoint):
     return set(pos(datapoint))
 
 
-@output_schema({(str,)}, lambda v: all(len(x) == 2 for x in v))
+@segment_feature
+@output_schema({(str,)}, _all_pairs)
 def bag_of_word_bigrams(datapoint):
     return set(bigrams(words(datapoint)))
 
 
-@output_schema({(str,)}, lambda v: all(len(x) == 2 for x in v))
+@segment_feature
+@output_schema({(str,)}, _all_pairs)
 def bag_of_wordpos(datapoint):
     return set(zip(words(datapoint), pos(datapoint)))
 
 
-@output_schema({((str,),)},
-               lambda v: all(len(x) == 2 and
-                             all(len(y) == 2 for y in x) for x in v))
+@segment_feature
+@output_schema({((str,),)}, _all_pairs_of_pairs)
 def bag_of_wordpos_bigrams(datapoint):
     xs = list(zip(words(datapoint), pos(datapoint)))
     return set(bigrams(xs))
@@ -140,28 +239,26 @@ def bag_of_pos_in_between(datapoint):
     return set(pos(datapoint)[i:j])
 
 
-@output_schema({(str,)}, lambda v: all(len(x) == 2 for x in v))
+@output_schema({(str,)}, _all_pairs)
 def bag_of_word_bigrams_in_between(datapoint):
     i, j = in_between_offsets(datapoint)
     return set(bigrams(words(datapoint)[i:j]))
 
 
-@output_schema({(str,)}, lambda v: all(len(x) == 2 for x in v))
+@output_schema({(str,)}, _all_pairs)
 def bag_of_wordpos_in_between(datapoint):
     i, j = in_between_offsets(datapoint)
     return set(list(zip(words(datapoint), pos(datapoint)))[i:j])
 
 
-@output_schema({((str,),)},
-               lambda v: all(len(x) == 2 and
-                             all(len(y) == 2 for y in x) for x in v))
+@output_schema({((str,),)}, _all_pairs_of_pairs)
 def bag_of_wordpos_bigrams_in_between(datapoint):
     i, j = in_between_offsets(datapoint)
     xs = list(zip(words(datapoint), pos(datapoint)))[i:j]
     return set(bigrams(xs))
 
 
-@output_schema(int, lambda x: x in (0, 1))
+@output_schema(int, _is_binary)
 def entity_order(datapoint):
     """
     Returns 1 if A occurs prior to B in the segment and 0 otherwise.
@@ -172,7 +269,7 @@ def entity_order(datapoint):
     return 0
 
 
-@output_schema(int, lambda x: x >= 0)
+@output_schema(int, _is_non_negative)
 def entity_distance(datapoint):
     """
     Returns the distance (in tokens) that separates the ocurrence of the
@@ -182,7 +279,7 @@ def entity_distance(datapoint):
     return j - i
 
 
-@output_schema(int, lambda x: x >= 0)
+@output_schema(int, _is_non_negative)
 def other_entities_in_between(datapoint):
     """
     Returns the number of entity ocurrences in between the datapoint entities.
@@ -195,7 +292,8 @@ def other_entities_in_between(datapoint):
     return n
 
 
-@output_schema(int, lambda x: x >= 2)
+@segment_feature
+@output_schema(int, _is_two_or_more)
 def total_number_of_entities(datapoint):
     """
     Returns the number of entity in the text segment
@@ -203,7 +301,7 @@ def total_number_of_entities(datapoint):
     return len(datapoint.segment.entities)
 
 
-@output_schema(int, lambda x: x >= 0)
+@output_schema(int, _is_non_negative)
 def verbs_count_in_between(datapoint):
     """
     Returns the number of Verb POS tags in between of the 2 entities.
@@ -212,7 +310,8 @@ def verbs_count_in_between(datapoint):
     return len(verbs(datapoint, i, j))
 
 
-@output_schema(int, lambda x: x >= 0)
+@segment_feature
+@output_schema(int, _is_non_negative)
 def verbs_count(datapoint):
     """
     Returns the number of Verb POS tags in the datapoint.
@@ -223,6 +322,10 @@ def verbs_count(datapoint):
 class BaseBagOfVerbs(Feature):
     output_schema = Schema({str})
 
+    @property
+    def segment_level(self):
+        return not self.in_between
+
     def _evaluate(self, datapoint):
         i, j = None, None
         if self.in_between:
@@ -238,7 +341,11 @@ class BagOfVerbStems(BaseBagOfVerbs):
 
     def __init__(self, in_between=False):
         self.in_between = in_between
-        self.do = LancasterStemmer().stem
+        self.stemmer = LancasterStemmer()
+
+    def do(self, token):
+        # Not the bound stem method itself, which python 2 can't pickle
+        return self.stemmer.stem(token)
 
 
 class BagOfVerbLemmas(BaseBagOfVerbs):
@@ -253,7 +360,7 @@ class BagOfVerbLemmas(BaseBagOfVerbs):
         return str(self.wn.lemmatize(token.lower(), 'v'))
 
 
-@output_schema(int, lambda x: x in (0, 1))
+@output_schema(int, _is_binary)
 def in_same_sentence(datapoint):  # TODO: Test
     """
     Returns 1 if the datapoints entities are in the same senteces.
@@ -266,7 +373,7 @@ def in_same_sentence(datapoint):  # TODO: Test
     return 1
 
 
-@output_schema(int, lambda x: x in (0, 1))
+@output_schema(int, _is_binary)
 def symbols_in_between(datapoint):
     """
     returns 1 if there are symbols between the entities, 0 if not.
@@ -280,7 +387,8 @@ def symbols_in_between(datapoint):
     return 0
 
 
-@output_schema(int, lambda x: x >= 0)
+@segment_feature
+@output_schema(int, _is_non_negative)
 def number_of_tokens(datapoint):
     return len(datapoint.segment.tokens)
 
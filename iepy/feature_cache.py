@@ -0,0 +1,238 @@
+"""
+Caching of evaluated features.
+
+Evaluating the features of an evidence is the most expensive part of both
+training and using a fact extractor, and the result depends only on the text
+segment and the pair of occurrences, which never change between bootstrap
+iterations. A FeatureCache stores the evaluated feature values keyed by
+(segment id, o1, o2), a digest of the segment content and a hash of the
+feature configuration, so features are computed only once per evidence and
+configuration, and values of segments rebuilt with another content are
+never used.
+
+Besides, many features depend only on the text segment (see
+segment_feature), and a segment with k entities has up to k^2 evidence
+pairs. Those features are evaluated once per segment and shared by all the
+evidence of it.
+"""
+import hashlib
+import json
+import pickle
+import types
+
+from iepy.models import EvidenceFeatures, insert_ignoring_duplicates
+
+
+def segment_feature(f):
+    """Decorator that flags a feature whose value depends only on the text
+    segment of the evidence, and not on the pair of occurrences.
+    """
+    f.segment_level = True
+    return f
+
+
+def is_segment_feature(feature):
+    """True if the feature was flagged with segment_feature, either directly
+    or as wrapped by featureforge.
+    """
+    evaluate = getattr(feature, '_evaluate', None)
+    return (getattr(feature, 'segment_level', False) is True or
+            getattr(evaluate, 'segment_level', False) is True)
+
+
+def evaluate_features(features, evidences):
+    """Returns a list with the tuple of feature values of each evidence.
+    Segment features are evaluated once per segment.
+    """
+    shared = [is_segment_feature(f) for f in features]
+    segments = {}
+    result = []
+    for evidence in evidences:
+        segment = evidence.segment
+        # The segment is kept with its values so its id is never reused
+        known = segments.get(id(segment))
+        if known is None or known[0] is not segment:
+            known = segments[id(segment)] = (segment, [
+                f(evidence) if s else None for f, s in zip(features, shared)])
+        result.append(tuple(v if s else f(evidence)
+                            for f, s, v in zip(features, shared, known[1])))
+    return result
+
+
+def feature_id(feature):
+    """Returns a string that identifies a feature of a feature configuration.
+    Functions are identified by their code too, so different lambdas (or
+    a function whose code changed) get different ids.
+    """
+    function = getattr(feature, '_evaluate', feature)  # As wrapped by featureforge
+    if isinstance(function, types.FunctionType):
+        code = function.__code__
+        name = getattr(function, '__qualname__', function.__name__)
+        digest = hashlib.sha1(code.co_code).hexdigest()[:12]
+        return u'%s.%s:%s:%s' % (function.__module__, name,
+                                 code.co_firstlineno, digest)
+    name = feature.name
+    if callable(name):
+        name = name()
+    return u'%s.%s' % (type(feature).__module__, name)
+
+
+def features_hash(features):
+    """Returns a hash of the given list of features, to be used as part of
+    the cache keys.
+    """
+    ids = u'\n'.join(feature_id(f) for f in features)
+    return hashlib.sha1(ids.encode('utf-8')).hexdigest()
+
+
+def segment_digest(segment):
+    """Returns a hash of the content of a segment used by features: tokens,
+    POS tags, sentences and entity occurrences.
+    """
+    content = [list(segment.tokens), list(segment.postags),
+               list(segment.sentences),
+               [(e.kind, e.key, e.offset, e.offset_end) for e in segment.entities]]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def evidence_key(evidence, digests=None):
+    """Returns the (segment id, o1, o2, segment digest) key of an evidence,
+    or None if the evidence can't be cached (ie, its segment was never
+    saved). `digests` is an optional dict {segment id: digest} used for
+    computing the digest of each segment only once.
+    """
+    segment = evidence.segment
+    if segment is None or segment.id is None:
+        return None
+    if digests is None:
+        digest = segment_digest(segment)
+    else:
+        digest = digests.get(segment.id)
+        if digest is None:
+            digest = digests[segment.id] = segment_digest(segment)
+    return (segment.id, evidence.o1, evidence.o2, digest)
+
+
+class FeatureCache(object):
+    """Cache of evaluated features of evidence.
+
+    If `persistent` is True the values are stored in the database (so they
+    survive between runs), otherwise they are kept in memory. Persistent
+    values are removed when the segments are (see IEDocument.clear_segments).
+    """
+
+    def __init__(self, persistent=True):
+        self.persistent = persistent
+        self._memory = {}
+
+    def __getstate__(self):
+        # In-memory values are not worth to be transferred
+        state = self.__dict__.copy()
+        state['_memory'] = {}
+        return state
+
+    def evaluate(self, config, features, evidences):
+        """Returns a list with the tuple of feature values of each evidence,
+        evaluating only the ones that are not cached for the given
+        config hash.
+        """
+        evidences = list(evidences)
+        digests = {}
+        keys = [evidence_key(e, digests) for e in evidences]
+        known = self.lookup(config, [k for k in keys if k is not None])
+        missing = [i for i, key in enumerate(keys)
+                   if key is None or key not in known]
+        evaluated = evaluate_features(features, [evidences[i] for i in missing])
+        result = [known.get(key) if key is not None else None for key in keys]
+        new = {}
+        for i, values in zip(missing, evaluated):
+            result[i] = values
+            if keys[i] is not None:
+                new.setdefault(keys[i], values)
+        self.store(config, new)
+        return result
+
+    def lookup(self, config, keys):
+        """Returns a dict {key: values} with the cached values of the given
+        keys. Keys not cached are left out.
+        """
+        if not self.persistent:
+            memory = self._memory.get(config, {})
+            return dict((k, memory[k]) for k in keys if k in memory)
+        wanted = set(keys)
+        segment_ids = list(set(k[0] for k in wanted))
+        result = {}
+        if not segment_ids:
+            return result
+        cached = EvidenceFeatures.objects(config=config, segment__in=segment_ids)
+        for item in cached.only('segment', 'o1', 'o2', 'content', 'values'):
+            key = (item.segment, item.o1, item.o2, item.content)
+            if key in wanted:
+                result[key] = pickle.loads(item.values)
+        return result
+
+    def store(self, config, values):
+        """Stores a dict {key: values} for the given config hash."""
+        if not values:
+            return
+        if not self.persistent:
+            self._memory.setdefault(config, {}).update(values)
+            return
+        entries = [
+            EvidenceFeatures(segment=segment_id, o1=o1, o2=o2, content=content,
+                             config=config,
+                             values=pickle.dumps(v, protocol=2)).to_mongo()
+            for (segment_id, o1, o2, content), v in values.items()
+        ]
+        # Values stored meanwhile by another process are just as good
+        insert_ignoring_duplicates(EvidenceFeatures._get_collection(), entries)
+
+    def clear(self):
+        """Forgets every cached value"""
+        self._memory = {}
+        if self.persistent:
+            EvidenceFeatures.objects.delete()
+
+
+def offline_cache(cache):
+    """Returns `cache`, or an in-memory FeatureCache in place of a persistent
+    one, for running with no database connection.
+    """
+    if cache is not None and cache.persistent:
+        return FeatureCache(persistent=False)
+    return cache
+
+
+class SegmentFeatureEvaluator(object):
+    """Wraps a featureforge feature evaluator, evaluating segment features
+    once per segment.
+    """
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+
+    def fit(self, X, y=None):
+        self.evaluator.fit(X, y)
+        self.alive_features = self.evaluator.alive_features
+        return self
+
+    def fit_transform(self, X, y=None):
+        X = list(X)
+        return self.fit(X, y).transform(X)
+
+    def transform(self, X, y=None):
+        return evaluate_features(self.alive_features, X)
+
+
+class CachedFeatureEvaluator(SegmentFeatureEvaluator):
+    """Wraps a featureforge feature evaluator, taking the feature values from
+    a FeatureCache when available.
+    """
+
+    def __init__(self, evaluator, cache, features):
+        super(CachedFeatureEvaluator, self).__init__(evaluator)
+        self.cache = cache
+        self.config = features_hash(features)
+
+    def transform(self, X, y=None):
+        return self.cache.evaluate(self.config, self.alive_features, X)
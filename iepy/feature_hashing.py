@@ -0,0 +1,79 @@
+"""
+Vectorization of features with the hashing trick.
+
+featureforge's Vectorizer (and BatchVectorizer) learn a column for each
+value of every bag feature, so the vocabulary and the matrices grow with the
+training data. HashingVectorizer instead hashes each (feature, value) into a
+fixed number of columns, with a hashed sign so that collisions tend to
+cancel out. It needs no fit, keeps memory fixed no matter the size of the
+vocabulary, and every process hashes the same way, so evidence can be
+vectorized in parallel.
+
+Signed values can't be taken by MultinomialNB or ColumnFilter: with
+`non_negative` the columns get only non negative values.
+"""
+from featureforge.feature import make_feature
+from sklearn.feature_extraction import FeatureHasher
+
+from future.builtins import str
+
+from iepy.feature_cache import evaluate_features, feature_id, features_hash
+
+BUCKETS = 2 ** 20
+
+
+def _hasher(buckets, non_negative):
+    try:
+        return FeatureHasher(n_features=buckets, input_type='pair',
+                             non_negative=non_negative)
+    except TypeError:
+        # scikit-learn 0.21 replaced non_negative with alternate_sign
+        return FeatureHasher(n_features=buckets, input_type='pair',
+                             alternate_sign=not non_negative)
+
+
+class HashingVectorizer(object):
+    """Drop-in replacement of featureforge's Vectorizer that hashes the
+    feature values into `buckets` columns. If a FeatureCache is given, the
+    feature values are taken from it when available. Unless `non_negative`
+    is True, the columns may get negative values.
+    """
+
+    def __init__(self, features, buckets=BUCKETS, cache=None,
+                 non_negative=False):
+        features = list(features)
+        self.features = [make_feature(f) for f in features]
+        self.names = [feature_id(f) for f in features]
+        self.hasher = _hasher(buckets, non_negative)
+        self.cache = cache
+        self.config = features_hash(features)
+
+    def fit(self, X, y=None):
+        return self
+
+    def fit_transform(self, X, y=None):
+        return self.transform(X)
+
+    def transform(self, X, y=None):
+        X = list(X)
+        if self.cache is not None:
+            values = self.cache.evaluate(self.config, self.features, X)
+        else:
+            values = evaluate_features(self.features, X)
+        return self.hasher.transform(self._pairs(v) for v in values)
+
+    def _pairs(self, values):
+        """Returns the (string, value) pairs to hash for the tuple of
+        feature values of an evidence."""
+        pairs = []
+        for name, value in zip(self.names, values):
+            if isinstance(value, (bool, int, float)):
+                if value:
+                    pairs.append((name, float(value)))
+            elif isinstance(value, str):
+                pairs.append((u'%s=%s' % (name, value), 1.0))
+            else:
+                # A bag: every element counts once per occurrence
+                pairs.extend((u'%s=%s' % (name, element), 1.0)
+                             for element in value)
+        return pairs
@@ -0,0 +1,153 @@
+"""
+Precompiled gazetteers for the LiteralNER.
+
+Building a LiteralNER means reading and parsing every names file, and keeping
+the whole trie of names as Python objects on each process. A compiled
+gazetteer is the same trie flattened into arrays and written to a binary
+file, which is loaded with memory maps: loading is instant, and every process
+using the same file shares the same physical memory.
+
+The file (see iepy.array_file) has a small JSON header with the labels, and
+these arrays:
+
+    - tokens_start, tokens_bytes: the vocabulary, sorted by its utf-8
+      encoding, as written by iepy.array_file.StringsBuilder
+    - child_start: for each node, where its children start on the next two
+      arrays (plus a final item with the total of edges)
+    - child_token: for each edge, the vocabulary index of its token. The
+      children of each node are sorted by it.
+    - child_node: for each edge, the node it leads to
+    - node_label: for each node, the index of the label of the name ending
+      there, or -1
+
+The root is node 0.
+"""
+import numpy
+
+from iepy.array_file import (Strings, StringsBuilder, read_array_file,
+                              write_array_file)
+
+MAGIC = b'IEPYGAZ2'
+
+
+def compile_gazetteer(labels, src_filenames, path):
+    """Reads the names files (as LiteralNER does) and writes the compiled
+    gazetteer to path.
+    """
+    from iepy.literal_ner import LiteralNER  # Done here to avoid circular dependency
+    write_gazetteer(LiteralNER(labels, src_filenames).trie, path)
+
+
+def write_gazetteer(trie, path):
+    """Writes a trie of nested dicts, as the one of LiteralNER, as a
+    compiled gazetteer on path.
+    """
+    vocabulary = set()
+    labels = []
+    label_ids = {}
+    nodes = [trie]
+    i = 0
+    # Breadth first walk, numbering the nodes as they are found
+    while i < len(nodes):
+        for token, child in nodes[i].items():
+            if token is not None:
+                vocabulary.add(token)
+                nodes.append(child)
+        i += 1
+    vocabulary = sorted(vocabulary, key=lambda t: t.encode('utf8'))
+    token_ids = dict((t, j) for j, t in enumerate(vocabulary))
+
+    child_start = numpy.zeros(len(nodes) + 1, dtype=numpy.int64)
+    child_token = []
+    child_node = []
+    node_label = numpy.zeros(len(nodes), dtype=numpy.int32)
+    next_node = 1
+    for n, node in enumerate(nodes):
+        label = node.get(None)
+        if label is None:
+            node_label[n] = -1
+        else:
+            if label not in label_ids:
+                label_ids[label] = len(labels)
+                labels.append(label)
+            node_label[n] = label_ids[label]
+        # Children were numbered in the order of node.items() by the walk
+        children = []
+        for token, child in node.items():
+            if token is not None:
+                children.append((token_ids[token], next_node))
+                next_node += 1
+        children.sort()
+        child_token.extend(t for t, _ in children)
+        child_node.extend(c for _, c in children)
+        child_start[n + 1] = len(child_token)
+
+    tokens = StringsBuilder('tokens')
+    for token in vocabulary:
+        tokens.add(token)
+    arrays = tokens.arrays() + [
+        ('child_start', child_start),
+        ('child_token', numpy.array(child_token, dtype=numpy.int32)),
+        ('child_node', numpy.array(child_node, dtype=numpy.int32)),
+        ('node_label', node_label),
+    ]
+    write_array_file(path, MAGIC, {'labels': labels}, arrays)
+
+
+class Gazetteer(object):
+    """A compiled gazetteer, memory mapped from a file written by
+    compile_gazetteer. Finds the same entities than the LiteralNER it was
+    compiled from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header, arrays = read_array_file(path, MAGIC)
+        self.labels = header['labels']
+        self.tokens = Strings(arrays, 'tokens')
+        self.child_start = arrays['child_start']
+        self.child_token = arrays['child_token']
+        self.child_node = arrays['child_node']
+        self.node_label = arrays['node_label']
+
+    def __getstate__(self):
+        # Unpickled copies map the file again instead of copying the arrays
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def token_ids(self, sent):
+        """Array with the vocabulary index of each token of the sentence, or
+        -1 for tokens not in the vocabulary."""
+        return numpy.array([self.tokens.find(t) for t in sent], dtype=numpy.int64)
+
+    def child(self, node, token_id):
+        """Returns the child of node through token_id, or -1"""
+        start, end = self.child_start[node], self.child_start[node + 1]
+        k = start + numpy.searchsorted(self.child_token[start:end], token_id)
+        if k < end and self.child_token[k] == token_id:
+            return int(self.child_node[k])
+        return -1
+
+    def entities(self, sent):
+        """Same as LiteralNER.entities"""
+        ids = self.token_ids(sent)
+        result = []
+        i = 0
+        while i < len(sent):
+            node = 0
+            j = i
+            while j < len(sent) and ids[j] >= 0:
+                child = self.child(node, ids[j])
+                if child < 0:
+                    break
+                node = child
+                j += 1
+            label = self.node_label[node] if j > i else -1
+            if label >= 0:
+                result.append(((i, j), self.labels[label]))
+                i = j
+            else:
+                i += 1
+        return result
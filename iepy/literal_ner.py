@@ -2,7 +2,9 @@ import json
 import urllib
 import codecs
 
-from iepy.models import PreProcessSteps, Entity, EntityOccurrence
+from iepy.db import EntityRegistry
+from iepy.gazetteer import Gazetteer
+from iepy.models import PreProcessSteps, EntityOccurrence
 from iepy.preprocess import BasePreProcessStepRunner
 
 
@@ -19,24 +21,21 @@ class LiteralNER(object):
         self.labels = labels
         self.src_filenames = src_filenames
 
-        names = set()
-        names_map = {}
+        # Token level trie of the names: each node is a dict {token: node},
+        # and the label of the name ending on a node is kept on its None key.
+        self.trie = {}
+        vocabulary = {}  # So each different token is stored only once
         for label, filename in zip(labels, src_filenames):
             f = codecs.open(filename, encoding="utf8")
-            namelist = f.read().strip().split('\n')
-            names.update(namelist)
-            for name in namelist:
-                names_map[name] = label
-        self.names = frozenset(names)
-        self.names_map = names_map
-
-        # compute prefix closure
-        prefixes = set()
-        for name in self.names:
-            sname = name.split()
-            prefixes.update([' '.join(sname[:i]) for i in range(1, len(sname) + 1)])
-
-        self.prefixes = frozenset(prefixes)
+            for name in f.read().strip().split('\n'):
+                tokens = name.split()
+                node = self.trie
+                for token in tokens:
+                    token = vocabulary.setdefault(token, token)
+                    node = node.setdefault(token, {})
+                if tokens and ' '.join(tokens) == name:
+                    node[None] = label
+            f.close()
 
     def tag(self, sent):
         """Tagger with output a la Stanford (no start/end markers).
@@ -60,20 +59,22 @@ class LiteralNER(object):
 
     def entities(self, sent):
         """Return entities as a list of pairs ((offset, offset_end), label).
+
+        From each position the trie is followed as far as the sentence
+        allows, and there's an entity only if a name ends exactly there.
         """
         result = []
         i = 0
         while i < len(sent):
-            j = i + 1
-            prev_segment = segment = ' '.join(sent[i:j])
-            while segment in self.prefixes and j <= len(sent):
+            node = self.trie
+            j = i
+            while j < len(sent) and sent[j] in node:
+                node = node[sent[j]]
                 j += 1
-                prev_segment = segment
-                segment = ' '.join(sent[i:j])
-            if prev_segment in self.names:
-                label = self.names_map[prev_segment]
-                result.append(((i, j - 1), label))
-                i = j - 1
+            label = node.get(None) if j > i else None
+            if label is not None:
+                result.append(((i, j), label))
+                i = j
             else:
                 i += 1
 
@@ -83,9 +84,21 @@ class LiteralNER(object):
 class LiteralNERRunner(BasePreProcessStepRunner):
     step = PreProcessSteps.ner
 
-    def __init__(self, labels, src_filenames, override=False):
-        self.lit_tagger = LiteralNER(labels, src_filenames)
+    def __init__(self, labels, src_filenames, override=False, gazetteer=None,
+                 entities=None):
+        """If gazetteer is given, it's the path of a gazetteer compiled with
+        iepy.gazetteer.compile_gazetteer, used instead of reading the names
+        of src_filenames (and labels and src_filenames are ignored).
+
+        entities is the EntityRegistry used for finding or creating the
+        entities found. By default each runner has its own.
+        """
+        if gazetteer is not None:
+            self.lit_tagger = Gazetteer(gazetteer)
+        else:
+            self.lit_tagger = LiteralNER(labels, src_filenames)
         self.override = override
+        self.entities = entities if entities is not None else EntityRegistry()
 
     def __call__(self, doc):
         # this step does not requires PreProcessSteps.tagging:
@@ -94,7 +107,7 @@ class LiteralNERRunner(BasePreProcessStepRunner):
         if not self.override and doc.was_preprocess_done(PreProcessSteps.ner):
             return
 
-        entities = []
+        found = []  # (name, kind, offset, offset_end) of each occurrence
         sent_offset = 0
         for sent in doc.get_sentences():
             sent_entities = self.lit_tagger.entities(sent)
@@ -102,15 +115,17 @@ class LiteralNERRunner(BasePreProcessStepRunner):
             for ((i, j), label) in sent_entities:
                 name = ' '.join(sent[i:j])
                 kind = label.lower()  # XXX: should be in models.ENTITY_KINDS
-                entity, created = Entity.objects.get_or_create(key=name, kind=kind,
-                            defaults={'canonical_form': name})
-                entity_oc = EntityOccurrence(entity=entity,
-                                        offset=sent_offset + i,
-                                        offset_end=sent_offset + j)
-                entities.append(entity_oc)
+                found.append((name, kind, sent_offset + i, sent_offset + j))
 
             sent_offset += len(sent)
 
+        # All the entities of the document are resolved at once
+        resolved = self.entities.resolve(
+            [(name, kind, name) for name, kind, _, _ in found])
+        entities = [EntityOccurrence(entity=entity, offset=offset,
+                                     offset_end=offset_end)
+                    for entity, (_, _, offset, offset_end) in zip(resolved, found)]
+
         doc.set_preprocess_result(PreProcessSteps.ner, entities)
         doc.save()
 
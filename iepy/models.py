@@ -1,14 +1,40 @@
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 import itertools
 from os import environ
 import sys
 
 from enum import Enum
-from mongoengine import DynamicDocument, EmbeddedDocument, fields
+from mongoengine import Document, DynamicDocument, EmbeddedDocument, fields
+from pymongo.errors import DuplicateKeyError
 
 from iepy.utils import unzip
 
 
+# Number of text segments written at once by the document segmentation
+SEGMENTS_BATCH_SIZE = 1000
+
+
+def insert_ignoring_duplicates(collection, documents):
+    """Inserts the given raw documents on the collection with a single bulk
+    insert, skipping the ones that break a unique index (as happens when
+    they were inserted meanwhile by another process). Other errors are
+    raised. Returns True if some document was skipped.
+
+    All the documents are tried even after an error, but only the error of
+    the last failed one is reported, so that's the one checked.
+    """
+    documents = list(documents)
+    if not documents:
+        return False
+    try:
+        collection.insert(documents, continue_on_error=True)
+    except DuplicateKeyError:
+        return True
+    return False
+
+
 class PreProcessSteps(Enum):
     tokenization = 1
     sentencer = 2
@@ -154,18 +180,11 @@ class EntityOccurrence(EmbeddedDocument):
     def __unicode__(self):
         return u'{0} ({1}, {2})'.format(self.entity, self.offset, self.offset_end)
 
-    @classmethod
-    def build(cls, key, kind, alias, offset, offset_end):
-        entity, created = Entity.objects.get_or_create(
-            key=key,
-            kind=kind,
-            defaults={'canonical_form': alias})
-        self = cls(
-            entity=entity,
-            offset=offset,
-            offset_end=offset_end,
-            alias=alias)
-        return self
+
+def kind_pair(kind_a, kind_b):
+    """Name of the unordered pair of entity kinds, as stored on
+    TextSegment.kind_pairs"""
+    return u'|'.join(sorted([kind_a, kind_b]))
 
 
 class EntityInSegment(EmbeddedDocument):
@@ -187,21 +206,50 @@ class TextSegment(DynamicDocument, SortableDocumentMixin):
     document = fields.ReferenceField('IEDocument', required=True)
     text = fields.StringField(required=True)
     offset = fields.IntField()  # Offset in tokens wrt document
+    offset_end = fields.IntField()  # End offset in tokens wrt document
 
     # The following lists have the same length, correspond 1-to-1
     tokens = fields.ListField(fields.StringField())
     postags = fields.ListField(fields.StringField())
 
+    # If True tokens and postags are not stored, they are taken from the
+    # packed ids of the document (see iepy.vocabulary)
+    compact = fields.BooleanField(default=False)
+
     entities = fields.ListField(fields.EmbeddedDocumentField(EntityInSegment))
 
     # offsets of sentence starts in this segment; relative to start of segment
     sentences = fields.ListField(fields.IntField())
 
+    # kind_pair of each pair of entity occurrences, so segments can be found
+    # by kinds with an indexed query
+    kind_pairs = fields.ListField(fields.StringField())
+
+    meta = {'indexes': ['kind_pairs']}
+
     def __unicode__(self):
         return u'{0}'.format(' '.join(self.tokens))
 
+    def update_kind_pairs(self):
+        counts = Counter(e.kind for e in self.entities)
+        pairs = [kind_pair(a, b) for a, b in itertools.combinations(sorted(counts), 2)]
+        pairs.extend(kind_pair(k, k) for k, n in counts.items() if n > 1)
+        self.kind_pairs = sorted(pairs)
+
+    def save(self, *args, **kwargs):
+        self.update_kind_pairs()
+        # Only new segments and the ones with changed entities are indexed
+        # again
+        reindex = self.id is None or any(
+            f.split('.')[0] == 'entities' for f in self._get_changed_fields())
+        result = super(TextSegment, self).save(*args, **kwargs)
+        if reindex:
+            EntityPairIndex.remove_segments([self.id])
+            EntityPairIndex.add_segments([self])
+        return result
+
     @classmethod
-    def build(cls, document, token_offset, token_offset_end):
+    def build(cls, document, token_offset, token_offset_end, compact=False):
         """
         Build a segment based in the given documents, using the tokens in the
         range [token_offset:token_offset_end] (note that this has the usual
@@ -209,12 +257,18 @@ class TextSegment(DynamicDocument, SortableDocumentMixin):
 
         use the given text as reference (it should be a human readable
         representation of the segment
+
+        If compact is True tokens and postags are not copied, and the document
+        must have its token_ids and postag_ids.
         """
         self = cls()
         self.document = document
         self.offset = token_offset
-        self.tokens = document.tokens[token_offset:token_offset_end]
-        self.postags = document.postags[token_offset:token_offset_end]
+        self.offset_end = token_offset_end
+        self.compact = compact
+        if not compact:
+            self.tokens = document.tokens[token_offset:token_offset_end]
+            self.postags = document.postags[token_offset:token_offset_end]
         if token_offset < len(document.offsets):
             text_start = document.offsets[token_offset]
         else:
@@ -241,6 +295,7 @@ class TextSegment(DynamicDocument, SortableDocumentMixin):
                 alias=o.alias,
             ))
         self.entities = entities
+        self.update_kind_pairs()
         # Find sentences
         l, r = _interval_offsets(document.sentences, token_offset, token_offset_end)
         self.sentences = [o - token_offset for o in document.sentences[l:r]]
@@ -257,6 +312,136 @@ class TextSegment(DynamicDocument, SortableDocumentMixin):
         return [(l, r) for l, r in itertools.product(left, right) if l != r]
 
 
+class EntityPairIndex(Document):
+    """A segment where a pair of entities occur together, one document per
+    pair and segment. Pairs are unordered: (kind_a, key_a) is never bigger
+    than (kind_b, key_b). Kept up to date as segments are saved or inserted.
+    """
+    kind_a = fields.StringField(required=True)
+    key_a = fields.StringField(required=True)
+    kind_b = fields.StringField(required=True)
+    key_b = fields.StringField(required=True)
+    segment = fields.ObjectIdField(required=True)
+    meta = {
+        'collection': 'entity_pair_index',
+        'indexes': [
+            {'fields': ['kind_a', 'key_a', 'kind_b', 'key_b', 'segment'],
+             'unique': True},
+            'segment',
+        ],
+    }
+
+    @staticmethod
+    def pair_query(a, b):
+        """Raw query of the pair of (kind, key) a and b"""
+        a, b = sorted([a, b])
+        return {'kind_a': a[0], 'key_a': a[1], 'kind_b': b[0], 'key_b': b[1]}
+
+    @classmethod
+    def segment_pairs(cls, segment):
+        """Set of the unordered pairs of (kind, key) of the entities of the
+        segment. An entity is paired with itself if it occurs twice."""
+        counts = {}
+        for e in segment.entities:
+            k = (e.kind, e.key)
+            counts[k] = counts.get(k, 0) + 1
+        pairs = set(itertools.combinations(sorted(counts), 2))
+        pairs.update((k, k) for k, n in counts.items() if n > 1)
+        return pairs
+
+    @classmethod
+    def add_segments(cls, segments):
+        """Indexes the entity pairs of the given saved segments, with a
+        single bulk insert. Pairs already indexed are skipped."""
+        entries = []
+        for segment in segments:
+            for a, b in cls.segment_pairs(segment):
+                entry = cls.pair_query(a, b)
+                entry['segment'] = segment.id
+                entries.append(entry)
+        insert_ignoring_duplicates(cls._get_collection(), entries)
+
+    @classmethod
+    def remove_segments(cls, segment_ids):
+        segment_ids = list(segment_ids)
+        if segment_ids:
+            cls._get_collection().remove({'segment': {'$in': segment_ids}})
+
+
+class VocabularyEntry(Document):
+    """A string of a vocabulary, and its id (see iepy.vocabulary)"""
+    vocabulary = fields.StringField(required=True)
+    value = fields.StringField(required=True)
+    index = fields.IntField(required=True)
+    meta = {
+        'collection': 'vocabulary',
+        'indexes': [
+            {'fields': ['vocabulary', 'value'], 'unique': True},
+            {'fields': ['vocabulary', 'index'], 'unique': True},
+        ],
+    }
+
+
+class PackedStringListField(fields.ListField):
+    """List of strings that, when empty, is read from the vocabulary ids
+    packed on the `ids_field` of the document (see iepy.vocabulary), so
+    documents with packed ids don't need to store the strings. Strings set
+    on a document with packed ids are packed too, replacing the old ids.
+    """
+
+    def __init__(self, vocabulary_name, ids_field, **kwargs):
+        self.vocabulary_name = vocabulary_name
+        self.ids_field = ids_field
+        super(PackedStringListField, self).__init__(fields.StringField(), **kwargs)
+
+    def __set__(self, instance, value):
+        # Not while loading the document, only on later changes (like
+        # rerunning a preprocess step) that would leave the ids stale
+        if value and instance._initialised and instance._data.get(self.ids_field):
+            from iepy import vocabulary  # Done here to avoid circular dependency
+            ids = getattr(vocabulary, self.vocabulary_name).ids(value)
+            setattr(instance, self.ids_field, vocabulary.pack_ids(ids))
+            value = []
+        super(PackedStringListField, self).__set__(instance, value)
+
+    def __get__(self, instance, owner):
+        value = super(PackedStringListField, self).__get__(instance, owner)
+        if instance is None or value:
+            return value
+        packed = instance._data.get(self.ids_field)
+        if not packed:
+            return value
+        # Unpacked once per packed ids, and kept out of _data so they are
+        # not taken as changes to be saved
+        unpacked = getattr(instance, '_unpacked', None)
+        if unpacked is None:
+            unpacked = instance._unpacked = {}
+        cached = unpacked.get(self.name)
+        if cached is None or cached[0] is not packed:
+            from iepy import vocabulary  # Done here to avoid circular dependency
+            ids = vocabulary.unpack_ids(packed).tolist()
+            values = getattr(vocabulary, self.vocabulary_name).values(ids)
+            cached = unpacked[self.name] = (packed, values)
+        return cached[1]
+
+
+class EvidenceFeatures(Document):
+    """Feature values evaluated for an occurrence pair of a segment, stored
+    so they don't need to be computed again (see iepy.feature_cache).
+    """
+    segment = fields.ObjectIdField(required=True)
+    o1 = fields.IntField(required=True)
+    o2 = fields.IntField(required=True)
+    # Digest of the segment content (see iepy.feature_cache.segment_digest)
+    content = fields.StringField(required=True)
+    # Hash of the feature configuration used for computing the values
+    config = fields.StringField(required=True)
+    values = fields.BinaryField()  # pickled tuple of feature values
+    meta = {'indexes': [
+        {'fields': ('config', 'segment', 'o1', 'o2', 'content'), 'unique': True},
+    ]}
+
+
 class IEDocument(DynamicDocument, SortableDocumentMixin):
     human_identifier = fields.StringField(required=True, unique=True)
     title = fields.StringField()
@@ -269,10 +454,15 @@ class IEDocument(DynamicDocument, SortableDocumentMixin):
     # Fields and stuff that is computed while traveling the pre-process pipeline
     preprocess_metadata = fields.DictField()
 
-    # The following 3 lists have 1 item per token
-    tokens = fields.ListField(fields.StringField())
+    # The following 3 lists have 1 item per token. tokens and postags are not
+    # stored when the document has them as token_ids and postag_ids.
+    tokens = PackedStringListField('tokens', 'token_ids')
     offsets = fields.ListField(fields.IntField())  # character offset for tokens
-    postags = fields.ListField(fields.StringField())
+    postags = PackedStringListField('postags', 'postag_ids')
+    # tokens and postags as vocabulary ids packed by iepy.vocabulary.pack_ids,
+    # only set when the document has compact segments
+    token_ids = fields.BinaryField()
+    postag_ids = fields.BinaryField()
 
     sentences = fields.ListField(fields.IntField())  # it's a list of token-offsets
     # Occurrences of entites, sorted by offset
@@ -287,6 +477,29 @@ class IEDocument(DynamicDocument, SortableDocumentMixin):
         PreProcessSteps.ner: 'entities',
     }
 
+    def save(self, *args, **kwargs):
+        if getattr(self, '_postponing_saves', False):
+            self._save_pending = True
+            return self
+        return super(IEDocument, self).save(*args, **kwargs)
+
+    @contextmanager
+    def postponed_saves(self):
+        """Inside this context calls to save are postponed: the document is
+        saved only once, when leaving the context (and only if some save was
+        requested and no error was raised). As with any save of an existing
+        document, only the changed fields are written.
+        """
+        self._postponing_saves = True
+        self._save_pending = False
+        try:
+            yield self
+        finally:
+            self._postponing_saves = False
+        if self._save_pending:
+            self._save_pending = False
+            self.save()
+
     def flag_preprocess_done(self, step):
         """Adds an internal mark for knowing that the given step was done.
         Explicit "save" shall be called after this call.
@@ -366,9 +579,21 @@ class IEDocument(DynamicDocument, SortableDocumentMixin):
 
     def clear_segments(self):
         """Remove all existing segments"""
-        TextSegment.objects.filter(document=self).delete()
+        segments = TextSegment.objects.filter(document=self)
+        ids = list(segments.scalar('id'))
+        EntityPairIndex.remove_segments(ids)
+        EvidenceFeatures.objects(segment__in=ids).delete()
+        segments.delete()
+
+    def build_syntactic_segments(self, batch_size=SEGMENTS_BATCH_SIZE, compact=False):
+        """
+        Build a text segment for each sentence with at least 2 entities.
+        Segments are inserted with a bulk insert every `batch_size` segments.
+        See TextSegment.build for the meaning of compact.
+        """
+        self._insert_segments(self._syntactic_segments(compact), batch_size)
 
-    def build_syntactic_segments(self):
+    def _syntactic_segments(self, compact):
         entity = 0
         L = len(self.sentences)
         for i, start in enumerate(self.sentences):
@@ -390,10 +615,9 @@ class IEDocument(DynamicDocument, SortableDocumentMixin):
                     break
                 n += 1
             if n >= 2:
-                s = TextSegment.build(self, start, end)
-                s.save()
+                yield TextSegment.build(self, start, end, compact)
 
-    def build_contextual_segments(self, d):
+    def build_contextual_segments(self, d, batch_size=SEGMENTS_BATCH_SIZE, compact=False):
         """
         Build all contextual text segments in a contextual way. A context is a
         contiguous piece of the document with at least 2 tokens separated by
@@ -406,7 +630,13 @@ class IEDocument(DynamicDocument, SortableDocumentMixin):
         - If no entities are found around the "center" entity, ignore this segment
         - multi-token entities should always be captured together
         - if two segments overlap, keep the larger one
+
+        Segments are inserted with a bulk insert every `batch_size` segments.
+        See TextSegment.build for the meaning of compact.
         """
+        self._insert_segments(self._contextual_segments(d, compact), batch_size)
+
+    def _contextual_segments(self, d, compact):
         L = len(self.entities)
         i = 0
         lstart, lend = -1, -1
@@ -438,7 +668,26 @@ class IEDocument(DynamicDocument, SortableDocumentMixin):
                 j += 1
             if not (end == lend and start >= lstart):
                 # Not a repeat
-                s = TextSegment.build(self, start, end)
-                s.save()
+                yield TextSegment.build(self, start, end, compact)
             lstart, lend = start, end
             i += 1
+
+    def _insert_segments(self, segments, batch_size):
+        batch = []
+        for s in segments:
+            s.validate()
+            batch.append(s)
+            if len(batch) >= batch_size:
+                self._insert_batch(batch)
+                batch = []
+        if batch:
+            self._insert_batch(batch)
+
+    @staticmethod
+    def _insert_batch(segments):
+        ids = TextSegment.objects.insert(segments, load_bulk=False)
+        # Older mongoengine versions don't set the ids on the documents, and
+        # the pair index needs them
+        for segment, segment_id in zip(segments, ids):
+            segment.id = segment_id
+        EntityPairIndex.add_segments(segments)
@@ -6,8 +6,10 @@ import logging
 from nltk.tag.stanford import NERTagger
 import wget
 
+from iepy.db import EntityRegistry
 from iepy.models import PreProcessSteps, EntityOccurrence
-from iepy.preprocess import BasePreProcessStepRunner
+from iepy.preprocess import BaseBatchedPreProcessStepRunner, tag_in_batches
+from iepy.stanford_server import ner_server
 from iepy.utils import DIRS, unzip_file
 
 logger = logging.getLogger(__name__)
@@ -24,34 +26,52 @@ class NonTokenizingNERTagger(NERTagger):
         return old
 
 
-class NERRunner(BasePreProcessStepRunner):
+class NERRunner(BaseBatchedPreProcessStepRunner):
     """Wrapper to insert a generic callable sentence NER tagger into the pipeline.
+
+    When processing many documents, their sentences are given to the NER
+    together, up to max_batch_sentences sentences or max_batch_tokens tokens
+    per call.
     """
     step = PreProcessSteps.ner
+    max_batch_sentences = 1000
+    max_batch_tokens = 25000
 
-    def __init__(self, ner, override=False):
+    def __init__(self, ner, override=False, entities=None):
+        """entities is the EntityRegistry used for finding or creating the
+        entities found. By default each runner has its own."""
         self.override = override
         self.ner = ner
+        self.entities = entities if entities is not None else EntityRegistry()
 
-    def __call__(self, doc):
+    def must_process(self, doc):
         # this step does not necessarily requires PreProcessSteps.tagging:
         if not doc.was_preprocess_done(PreProcessSteps.sentencer):
-            return
-        if not self.override and doc.was_preprocess_done(PreProcessSteps.ner):
-            return
+            return False
+        return self.override or not doc.was_preprocess_done(PreProcessSteps.ner)
 
-        entities = self.execute(doc)
+    def process_documents(self, docs):
+        for doc, ner_sentences in tag_in_batches(docs, self.ner, self.must_process,
+                                                 self.max_batch_sentences,
+                                                 self.max_batch_tokens):
+            if ner_sentences is not None:
+                entities = self.build_entities(doc, ner_sentences)
 
-        doc.set_preprocess_result(PreProcessSteps.ner, entities)
-        doc.save()
-        logger.debug("NER tagged a document")
+                doc.set_preprocess_result(PreProcessSteps.ner, entities)
+                doc.save()
+                logger.debug("NER tagged a document")
+            yield doc
 
     def execute(self, doc):
-        entities = []
         # Apply the ner algorithm which takes a list of sentences and returns
         # a list of sentences, each being a list of NER-tokens, each of which is
         # a pairs (tokenstring, class)
-        ner_sentences = self.ner(doc.get_sentences())
+        return self.build_entities(doc, self.ner(doc.get_sentences()))
+
+    def build_entities(self, doc, ner_sentences):
+        """Returns the entity occurrences of the document, given the
+        NER-tagged sentences of it"""
+        found = []  # (name, kind, offset, offset_end) of each occurrence
         # Flatten the nested list above into just a list of kinds
         ner_kinds = (k for s in ner_sentences for (_, k) in s)
 
@@ -77,7 +97,7 @@ class NERRunner(BasePreProcessStepRunner):
                 if last_kind != 'O':
                     # Found a new entity in offset:i
                     name = ' '.join(doc.tokens[offset:i])
-                    entities.append(EntityOccurrence.build(name, last_kind.lower(), name, offset, i))
+                    found.append((name, last_kind.lower(), offset, i))
                 # Restart offset counter at each change of entity type
                 offset = i
             last_kind = kind
@@ -90,23 +110,33 @@ class NERRunner(BasePreProcessStepRunner):
             # Actually the stop iteration is the expected result here
             pass
 
-        return entities
+        entities = self.entities.resolve(
+            [(name, kind, name) for name, kind, _, _ in found])
+        return [EntityOccurrence(entity=entity, offset=offset,
+                                 offset_end=offset_end, alias=name)
+                for entity, (name, _, offset, offset_end) in zip(entities, found)]
 
 
 class StanfordNERRunner(NERRunner):
 
-    def __init__(self, override=False):
+    def __init__(self, override=False, persistent=False):
+        """If persistent is True, the NER runs as a server started once,
+        instead of a new Java process for each document (see
+        iepy.stanford_server). The preprocess script of new applications
+        turns it on."""
         ner_path = os.path.join(DIRS.user_data_dir, stanford_ner_name)
         if not os.path.exists(ner_path):
             raise LookupError("Stanford NER not found. Try running the "
                               "command download_third_party_data.py")
 
-        ner = NonTokenizingNERTagger(
-            os.path.join(ner_path, 'classifiers', 'english.all.3class.distsim.crf.ser.gz'),
-            os.path.join(ner_path, 'stanford-ner.jar'),
-            encoding='utf8')
+        classifier = os.path.join(ner_path, 'classifiers', 'english.all.3class.distsim.crf.ser.gz')
+        jar = os.path.join(ner_path, 'stanford-ner.jar')
+        if persistent:
+            ner = ner_server(classifier, jar)
+        else:
+            ner = NonTokenizingNERTagger(classifier, jar, encoding='utf8').batch_tag
 
-        super(StanfordNERRunner, self).__init__(ner.batch_tag, override)
+        super(StanfordNERRunner, self).__init__(ner, override)
 
 
 def download():
@@ -1,4 +1,11 @@
 import logging
+import multiprocessing
+import pickle
+
+from mongoengine.connection import disconnect, get_db
+
+from iepy import db
+from iepy.utils import chunks
 
 logger = logging.getLogger(__name__)
 
@@ -6,15 +13,23 @@ logger = logging.getLogger(__name__)
 class PreProcessPipeline(object):
     """Coordinates the pre-processing tasks on a set of documents"""
 
-    def __init__(self, step_runners, documents_manager):
+    # Number of documents handed out at once to each worker process
+    chunk_size = 10
+
+    def __init__(self, step_runners, documents_manager, processes=1):
         """Takes a list of callables and a documents-manager.
 
             Step Runners may be any callable. It they have an attribute step,
             then that runner will be treated as the responsible for
             accomplishing such a PreProcessStep.
+
+            If processes is more than 1, each step is run on a pool of that
+            many worker processes, each one with its own database connection
+            and its own copy of the runner (so runners must be picklable).
         """
         self.step_runners = step_runners
         self.documents = documents_manager
+        self.processes = processes
 
     def walk_document(self, doc):
         """Computes all the missing pre-process steps for the given document"""
@@ -23,21 +38,140 @@ class PreProcessPipeline(object):
         return
 
     def process_step_in_batch(self, runner):
-        """Tries to apply the required step to all documents lacking it"""
+        """Tries to apply the required step to all documents lacking it.
+
+        Returns the list of (document id, error) of the failed documents.
+        When running on parallel, a failure on a document doesn't stop the
+        step: it's logged and added to that list. Otherwise the error is
+        raised, so the list is always empty.
+        """
         logger.info('Starting preprocessing step %s', runner)
+        if self.processes > 1:
+            return self._process_step_in_parallel(runner)
         if hasattr(runner, 'step'):
             docs = self.documents.get_documents_lacking_preprocess(runner.step)
         else:
             docs = self.documents  # everything
-        for i, doc in enumerate(docs):
-            runner(doc)
+        if isinstance(runner, BaseBatchedPreProcessStepRunner):
+            done = runner.process_documents(docs)
+        else:
+            done = (runner(doc) for doc in docs)
+        for i, _ in enumerate(done):
             logger.info('\tDone for %i documents', i + 1)
+        return []
 
     def process_everything(self):
         """Tries to apply all the steps to all documents"""
         for runner in self.step_runners:
             self.process_step_in_batch(runner)
 
+    def process_streaming(self):
+        """Tries to apply all the steps to all documents, in a single pass:
+        each document is read once, walked through all the step runners, and
+        saved once at the end (with only the fields that changed), instead of
+        once per step.
+
+        Failures are handled as in process_step_in_batch.
+        """
+        logger.info('Starting streaming preprocessing')
+        walker = DocumentWalker(self.step_runners)
+        steps = [getattr(r, 'step', None) for r in self.step_runners]
+        # Runners without a step, or overriding it, want every document
+        walk_all = None in steps or any(getattr(r, 'override', False)
+                                        for r in self.step_runners)
+        if self.processes > 1:
+            if walk_all:
+                ids = self.documents.get_document_ids()
+            else:
+                ids = self.documents.get_document_ids_lacking_any_preprocess(steps)
+            return self._process_in_parallel(walker, ids)
+        if walk_all:
+            docs = self.documents
+        else:
+            docs = self.documents.get_documents_lacking_any_preprocess(steps)
+        for i, doc in enumerate(docs):
+            walker(doc)
+            logger.info('\tDone for %i documents', i + 1)
+        return []
+
+    def _process_step_in_parallel(self, runner):
+        if hasattr(runner, 'step'):
+            ids = self.documents.get_document_ids_lacking_preprocess(runner.step)
+        else:
+            ids = self.documents.get_document_ids()
+        return self._process_in_parallel(runner, ids)
+
+    def _process_in_parallel(self, runner, ids):
+        pool = multiprocessing.Pool(
+            self.processes, _init_worker,
+            (get_db().name, pickle.dumps(runner, protocol=2))
+        )
+        failures = []
+        i = 0
+        try:
+            # imap gives the results in order, so progress is reported in order
+            for results in pool.imap(_process_documents, chunks(ids, self.chunk_size)):
+                for doc_id, error in results:
+                    i += 1
+                    if error is not None:
+                        logger.error('\tFailed on document %s: %s', doc_id, error)
+                        failures.append((doc_id, error))
+                logger.info('\tDone for %i documents', i)
+        finally:
+            pool.close()
+            pool.join()
+        return failures
+
+
+class DocumentWalker(object):
+    """Applies all the step runners to a document, and saves it only once
+    at the end. Saves done by the runners themselves are postponed until
+    all of them are done.
+    """
+
+    def __init__(self, step_runners):
+        self.step_runners = step_runners
+
+    def __call__(self, doc):
+        with doc.postponed_saves():
+            for step in self.step_runners:
+                step(doc)
+
+
+# State of the worker processes, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(db_name, pickled_runner):
+    # A connection can't be shared with the parent process
+    disconnect()
+    _worker['documents'] = db.connect(db_name).documents
+    _worker['runner'] = pickle.loads(pickled_runner)
+
+
+def _process_documents(ids):
+    """
+    Runs on a worker process. Applies the runner to the documents of the
+    given ids, returning a list of (document id, error) in the same order,
+    where error is None if the document was processed fine.
+    """
+    runner = _worker['runner']
+    docs = _worker['documents'].documents_by_id(ids)
+    results = []
+    for doc_id in ids:
+        doc = docs.get(doc_id)
+        if doc is None:
+            results.append((doc_id, 'Document not found'))
+            continue
+        try:
+            runner(doc)
+        except Exception as error:
+            logger.exception('Failed preprocessing document %s', doc_id)
+            results.append((doc_id, '%s: %s' % (type(error).__name__, error)))
+        else:
+            results.append((doc_id, None))
+    return results
+
 
 class BasePreProcessStepRunner(object):
     # If it's for a particular step, you can write
@@ -55,3 +189,62 @@ class BasePreProcessStepRunner(object):
         #    - skip
         #    - re-do step.
         raise NotImplementedError
+
+
+class BaseBatchedPreProcessStepRunner(BasePreProcessStepRunner):
+    """A step runner that's more efficient when processing many documents
+    at once (for example, because it calls an external tool with a high cost
+    per call). When running a step in batch the pipeline gives it all the
+    documents at once.
+    """
+
+    def __call__(self, doc):
+        for _ in self.process_documents([doc]):
+            pass
+
+    def process_documents(self, docs):
+        # Must process the given iterable of documents, yielding each one of
+        # them (in any order) once it's done.
+        raise NotImplementedError
+
+
+def tag_in_batches(docs, tagger, wanted, max_sentences, max_tokens):
+    """Tags the sentences of many documents with few calls to tagger: the
+    sentences of several documents are given together, up to max_sentences
+    sentences or max_tokens tokens per call (but never splitting a document).
+
+    Yields pairs (document, tagged sentences) in the same order of docs. The
+    documents for which wanted(doc) is False are not tagged, and yielded with
+    None.
+    """
+    pending = []  # pairs (document, number of sentences, or None)
+    sentences = []
+    tokens = 0
+    for doc in docs:
+        if not wanted(doc):
+            pending.append((doc, None))
+            continue
+        doc_sentences = list(doc.get_sentences())
+        pending.append((doc, len(doc_sentences)))
+        sentences.extend(doc_sentences)
+        tokens += sum(len(s) for s in doc_sentences)
+        if len(sentences) >= max_sentences or tokens >= max_tokens:
+            for result in _split_tagged(pending, tagger, sentences):
+                yield result
+            pending, sentences, tokens = [], [], 0
+    for result in _split_tagged(pending, tagger, sentences):
+        yield result
+
+
+def _split_tagged(pending, tagger, sentences):
+    tagged = list(tagger(sentences)) if sentences else []
+    if len(tagged) != len(sentences):
+        raise ValueError('Tagger returned %i sentences instead of %i' %
+                         (len(tagged), len(sentences)))
+    start = 0
+    for doc, n in pending:
+        if n is None:
+            yield doc, None
+        else:
+            yield doc, tagged[start:start + n]
+            start += n
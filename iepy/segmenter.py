@@ -1,13 +1,26 @@
-from iepy.models import PreProcessSteps
+from iepy.models import PreProcessSteps, SEGMENTS_BATCH_SIZE
 from iepy.preprocess import BasePreProcessStepRunner
+from iepy import vocabulary
+
+
+def store_token_ids(doc):
+    """Stores on the document its tokens and postags as vocabulary ids, as
+    needed by compact segments. The lists of strings are not stored anymore,
+    they are read back from the ids."""
+    doc.token_ids = vocabulary.pack_ids(vocabulary.tokens.ids(doc.tokens))
+    doc.postag_ids = vocabulary.pack_ids(vocabulary.postags.ids(doc.postags))
+    doc.tokens = []
+    doc.postags = []
 
 
 class SyntacticSegmenterRunner(BasePreProcessStepRunner):
 
     step = PreProcessSteps.segmentation
 
-    def __init__(self, override=False):
+    def __init__(self, override=False, batch_size=SEGMENTS_BATCH_SIZE, compact=False):
         self.override = override
+        self.batch_size = batch_size
+        self.compact = compact
 
     def __call__(self, doc):
         if not doc.was_preprocess_done(PreProcessSteps.ner) or not doc.was_preprocess_done(PreProcessSteps.sentencer):
@@ -15,7 +28,9 @@ class SyntacticSegmenterRunner(BasePreProcessStepRunner):
         if self.override or not doc.was_preprocess_done(self.step):
             assert all(doc.entities[i].offset <= doc.entities[i + 1].offset for i in range(len(doc.entities) - 1))
             doc.clear_segments()
-            doc.build_syntactic_segments()
+            if self.compact:
+                store_token_ids(doc)
+            doc.build_syntactic_segments(self.batch_size, self.compact)
             doc.flag_preprocess_done(self.step)
             doc.save()
 
@@ -24,15 +39,20 @@ class ContextualSegmenterRunner(BasePreProcessStepRunner):
 
     step = PreProcessSteps.segmentation
 
-    def __init__(self, distance, override=False):
+    def __init__(self, distance, override=False, batch_size=SEGMENTS_BATCH_SIZE,
+                 compact=False):
         self.distance = distance
         self.override = override
+        self.batch_size = batch_size
+        self.compact = compact
 
     def __call__(self, doc):
         if not doc.was_preprocess_done(PreProcessSteps.ner):
             return
         if self.override or not doc.was_preprocess_done(self.step):
             doc.clear_segments()
-            doc.build_contextual_segments(self.distance)
+            if self.compact:
+                store_token_ids(doc)
+            doc.build_contextual_segments(self.distance, self.batch_size, self.compact)
             doc.flag_preprocess_done(self.step)
             doc.save()
@@ -0,0 +1,412 @@
+"""
+Memory mapped snapshots of a preprocessed corpus.
+
+Every stage of the bootstrap reads segments from MongoDB. A snapshot is a
+read-only copy of the text segments of the corpus (and of the entities and
+documents they refer to) in a local file of flat arrays (see
+iepy.array_file): token and POS ids with their vocabularies, offsets, entity
+occurrences and an index of segments by pair of kinds. It's loaded instantly
+with memory maps, and worker processes share its pages.
+
+SnapshotSegmentManager reads a snapshot with the same interface of
+db.TextSegmentManager, so extraction and cross-validation can run with no
+database at all:
+
+    export_snapshot('corpus.snapshot')  # connected to the database
+    ...
+    connection = snapshot.connect('corpus.snapshot')  # no database needed
+    pipeline = BootstrappedIEPipeline(connection, seeds)
+"""
+from array import array
+import itertools
+import logging
+
+from bson.objectid import ObjectId
+import numpy
+
+from iepy import db
+from iepy.array_file import (Strings, StringsBuilder, read_array_file,
+                              write_array_file)
+from iepy.models import (
+    Entity, EntityInSegment, IEDocument, TextSegment, kind_pair)
+from iepy.utils import ValueTable, chunks
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'IEPYSNP1'
+_NO_ID = ObjectId(b'\0' * 12)  # Id of the entities not found on the database
+
+
+def _object_ids(ids):
+    return numpy.frombuffer(b''.join(i.binary for i in ids), dtype=numpy.uint8)
+
+
+def _strings(name, table):
+    """StringsBuilder with the values of a ValueTable, so their ids are kept"""
+    strings = StringsBuilder(name)
+    for value in table.values:
+        strings.add(value)
+    return strings
+
+
+def _starts(counts):
+    result = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+    result[1:] = numpy.cumsum(numpy.asarray(counts, dtype=numpy.int64))
+    return result
+
+
+def write_snapshot(path, segments, entities=db.get_entities,
+                   document_identifiers=None):
+    """
+    Writes a snapshot of the given saved segments (complete, and expanded if
+    compact) on path. entities is a function like db.get_entities, used for
+    finding the entities of the segment occurrences. document_identifiers is
+    a function that takes document ids and returns a dict {id: human
+    identifier}, by default taken from the database.
+    """
+    if document_identifiers is None:
+        document_identifiers = _document_identifiers
+    segment_ids, segment_documents, offsets = [], [], array('q')
+    texts = StringsBuilder('text')
+    tokens, postags = ValueTable(), ValueTable()
+    token_ids, postag_ids, token_counts = array('I'), array('I'), array('q')
+    sentences, sentence_counts = array('i'), array('q')
+    occurrence_counts = array('q')
+    occurrence_entity, occurrence_offset, occurrence_offset_end = array('i'), array('i'), array('i')
+    aliases = ValueTable()
+    occurrence_alias = array('i')
+    entity_index = {}
+    documents = {}
+    kind_pairs = {}
+    for n, segment in enumerate(segments):
+        segment_ids.append(segment.id)
+        document = segment._data['document']
+        document = getattr(document, 'id', document) or _NO_ID
+        segment_documents.append(documents.setdefault(document, len(documents)))
+        offsets.append(segment.offset or 0)
+        texts.add(segment.text or u'')
+        token_ids.extend(tokens.id_of(t) for t in segment.tokens)
+        postag_ids.extend(postags.id_of(p) for p in segment.postags)
+        token_counts.append(len(segment.tokens))
+        sentences.extend(segment.sentences)
+        sentence_counts.append(len(segment.sentences))
+        occurrence_counts.append(len(segment.entities))
+        for e in segment.entities:
+            k = (e.kind, e.key)
+            if k not in entity_index:
+                entity_index[k] = (len(entity_index), e.canonical_form)
+            occurrence_entity.append(entity_index[k][0])
+            occurrence_offset.append(e.offset)
+            occurrence_offset_end.append(e.offset_end)
+            occurrence_alias.append(-1 if e.alias is None else aliases.id_of(e.alias))
+        segment.update_kind_pairs()
+        for pair in segment.kind_pairs:
+            kind_pairs.setdefault(pair, []).append(n)
+        if (n + 1) % 10000 == 0:
+            logger.info('%i segments read', n + 1)
+
+    # Entities, with the ids they have on the database (if any)
+    entity_keys = sorted(entity_index, key=lambda k: entity_index[k][0])
+    kinds = sorted(set(kind for kind, _ in entity_keys))
+    keys, canonical_forms = StringsBuilder('entity_key'), StringsBuilder('canonical_form')
+    found = {}
+    for chunk in chunks(entity_keys, db.PAIR_LOOKUP_BATCH_SIZE):
+        found.update(entities(chunk))
+    entity_ids = []
+    for k in entity_keys:
+        keys.add(k[1])
+        entity = found.get(k)
+        if entity is not None and entity.id is not None:
+            entity_ids.append(entity.id)
+            canonical_forms.add(entity.canonical_form)
+        else:
+            entity_ids.append(_NO_ID)
+            canonical_forms.add(entity_index[k][1])
+
+    document_ids = sorted(documents, key=documents.get)
+    identifiers = StringsBuilder('document_identifier')
+    found = {}
+    for chunk in chunks(document_ids, db.PAIR_LOOKUP_BATCH_SIZE):
+        found.update(document_identifiers(chunk))
+    for d in document_ids:
+        identifiers.add(found.get(d, u''))
+
+    pair_names = sorted(kind_pairs)
+    arrays = [
+        ('segment_id', _object_ids(segment_ids)),
+        ('segment_document', numpy.array(segment_documents, dtype=numpy.int32)),
+        ('segment_offset', numpy.array(offsets, dtype=numpy.int64)),
+        ('token_start', _starts(token_counts)),
+        ('token_ids', numpy.array(token_ids, dtype=numpy.uint32)),
+        ('postag_ids', numpy.array(postag_ids, dtype=numpy.uint32)),
+        ('sentence_start', _starts(sentence_counts)),
+        ('sentences', numpy.array(sentences, dtype=numpy.int32)),
+        ('occurrence_start', _starts(occurrence_counts)),
+        ('occurrence_entity', numpy.array(occurrence_entity, dtype=numpy.int32)),
+        ('occurrence_offset', numpy.array(occurrence_offset, dtype=numpy.int32)),
+        ('occurrence_offset_end', numpy.array(occurrence_offset_end, dtype=numpy.int32)),
+        ('occurrence_alias', numpy.array(occurrence_alias, dtype=numpy.int32)),
+        ('entity_kind', numpy.array([kinds.index(k) for k, _ in entity_keys], dtype=numpy.int32)),
+        ('entity_id', _object_ids(entity_ids)),
+        ('document_id', _object_ids(document_ids)),
+        ('kind_pair_start', _starts([len(kind_pairs[p]) for p in pair_names])),
+        ('kind_pair_segments', numpy.array(
+            list(itertools.chain.from_iterable(kind_pairs[p] for p in pair_names)),
+            dtype=numpy.int32)),
+    ]
+    for strings in (texts, _strings('token_vocabulary', tokens),
+                    _strings('postag_vocabulary', postags), _strings('alias', aliases),
+                    keys, canonical_forms, identifiers):
+        arrays.extend(strings.arrays())
+    header = {'kinds': kinds, 'kind_pairs': pair_names}
+    write_array_file(path, MAGIC, header, arrays)
+    logger.info('Snapshot of %i segments written on %s', len(segment_ids), path)
+
+
+def _document_identifiers(ids):
+    documents = IEDocument.objects.only('human_identifier').in_bulk(list(ids))
+    return dict((i, d.human_identifier) for i, d in documents.items())
+
+
+def export_snapshot(path, batch_size=1000):
+    """Writes a snapshot with all the segments of the database on path"""
+    manager = db.TextSegmentManager()
+
+    def segments():
+        query = TextSegment.objects.timeout(False)
+        for chunk in chunks(query, batch_size):
+            manager.expand(chunk)
+            for segment in chunk:
+                yield segment
+    write_snapshot(path, segments())
+
+
+class SnapshotSegmentManager(object):
+    """
+    Read-only db.TextSegmentManager over a snapshot file. Segments are built
+    from the snapshot as they are asked for. Pickled copies map the file
+    again.
+    """
+    # Needs no database connection
+    offline = True
+
+    def __init__(self, path):
+        self.path = path
+        header, arrays = read_array_file(path, MAGIC)
+        self.kinds = header['kinds']
+        self.kind_pairs = dict((p, i) for i, p in enumerate(header['kind_pairs']))
+        self.arrays = arrays
+        self.texts = Strings(arrays, 'text')
+        self.tokens = Strings(arrays, 'token_vocabulary')
+        self.postags = Strings(arrays, 'postag_vocabulary')
+        self.aliases = Strings(arrays, 'alias')
+        self.entity_keys = Strings(arrays, 'entity_key')
+        self.canonical_forms = Strings(arrays, 'canonical_form')
+        self.document_identifiers = Strings(arrays, 'document_identifier')
+        self._token_values = {}
+        self._postag_values = {}
+        self._segment_index = None
+        self._entity_index = None
+        self._entity_occurrences = None
+        self._segment_of_occurrence = None
+        self._document_offsets = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.arrays['segment_document'])
+
+    ###
+    ### Building segments
+    ###
+
+    def _object_id(self, name, i):
+        return ObjectId(bytes(self.arrays[name][i * 12:(i + 1) * 12]))
+
+    def _strings(self, cache, strings, ids):
+        result = []
+        for i in ids:
+            value = cache.get(i)
+            if value is None:
+                value = cache[i] = strings[i]
+            result.append(value)
+        return result
+
+    def segment(self, i, fields=None):
+        """Returns the i-th segment, with only the given fields if any"""
+        a = self.arrays
+        wanted = (lambda f: True) if fields is None else set(fields).__contains__
+        segment = TextSegment(id=self._object_id('segment_id', i))
+        start, end = a['token_start'][i], a['token_start'][i + 1]
+        if wanted('document'):
+            segment._data['document'] = self._object_id('document_id', a['segment_document'][i])
+        if wanted('offset'):
+            segment.offset = int(a['segment_offset'][i])
+        if wanted('offset_end'):
+            segment.offset_end = int(a['segment_offset'][i] + end - start)
+        if wanted('text'):
+            segment.text = self.texts[i]
+        if wanted('tokens'):
+            segment.tokens = self._strings(self._token_values, self.tokens,
+                                           a['token_ids'][start:end].tolist())
+        if wanted('postags'):
+            segment.postags = self._strings(self._postag_values, self.postags,
+                                            a['postag_ids'][start:end].tolist())
+        if wanted('sentences'):
+            segment.sentences = a['sentences'][a['sentence_start'][i]:a['sentence_start'][i + 1]].tolist()
+        if wanted('entities'):
+            segment.entities = [self._occurrence(j) for j in range(
+                a['occurrence_start'][i], a['occurrence_start'][i + 1])]
+        if wanted('kind_pairs') and wanted('entities'):
+            segment.update_kind_pairs()
+        segment._changed_fields = []
+        return segment
+
+    def _occurrence(self, j):
+        a = self.arrays
+        entity = a['occurrence_entity'][j]
+        alias = a['occurrence_alias'][j]
+        return EntityInSegment(
+            key=self.entity_keys[entity],
+            canonical_form=self.canonical_forms[entity],
+            kind=self.kinds[a['entity_kind'][entity]],
+            offset=int(a['occurrence_offset'][j]),
+            offset_end=int(a['occurrence_offset_end'][j]),
+            alias=None if alias < 0 else self.aliases[alias],
+        )
+
+    def _segments(self, indexes, fields):
+        for i in indexes:
+            yield self.segment(i, fields)
+
+    ###
+    ### Indexes, built when first needed
+    ###
+
+    def segment_index(self, segment_id):
+        """Position of the segment of the given id, or None"""
+        if self._segment_index is None:
+            ids = self.arrays['segment_id']
+            self._segment_index = dict(
+                (ObjectId(bytes(ids[i * 12:(i + 1) * 12])), i) for i in range(len(self)))
+        return self._segment_index.get(segment_id)
+
+    def entity_index(self, kind, key):
+        """Position of the entity on the snapshot, or None"""
+        if self._entity_index is None:
+            self._entity_index = dict(
+                ((self.kinds[k], self.entity_keys[i]), i)
+                for i, k in enumerate(self.arrays['entity_kind']))
+        return self._entity_index.get((kind, key))
+
+    def _segments_of_occurrences(self):
+        if self._segment_of_occurrence is None:
+            counts = numpy.diff(self.arrays['occurrence_start'])
+            self._segment_of_occurrence = numpy.repeat(
+                numpy.arange(len(self), dtype=numpy.int64), counts)
+        return self._segment_of_occurrence
+
+    def _occurrences_of(self, entity):
+        """Sorted array of segment positions, once for each occurrence of
+        the entity on them"""
+        if self._entity_occurrences is None:
+            entities = self.arrays['occurrence_entity']
+            order = numpy.argsort(entities, kind='mergesort')
+            self._entity_occurrences = (
+                entities[order], self._segments_of_occurrences()[order])
+        entities, segments = self._entity_occurrences
+        start, end = numpy.searchsorted(entities, [entity, entity + 1])
+        return segments[start:end]
+
+    ###
+    ### TextSegmentManager interface
+    ###
+
+    def segments_with_both_entities(self, entity_a, entity_b):
+        ids, = self.segment_ids_with_entity_pairs([(entity_a, entity_b)])
+        return list(self.segments_by_id(ids).values())
+
+    def segment_ids_with_entity_pairs(self, pairs):
+        result = []
+        for a, b in pairs:
+            i, j = self.entity_index(a.kind, a.key), self.entity_index(b.kind, b.key)
+            if i is None or j is None:
+                result.append([])
+                continue
+            if i == j:
+                # Segments with two occurrences or more
+                occurrences = numpy.sort(self._occurrences_of(i))
+                segments = numpy.unique(occurrences[1:][occurrences[1:] == occurrences[:-1]])
+            else:
+                segments = numpy.intersect1d(self._occurrences_of(i), self._occurrences_of(j))
+            result.append([self._object_id('segment_id', s) for s in segments])
+        return result
+
+    def segments_with_both_kinds(self, kind_a, kind_b, fields=None):
+        return self.segments_with_kind_pairs([(kind_a, kind_b)], fields)
+
+    def _indexes_with_kind_pairs(self, pairs):
+        a = self.arrays
+        found = []
+        for kind_a, kind_b in pairs:
+            p = self.kind_pairs.get(kind_pair(kind_a, kind_b))
+            if p is not None:
+                found.append(a['kind_pair_segments'][a['kind_pair_start'][p]:a['kind_pair_start'][p + 1]])
+        if not found:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(found))
+
+    def segments_with_kind_pairs(self, pairs, fields=None):
+        return self._segments(self._indexes_with_kind_pairs(pairs), fields)
+
+    def segment_ids_with_kind_pairs(self, pairs):
+        return [self._object_id('segment_id', i) for i in self._indexes_with_kind_pairs(pairs)]
+
+    def segments_by_id(self, ids, fields=None):
+        result = {}
+        for segment_id in ids:
+            i = self.segment_index(segment_id)
+            if i is not None:
+                result[segment_id] = self.segment(i, fields)
+        return result
+
+    def expand(self, segments):
+        # Segments of snapshots are never compact
+        pass
+
+    def get_segment(self, document_identifier, offset):
+        if self._document_offsets is None:
+            a = self.arrays
+            self._document_offsets = dict(
+                ((self.document_identifiers[d], int(o)), i)
+                for i, (d, o) in enumerate(zip(a['segment_document'], a['segment_offset'])))
+        i = self._document_offsets.get((document_identifier, offset))
+        if i is None:
+            raise TextSegment.DoesNotExist(
+                'No segment of %s at %i on the snapshot' % (document_identifier, offset))
+        return self.segment(i)
+
+    def entities(self, keys):
+        """Same as db.get_entities, using the entities on the snapshot"""
+        result = {}
+        for kind, key in keys:
+            i = self.entity_index(kind, key)
+            if i is not None:
+                entity_id = self._object_id('entity_id', i)
+                result[(kind, key)] = Entity(
+                    id=entity_id if entity_id != _NO_ID else None,
+                    kind=kind, key=key, canonical_form=self.canonical_forms[i])
+        return result
+
+
+def connect(path):
+    """Returns a db.IEPYDBConnector reading segments from the snapshot on
+    path, and makes get_entity and get_entities read its entities.
+    """
+    segments = SnapshotSegmentManager(path)
+    db.set_entity_source(segments.entities)
+    return db.IEPYDBConnector(None, segments, None)
@@ -0,0 +1,171 @@
+"""
+Long lived Stanford POS tagger and NER processes.
+
+nltk's Stanford wrappers start a new Java process, and write temporary files,
+on every call. Here the Java tool is started once, reading sentences from its
+standard input, and every batch of sentences is sent through that same pipe,
+one sentence per line.
+"""
+import atexit
+import logging
+import re
+import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+
+def _escape(token):
+    # Tokens are sent separated by spaces, so they must have none
+    return _WHITESPACE.sub(u'_', token) or u'_'
+
+
+class StanfordServer(object):
+    """A Stanford tool running as a long lived process.
+
+    command is the command line that starts the tool, that must read
+    sentences from its standard input, one per line, and write the tagged
+    tokens of each one as "token<separator>tag" (a sentence may be answered
+    in several lines). Whitespace inside tokens is sent as "_", and empty
+    tokens as a single "_", so every token is answered once. The process is
+    started on first use (so instances can be pickled and used on other
+    processes, each one starting its own process) and stopped on exit.
+
+    If the process takes more than `timeout` seconds to write the next line
+    of an answer (including the time it takes to start, the first time), or
+    answers a sentence with too many tokens, it's stopped and an error is
+    raised, instead of waiting forever.
+
+    Instances are callables, with the same interface of nltk's batch_tag:
+    take a list of sentences (lists of tokens) and return a list of lists of
+    (token, tag) pairs.
+    """
+
+    def __init__(self, command, separator, encoding='utf8', timeout=300):
+        self.command = command
+        self.separator = separator
+        self.encoding = encoding
+        self.timeout = timeout
+        self.process = None
+        self._lines = None
+        self._stop_at_exit = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['process'] = None
+        state['_lines'] = None
+        state['_stop_at_exit'] = False
+        return state
+
+    def start(self):
+        if self.process is not None and self.process.poll() is None:
+            return
+        logger.info('Starting %s', ' '.join(self.command))
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        # Answers are read on a thread, so they can be waited for with a
+        # timeout
+        self._lines = queue.Queue()
+        reader = threading.Thread(target=self._read_lines,
+                                  args=(self.process.stdout, self._lines))
+        reader.daemon = True
+        reader.start()
+        if not self._stop_at_exit:
+            atexit.register(self.stop)
+            self._stop_at_exit = True
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+    def tag_sentence(self, tokens):
+        """Returns the list of (token, tag) pairs of a list of tokens"""
+        return self.batch_tag([tokens])[0]
+
+    def batch_tag(self, sentences):
+        sentences = [list(s) for s in sentences]
+        pending = [s for s in sentences if s]
+        if not pending:
+            return [[] for s in sentences]
+        self.start()
+        # Sentences are written while the answers are read, so neither pipe
+        # gets full waiting for the other one
+        writer = threading.Thread(target=self._write,
+                                  args=(self.process.stdin, pending))
+        writer.daemon = True
+        writer.start()
+        try:
+            answers = [self._read(s) for s in pending]
+        except Exception:
+            self.stop()
+            raise
+        finally:
+            writer.join()
+        answers.reverse()
+        return [answers.pop() if s else [] for s in sentences]
+
+    __call__ = batch_tag
+
+    def _write(self, pipe, sentences):
+        try:
+            for tokens in sentences:
+                line = u' '.join(_escape(t) for t in tokens) + u'\n'
+                pipe.write(line.encode(self.encoding))
+            pipe.flush()
+        except (IOError, OSError, ValueError):
+            # The process exited, or was stopped; the reader finds it out
+            pass
+
+    @staticmethod
+    def _read_lines(pipe, lines):
+        for line in iter(pipe.readline, b''):
+            lines.put(line)
+        lines.put(None)  # The process exited, or was stopped
+
+    def _read(self, tokens):
+        answer = []
+        while len(answer) < len(tokens):
+            try:
+                line = self._lines.get(timeout=self.timeout)
+            except queue.Empty:
+                raise RuntimeError('No answer in %s seconds: %s' %
+                                   (self.timeout, ' '.join(self.command)))
+            if line is None:
+                raise RuntimeError('Process exited with code %s: %s' %
+                                   (self.process.poll(), ' '.join(self.command)))
+            answer.extend(line.decode(self.encoding).split())
+        if len(answer) != len(tokens):
+            raise ValueError('Answered %i tokens for a sentence of %i' %
+                             (len(answer), len(tokens)))
+        return [(token, tagged.rsplit(self.separator, 1)[-1])
+                for token, tagged in zip(tokens, answer)]
+
+
+def postagger_server(model, jar, java_options='-mx1000m', encoding='utf8'):
+    """Returns a StanfordServer running the Stanford POS tagger, that doesn't
+    tokenize nor split the sentences given."""
+    command = ['java', java_options, '-cp', jar,
+               'edu.stanford.nlp.tagger.maxent.MaxentTagger',
+               '-model', model, '-tokenize', 'false', '-sentenceDelimiter', 'newline',
+               '-encoding', encoding]
+    return StanfordServer(command, '_', encoding)
+
+
+def ner_server(classifier, jar, java_options='-mx1000m', encoding='utf8'):
+    """Returns a StanfordServer running the Stanford NER, that doesn't
+    tokenize the sentences given."""
+    command = ['java', java_options, '-cp', jar,
+               'edu.stanford.nlp.ie.crf.CRFClassifier',
+               '-loadClassifier', classifier, '-readStdin',
+               '-tokenizerFactory', 'edu.stanford.nlp.process.WhitespaceTokenizer',
+               '-outputFormat', 'slashTags', '-encoding', encoding]
+    return StanfordServer(command, '/', encoding)
@@ -6,7 +6,8 @@ from nltk.tag.stanford import POSTagger
 import wget
 
 from iepy.models import PreProcessSteps
-from iepy.preprocess import BasePreProcessStepRunner
+from iepy.preprocess import BaseBatchedPreProcessStepRunner, tag_in_batches
+from iepy.stanford_server import postagger_server
 from iepy.utils import DIRS, unzip_file
 
 
@@ -15,10 +16,16 @@ stanford_postagger_name = 'stanford-postagger-2014-01-04'
 download_url_base = 'http://nlp.stanford.edu/software/'
 
 
-class TaggerRunner(BasePreProcessStepRunner):
+class TaggerRunner(BaseBatchedPreProcessStepRunner):
     """Wrapper to insert a generic callable sentence POS tagger into the pipeline.
+
+    When processing many documents, their sentences are given to the tagger
+    together, up to max_batch_sentences sentences or max_batch_tokens tokens
+    per call.
     """
     step = PreProcessSteps.tagging
+    max_batch_sentences = 1000
+    max_batch_tokens = 25000
 
     def __init__(self, postagger, override=False):
         """override:
@@ -26,36 +33,47 @@ class TaggerRunner(BasePreProcessStepRunner):
         self.postagger = postagger
         self.override = override
 
-    def __call__(self, doc):
+    def must_process(self, doc):
         if not doc.was_preprocess_done(PreProcessSteps.sentencer):
-            return
-        if not self.override and doc.was_preprocess_done(PreProcessSteps.tagging):
-            return
+            return False
+        return self.override or not doc.was_preprocess_done(PreProcessSteps.tagging)
 
-        tagged_doc = []
-        for ts in self.postagger(doc.get_sentences()):
-            tagged_doc.extend(tag for token, tag in ts)
+    def process_documents(self, docs):
+        for doc, tagged in tag_in_batches(docs, self.postagger, self.must_process,
+                                          self.max_batch_sentences,
+                                          self.max_batch_tokens):
+            if tagged is not None:
+                tagged_doc = []
+                for ts in tagged:
+                    tagged_doc.extend(tag for token, tag in ts)
 
-        assert len(tagged_doc) == len(doc.tokens)
+                assert len(tagged_doc) == len(doc.tokens)
 
-        doc.set_preprocess_result(PreProcessSteps.tagging, tagged_doc)
-        doc.save()
-        logger.debug("POS tagged a document")
+                doc.set_preprocess_result(PreProcessSteps.tagging, tagged_doc)
+                doc.save()
+                logger.debug("POS tagged a document")
+            yield doc
 
 
 class StanfordTaggerRunner(TaggerRunner):
 
-    def __init__(self, override=False):
+    def __init__(self, override=False, persistent=False):
+        """If persistent is True, the tagger runs as a server started once,
+        instead of a new Java process for each document (see
+        iepy.stanford_server). The preprocess script of new applications
+        turns it on."""
         tagger_path = os.path.join(DIRS.user_data_dir, stanford_postagger_name)
         if not os.path.exists(tagger_path):
             raise LookupError("Stanford POS tagger not found. Try running the "
                               "command download_third_party_data.py")
 
-        postagger = POSTagger(
-            os.path.join(tagger_path, 'models', 'english-bidirectional-distsim.tagger'),
-            os.path.join(tagger_path, 'stanford-postagger.jar'),
-            encoding='utf8')
-        super(StanfordTaggerRunner, self).__init__(postagger.batch_tag, override)
+        model = os.path.join(tagger_path, 'models', 'english-bidirectional-distsim.tagger')
+        jar = os.path.join(tagger_path, 'stanford-postagger.jar')
+        if persistent:
+            postagger = postagger_server(model, jar)
+        else:
+            postagger = POSTagger(model, jar, encoding='utf8').batch_tag
+        super(StanfordTaggerRunner, self).__init__(postagger, override)
 
 
 def download():
@@ -1,9 +1,11 @@
 import codecs
 from csv import reader, writer
 from getpass import getuser
+import itertools
 import zipfile
 
 from appdirs import AppDirs
+import numpy
 
 
 DIRS = AppDirs('iepy', getuser())
@@ -25,6 +27,39 @@ def unzip(zipped_list, n):
         return zip(*zipped_list)
 
 
+def chunks(iterable, size):
+    """Iterates over lists of `size` consecutive items of the iterable (the
+    last one may be shorter)."""
+    it = iter(iterable)
+    chunk = list(itertools.islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(it, size))
+
+
+class ValueTable(object):
+    """Bidirectional mapping between hashable values and consecutive ints,
+    given in order of first appearance"""
+
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def id_of(self, value):
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def ids_of(self, values):
+        """numpy array of the ids of the given values"""
+        return numpy.array([self.id_of(v) for v in values], dtype=numpy.int64)
+
+
 def unzip_file(zip_path, extraction_base_path):
     zfile = zipfile.ZipFile(zip_path)
     zfile.extractall(extraction_base_path)
@@ -62,7 +97,7 @@ def load_evidence_from_csv(filename, connection):
             entity_a = db.get_entity(row[0], row[1])
             entity_b = db.get_entity(row[2], row[3])
             f = Fact(entity_a, row[4], entity_b)
-            s = db.get_segment(row[5], int(row[6]))
+            s = connection.segments.get_segment(row[5], int(row[6]))
             e = Evidence(fact=f, segment=s, o1=int(row[7]), o2=int(row[8]))
             assert s.entities[e.o1].key == entity_a.key
             assert s.entities[e.o2].key == entity_b.key
@@ -0,0 +1,107 @@
+"""
+Compact storage of tokens and POS tags.
+
+Segments built in compact mode don't copy the tokens and POS tags of their
+document. Instead, the document keeps them as integer ids packed in binary
+fields (4 bytes per token), in place of its lists of strings, and segments
+refer to their range of tokens of the document. Ids are given by
+vocabularies stored on the database (shared by every process) and cached
+in-process, and TextSegmentManager turns them back into strings when compact
+segments are loaded.
+"""
+import threading
+
+import numpy
+
+from iepy.array_file import array_bytes
+from iepy.models import VocabularyEntry, insert_ignoring_duplicates
+
+_ID_DTYPE = numpy.dtype('<u4')
+
+
+def pack_ids(ids):
+    """Returns the bytes of a list of ids"""
+    return array_bytes(numpy.asarray(ids, dtype=_ID_DTYPE))
+
+
+def unpack_ids(data):
+    """Returns an array with the ids packed by pack_ids"""
+    return numpy.frombuffer(data or b'', dtype=_ID_DTYPE)
+
+
+class Vocabulary(object):
+    """Bidirectional mapping between strings and consecutive int ids,
+    stored on the database with the given name and cached in-process.
+    Ids never change once given, so the cache never gets stale.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._ids = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Cached ids are not worth to be transferred
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ids(self, values):
+        """Returns the list of ids of the given strings. New strings get
+        new ids, all of them with a single write."""
+        with self._lock:
+            missing = set(v for v in values if v not in self._ids)
+            if missing:
+                self._fetch(value__in=list(missing))
+                # New ones get their ids in order of appearance
+                new = []
+                for v in values:
+                    if v not in self._ids and v in missing:
+                        new.append(v)
+                        missing.discard(v)
+                if new:
+                    self._add(new)
+            return [self._ids[v] for v in values]
+
+    def values(self, ids):
+        """Returns the list of strings of the given ids"""
+        with self._lock:
+            missing = set(int(i) for i in ids if i not in self._values)
+            if missing:
+                self._fetch(index__in=list(missing))
+            return [self._values[i] for i in ids]
+
+    def _cache(self, value, index):
+        self._ids[value] = index
+        self._values[index] = value
+
+    def _fetch(self, **query):
+        entries = VocabularyEntry.objects(vocabulary=self.name, **query)
+        for entry in entries.only('value', 'index'):
+            self._cache(entry.value, entry.index)
+
+    def _add(self, values):
+        # Ids are reserved in a block from a counter, so concurrent
+        # processes never give the same id to different strings
+        counter = VocabularyEntry._get_db().vocabulary_counters.find_and_modify(
+            {'_id': self.name}, {'$inc': {'next': len(values)}},
+            upsert=True, new=True)
+        first = counter['next'] - len(values)
+        entries = [{'vocabulary': self.name, 'value': v, 'index': first + i}
+                   for i, v in enumerate(values)]
+        if insert_ignoring_duplicates(VocabularyEntry._get_collection(), entries):
+            # Some strings were added meanwhile by another process, with
+            # other ids. Theirs are the good ones.
+            self._fetch(value__in=values)
+        for entry in entries:
+            if entry['value'] not in self._ids:
+                self._cache(entry['value'], entry['index'])
+
+
+tokens = Vocabulary('tokens')
+postags = Vocabulary('postags')
@@ -0,0 +1,20 @@
+"""
+Compiles names files into a gazetteer, to be loaded instantly (and shared
+between processes) by LiteralNERRunner.
+
+Usage:
+    compile_gazetteer.py <output_file> (<label> <names_file>)...
+    compile_gazetteer.py -h | --help | --version
+
+Options:
+  -h --help             Show this screen
+  --version             Version number
+"""
+from docopt import docopt
+
+from iepy.gazetteer import compile_gazetteer
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__, version=0.1)
+    compile_gazetteer(opts['<label>'], opts['<names_file>'], opts['<output_file>'])
@@ -4,12 +4,15 @@ Cross-validate IEPY classifier
 
 Usage:
     cross_validate.py [--k=<subsamples>] <dbname> <gold_standard>
+    cross_validate.py [--k=<subsamples>] --snapshot=<file> <gold_standard>
     cross_validate.py -h | --help | --version
 
 Options:
   -h --help             Show this screen
   --version             Version number
   --k=<subsamples>      Number of subsamples [default: 10]
+  --snapshot=<file>     Read the corpus from a snapshot (see export_snapshot.py)
+                        instead of a database
 """
 from __future__ import division
 
@@ -19,21 +22,27 @@ import sys
 
 from docopt import docopt
 
-from iepy import db
+from iepy import db, snapshot
 from iepy.core import Knowledge
 from iepy.fact_extractor import FactExtractorFactory
+from iepy.feature_cache import FeatureCache
 from iepy.utils import load_evidence_from_csv
 
 config = {
     "classifier": "dtree",
     "classifier_args": dict(),
     "dimensionality_reduction": None,
+    # every subsample shares the features evaluated on the others
+    "feature_cache": FeatureCache(persistent=False),
 }
 
 
 def main(options):
     logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
-    connection = db.connect(options['<dbname>'])
+    if options['--snapshot']:
+        connection = snapshot.connect(options['--snapshot'])
+    else:
+        connection = db.connect(options['<dbname>'])
     standard = load_evidence_from_csv(options['<gold_standard>'], connection)
     logging.info("Loaded %d samples from gold standard", len(standard))
     k = int(options['--k'])
@@ -0,0 +1,25 @@
+"""
+Exports the preprocessed corpus of a database to a snapshot file, that can be
+used for running extraction with no database.
+
+Usage:
+    export_snapshot.py <dbname> <output_file>
+    export_snapshot.py -h | --help | --version
+
+Options:
+  -h --help             Show this screen
+  --version             Version number
+"""
+import logging
+
+from docopt import docopt
+
+from iepy import db
+from iepy.snapshot import export_snapshot
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    opts = docopt(__doc__, version=0.1)
+    db.connect(opts['<dbname>'])
+    export_snapshot(opts['<output_file>'])
@@ -2,12 +2,14 @@
 Run IEPY core loop
 
 Usage:
-    iepy_runner.py <dbname> <seeds_file> <output_file>
+    iepy_runner.py [--questions=<n>] [--async] <dbname> <seeds_file> <output_file>
     iepy_runner.py -h | --help | --version
 
 Options:
   -h --help             Show this screen
   --version             Version number
+  --questions=<n>       Number of questions shown on each round [default: 20]
+  --async               Answer questions while the next iteration runs
 """
 from docopt import docopt
 import logging
@@ -22,18 +24,25 @@ if __name__ == '__main__':
     connection = db.connect(opts['<dbname>'])
     seed_facts = load_facts_from_csv(opts['<seeds_file>'])
     output_file = opts['<output_file>']
+    questions_per_round = int(opts['--questions'])
     p = BootstrappedIEPipeline(connection, seed_facts)
+    # Answer questions of the previous iteration while the next one runs
+    p.asynchronous = opts['--async']
 
     logging.basicConfig(level=logging.DEBUG,
                         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
     STOP = 'STOP'
 
-    p.start()  # blocking
+    p.start()
+    p.wait()  # There are no questions until the first iteration ends
     keep_looping = True
     while keep_looping:
-        qs = list(p.questions_available())
+        qs = p.questions_available(questions_per_round)
         if not qs:
+            if p.is_processing():
+                p.wait()
+                continue
             keep_looping = False
         term = TerminalInterviewer(qs, p.add_answer, [(STOP, 'Stop execution ASAP')])
         result = term()
@@ -41,5 +50,6 @@ if __name__ == '__main__':
             keep_looping = False
         else:
             p.force_process()
+    p.wait()
     facts = p.known_facts()  # profit
     save_labeled_evidence_to_csv(facts.items(), output_file)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+from featureforge.vectorizer import Vectorizer
+
+from iepy.batch_features import BatchVectorizer
+from iepy.fact_extractor import (bag_of_words,
+                                 bag_of_pos,
+                                 bag_of_word_bigrams,
+                                 bag_of_wordpos,
+                                 bag_of_wordpos_bigrams,
+                                 bag_of_words_in_between,
+                                 bag_of_pos_in_between,
+                                 bag_of_word_bigrams_in_between,
+                                 bag_of_wordpos_in_between,
+                                 bag_of_wordpos_bigrams_in_between,
+                                 entity_order,
+                                 entity_distance,
+                                 other_entities_in_between,
+                                 in_same_sentence,
+                                 total_number_of_entities,
+                                 verbs_count_in_between,
+                                 verbs_count,
+                                 symbols_in_between,
+                                 BagOfVerbStems,
+                                 number_of_tokens,
+                                 FactExtractor,
+                                 )
+
+from .factories import EvidenceFactory
+
+FEATURES = [
+    bag_of_words,
+    bag_of_pos,
+    bag_of_word_bigrams,
+    bag_of_wordpos,
+    bag_of_wordpos_bigrams,
+    bag_of_words_in_between,
+    bag_of_pos_in_between,
+    bag_of_word_bigrams_in_between,
+    bag_of_wordpos_in_between,
+    bag_of_wordpos_bigrams_in_between,
+    entity_order,
+    entity_distance,
+    other_entities_in_between,
+    in_same_sentence,
+    verbs_count_in_between,
+    verbs_count,
+    total_number_of_entities,
+    symbols_in_between,
+    number_of_tokens,
+    BagOfVerbStems(in_between=True),
+    BagOfVerbStems(in_between=False),
+]
+
+
+def _e(markup, postags, sentences=(0,), **kwargs):
+    evidence = EvidenceFactory(markup=markup, **kwargs)
+    evidence.segment.postags = postags.split()
+    evidence.segment.sentences = list(sentences)
+    return evidence
+
+
+def _pairs(evidence):
+    """All the evidence of the occurrence pairs of the evidence segment"""
+    n = len(evidence.segment.entities)
+    return [EvidenceFactory(segment=evidence.segment, o1=i, o2=j)
+            for i in range(n) for j in range(n) if i != j]
+
+
+def _rows(reverse, matrix):
+    """The rows of matrix as dicts {(feature index, value): value}, given the
+    list of (feature index, value) of each column"""
+    rows = []
+    for row in matrix.toarray():
+        rows.append(dict((reverse[column], row[column])
+                         for column in row.nonzero()[0]))
+    return rows
+
+
+class TestBatchVectorizer(TestCase):
+
+    def setUp(self):
+        a = _e(u"{John|person} Smith Ran to {Paris|location} , and "
+               u"then ran to the {Louvre|location} .",
+               u"NNP NNP VBD TO NNP , CC RB VBD TO DT NNP .",
+               sentences=(0, 6))
+        b = _e(u"The {Mate|thing**} runs before {Tea|thing*} ... {Coffee|thing} Runs",
+               u"DT NN VBZ IN NN : NN VBZ")
+        c = _e(u"{Drinking Mate|thing*} {toilet|thing**}", u"VBG NN")
+        self.evidences = _pairs(a) + _pairs(b) + [c]
+        self.evidences.insert(1, _e(u"{John|person} {Paris|location} Ran",
+                                    u"NNP NNP"))
+
+    def test_same_columns_as_featureforge(self):
+        featureforge = Vectorizer(FEATURES)
+        batch = BatchVectorizer(FEATURES, batch_size=4)
+        expected = featureforge.fit_transform(self.evidences)
+        result = batch.fit_transform(self.evidences)
+        self.assertEqual(result.shape, expected.shape)
+        self.assertEqual(_rows(batch.reverse, result),
+                         _rows(featureforge.flattener.reverse, expected))
+
+    def test_transform_ignores_unknown_values(self):
+        featureforge = Vectorizer(FEATURES)
+        batch = BatchVectorizer(FEATURES)
+        featureforge.fit(self.evidences[:3])
+        batch.fit(self.evidences[:3])
+        expected = featureforge.transform(self.evidences)
+        result = batch.transform(self.evidences)
+        self.assertEqual(result.shape, expected.shape)
+        self.assertEqual(_rows(batch.reverse, result),
+                         _rows(featureforge.flattener.reverse, expected))
+
+    def test_extra_pos_tags_are_ignored(self):
+        evidence = _e(u"{John|person} runs to {Paris|location}", u"NNP VBZ TO NNP")
+        extra = _e(u"{John|person} runs to {Paris|location}", u"NNP VBZ TO NNP VBD")
+        batch = BatchVectorizer([bag_of_pos, bag_of_wordpos, verbs_count])
+        batch.fit([evidence])
+        self.assertEqual(_rows(batch.reverse, batch.transform([extra])),
+                         _rows(batch.reverse, batch.transform([evidence])))
+
+    def test_numeric_features_come_first(self):
+        batch = BatchVectorizer([bag_of_words, number_of_tokens])
+        batch.fit(self.evidences)
+        self.assertEqual(batch.column_to_feature(0), (number_of_tokens, None))
+        self.assertEqual(batch.column_to_feature(1), (bag_of_words, u'john'))
+
+    def test_unsupported_features_are_rejected(self):
+        with self.assertRaises(ValueError):
+            BatchVectorizer([lambda evidence: 1])
+
+    def test_fact_extractor_option(self):
+        extractor = FactExtractor({"features": FEATURES, "vectorizer": "batch",
+                                   "classifier": "dtree"})
+        extractor.fit(dict((e, i % 2 == 0) for i, e in enumerate(self.evidences)))
+        self.assertIsInstance(extractor.predictor.steps[0][1], BatchVectorizer)
+        self.assertEqual(len(extractor.predict(self.evidences)),
+                         len(self.evidences))
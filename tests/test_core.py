@@ -2,13 +2,25 @@ try:
     from unittest import mock
 except ImportError:
     import mock
+import pickle
+import threading
 import unittest
 
+from bson.objectid import ObjectId
+import numpy
 from sklearn.pipeline import Pipeline
 from future.builtins import range
 
-from iepy.core import Fact, Evidence, certainty, Knowledge, BootstrappedIEPipeline
-from .factories import EntityFactory, EvidenceFactory, FactFactory
+from iepy.core import (
+    Fact, Evidence, certainty, Knowledge, BootstrappedIEPipeline, Questions,
+    build_evidence, load_evidence, _score_segments)
+from iepy.fact_extractor import (
+    BagOfVerbStems, bag_of_words, entity_order, number_of_tokens)
+from iepy.db import CANDIDATE_FIELDS, FEATURE_FIELDS
+from iepy.evidence_store import EvidenceStore
+from .factories import (
+    EntityFactory, EntityInSegmentFactory, EvidenceFactory, FactFactory,
+    TextSegmentFactory)
 
 
 class TestCertainty(unittest.TestCase):
@@ -56,6 +68,51 @@ class TestKnowledge(unittest.TestCase):
             'other': Knowledge({e2: 0.5}),
         })
 
+    def test_sorting_top_n(self):
+        f = Fact(None, 'rel', None)
+        e1 = Evidence(f, None, 0, 1)
+        e2 = Evidence(f, None, 0, 2)
+        e3 = Evidence(f, None, 0, 3)
+        e4 = Evidence(f, None, 0, 4)
+        k = Knowledge({e1: 1.0, e2: 0.5, e3: 0.1, e4: None})
+        self.assertEqual(k.by_certainty(2), [(e1, 1.0), (e3, 0.1)])
+        self.assertEqual(k.by_certainty()[-1], (e4, None))
+
+    def test_certain_and_without(self):
+        f = Fact(None, 'rel', None)
+        e1 = Evidence(f, None, 0, 1)
+        e2 = Evidence(f, None, 0, 2)
+        e3 = Evidence(f, None, 0, 3)
+        k = Knowledge({e1: 1.0, e2: 0.5, e3: 0.1})
+        self.assertEqual(k.certain(0.8), Knowledge({e1: 1.0, e3: 0.1}))
+        self.assertEqual(k.without({e1: True}), Knowledge({e2: 0.5, e3: 0.1}))
+
+
+class TestLoadEvidence(unittest.TestCase):
+
+    def test_segments_and_entities_are_loaded_per_chunk(self):
+        segments = [TextSegmentFactory(entities=[
+            EntityInSegmentFactory(key=u'A', offset=0, offset_end=1),
+            EntityInSegmentFactory(key=u'B', offset=1, offset_end=2),
+        ]) for _ in range(3)]
+        for s in segments:
+            s.id = ObjectId()
+        manager = mock.MagicMock()
+        manager.segments_by_id.side_effect = lambda ids: dict(
+            (s.id, s) for s in segments if s.id in ids)
+        A, B = (u'person', u'A'), (u'person', u'B')
+        items = [(s.id, 0, 1, u'knows', A, B, 0.25) for s in segments]
+        with mock.patch('iepy.db.get_entities') as get_entities:
+            get_entities.side_effect = lambda keys: dict(
+                (k, EntityFactory(kind=k[0], key=k[1])) for k in keys)
+            result = list(load_evidence(manager, iter(items), chunk_size=2))
+        self.assertEqual(manager.segments_by_id.call_count, 2)
+        self.assertEqual(get_entities.call_count, 2)
+        self.assertEqual([e.segment for e, _ in result], segments)
+        e, score = result[0]
+        self.assertEqual((e.o1, e.o2, e.fact.relation, score), (0, 1, u'knows', 0.25))
+        self.assertEqual(e.fact.e2.key, u'B')
+
 
 class TestFactExtractionInterface(unittest.TestCase):
 
@@ -147,3 +204,297 @@ class TestBootstrappedIEPipelineRelations(unittest.TestCase):
                          relation=u'x')
         self.assertRaises(ValueError, BootstrappedIEPipeline,
                           mock.MagicMock(), [f1, f2])
+
+
+class TestExtractorConfig(unittest.TestCase):
+
+    def test_default_features_can_be_pickled(self):
+        # Extractors are pickled for scoring on worker processes
+        f = FactFactory(e1__kind=u'person', e2__kind=u'location', relation=u'x')
+        config = BootstrappedIEPipeline(mock.MagicMock(), [f]).extractor_config
+        copy = pickle.loads(pickle.dumps(config, protocol=2))
+        self.assertEqual([type(x) for x in copy['features']],
+                         [type(x) for x in config['features']])
+        stems = [x for x in copy['features'] if isinstance(x, BagOfVerbStems)]
+        self.assertEqual(stems[0].do(u'drinking'), u'drink')
+
+
+class TestExtractFacts(unittest.TestCase):
+
+    def setUp(self):
+        super(TestExtractFacts, self).setUp()
+        patcher = mock.patch('iepy.db.get_entity')
+        self.mock_get_entity = patcher.start()
+        entities = {}
+
+        def get_entity(kind, key):
+            if (kind, key) not in entities:
+                entities[(kind, key)] = EntityFactory(kind=kind, key=key)
+            return entities[(kind, key)]
+        self.mock_get_entity.side_effect = get_entity
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('iepy.db.get_entities')
+        self.mock_get_entities = patcher.start()
+        self.mock_get_entities.side_effect = lambda keys: dict((k, get_entity(*k)) for k in keys)
+        self.addCleanup(patcher.stop)
+
+    def build_pipeline(self, segments):
+        seeds = [
+            FactFactory(e1__kind=u'person', e2__kind=u'location', relation=u'born'),
+            FactFactory(e1__kind=u'person', e2__kind=u'person', relation=u'knows'),
+        ]
+        db_con = mock.MagicMock()
+        db_con.segments.segments_with_kind_pairs.return_value = segments
+        db_con.segments.segments_by_id.side_effect = lambda ids, fields=None: dict(
+            (s.id, s) for s in segments if s.id in ids)
+        return BootstrappedIEPipeline(db_con, seeds)
+
+    def build_segment(self, kinds):
+        entities = [EntityInSegmentFactory(kind=kind, offset=i, offset_end=i + 1)
+                    for i, kind in enumerate(kinds)]
+        segment = TextSegmentFactory(tokens=[u'x'] * len(kinds), entities=entities)
+        segment.id = ObjectId()
+        return segment
+
+    def test_seed_segments_are_looked_up_in_bulk(self):
+        b = self.build_pipeline([])
+        fact = [f for f, _, _, _ in b.knowledge if f.relation == u'born'][0]
+        segment = self.build_segment([u'person', u'location'])
+        segment.entities[0].key = fact.e1.key
+        segment.entities[1].key = fact.e2.key
+        b.db_con.segments.segment_ids_with_entity_pairs.side_effect = lambda pairs: [
+            [segment.id] if (e1, e2) == (fact.e1, fact.e2) else [] for e1, e2 in pairs]
+        b.db_con.segments.segments_by_id.side_effect = lambda ids, fields=None: dict(
+            (i, segment) for i in ids)
+        with mock.patch.object(b, 'do_iteration') as mock_do_iteration:
+            b.start()
+        self.assertEqual(b.db_con.segments.segment_ids_with_entity_pairs.call_count, 1)
+        self.assertEqual(b.db_con.segments.segments_by_id.call_count, 1)
+        evidences = mock_do_iteration.call_args[0][0]
+        self.assertEqual([(o1, o2, r) for _, o1, o2, r, _ in evidences.compact_items()],
+                         [(0, 1, u'born')])
+
+    def test_only_segments_with_candidates_are_fully_loaded(self):
+        s1 = self.build_segment([u'person', u'location'])
+        s2 = self.build_segment([u'location', u'location'])
+        b = self.build_pipeline([s1, s2])
+        b.extract_facts({})
+        manager = b.db_con.segments
+        self.assertEqual(manager.segments_with_kind_pairs.call_args[1],
+                         {'fields': CANDIDATE_FIELDS})
+        (ids, ), kwargs = manager.segments_by_id.call_args
+        self.assertEqual((ids, kwargs), ([s1.id], {'fields': FEATURE_FIELDS}))
+
+    def test_corpus_is_read_once_for_all_relations(self):
+        segments = [self.build_segment([u'person', u'location'])]
+        b = self.build_pipeline(segments)
+        b.extract_facts({})
+        segment_queries = b.db_con.segments.segments_with_kind_pairs
+        self.assertEqual(segment_queries.call_count, 1)
+        pairs = set(segment_queries.call_args[0][0])
+        self.assertEqual(pairs, {(u'person', u'location'), (u'person', u'person')})
+
+    def test_candidates_are_generated_for_each_matching_relation(self):
+        s1 = self.build_segment([u'person', u'location'])
+        s2 = self.build_segment([u'person', u'person', u'location'])
+        b = self.build_pipeline([s1, s2])
+        result = b.extract_facts({})
+        per_relation = Knowledge(result.items()).per_relation()
+        born = sorted((e.segment.text, e.o1, e.o2) for e in per_relation[u'born'])
+        self.assertEqual(born, sorted([(s1.text, 0, 1), (s2.text, 0, 2), (s2.text, 1, 2)]))
+        knows = sorted((e.segment.text, e.o1, e.o2) for e in per_relation[u'knows'])
+        self.assertEqual(knows, sorted([(s2.text, 0, 1), (s2.text, 1, 0)]))
+        self.assertTrue(all(s == 0.5 for _, _, _, _, s in result.compact_items()))
+
+    def test_candidates_are_scored_in_batches(self):
+        segments = [self.build_segment([u'person', u'location']) for _ in range(5)]
+        b = self.build_pipeline(segments)
+        b.extraction_batch_size = 2
+        extractor = mock.MagicMock()
+        extractor.predictor.named_steps = {'classifier': mock.MagicMock(classes_=[0, 1])}
+        extractor.predictor.predict_proba.side_effect = lambda xs: numpy.array([[0.1, 0.9]] * len(xs))
+        result = b.extract_facts({u'born': extractor})
+        batch_sizes = [len(args[0]) for args, _ in extractor.predictor.predict_proba.call_args_list]
+        self.assertEqual(batch_sizes, [2, 2, 1])
+        born = Knowledge(result.items()).per_relation()[u'born']
+        self.assertEqual(len(born), 5)
+        self.assertTrue(all(s == 0.9 for s in born.values()))
+
+    def test_entities_are_prefetched_per_batch_of_segments(self):
+        segments = [self.build_segment([u'person', u'location']) for _ in range(5)]
+        b = self.build_pipeline(segments)
+        b.extraction_batch_size = 2
+        list(b._score_serially({}, b.relations))
+        self.assertEqual(self.mock_get_entities.call_count, 3)
+
+    def test_scoring_worker_returns_compact_arrays(self):
+        s1 = self.build_segment([u'person', u'location'])
+        s2 = self.build_segment([u'location', u'location'])
+        s3 = self.build_segment([u'location', u'person', u'location'])
+        segments = mock.MagicMock()
+        segments.segments_by_id.side_effect = lambda ids, fields=None: dict(
+            (s.id, s) for s in [s1, s2, s3] if s.id in ids)
+        extractor = mock.MagicMock()
+        extractor.predictor.named_steps = {'classifier': mock.MagicMock(classes_=[0, 1])}
+        extractor.predictor.predict_proba.side_effect = lambda xs: numpy.array([[0.3, 0.7]] * len(xs))
+        state = {
+            'segments': segments,
+            'relations': {u'born': (u'person', u'location')},
+            'extractors': {u'born': extractor},
+            'fields': FEATURE_FIELDS,
+        }
+        with mock.patch.dict('iepy.core._worker', state):
+            ids, result = _score_segments([s1.id, s2.id, s3.id])
+        self.assertEqual(ids, [s1.id, s2.id, s3.id])
+        # Only the segments with candidates are fully loaded
+        (ids, ), kwargs = segments.segments_by_id.call_args
+        self.assertEqual((ids, kwargs), ([s1.id, s3.id], {'fields': FEATURE_FIELDS}))
+        indexes, o1s, o2s, e1s, e2s, ps = result[u'born']
+        self.assertEqual(list(zip(indexes, o1s, o2s)), [(0, 0, 1), (2, 1, 0), (2, 1, 2)])
+        person1, person3 = s1.entities[0].key, s3.entities[1].key
+        self.assertEqual(e1s, [(u'person', person1), (u'person', person3), (u'person', person3)])
+        self.assertEqual([kind for kind, _ in e2s], [u'location'] * 3)
+        self.assertEqual(list(ps), [0.7, 0.7, 0.7])
+
+    def test_answered_questions_are_not_available(self):
+        segments = [self.build_segment([u'person', u'location']) for _ in range(3)]
+        b = self.build_pipeline(segments)
+        b.generate_questions(b.extract_facts({}))
+        self.assertEqual(len(b.questions_available()), 3)
+        first, second = b.questions_available(2)
+        b.add_answer(first[0], True)
+        available = b.questions_available()
+        self.assertEqual(len(available), 2)
+        self.assertEqual(available[0][0], second[0])
+        self.assertNotIn(first[0], [e for e, _ in available])
+
+    def test_incremental_mode_keeps_scores_of_relations_without_answers(self):
+        segments = [self.build_segment([u'person', u'person', u'location'])]
+        b = self.build_pipeline(segments)
+        b.incremental = True
+        extractor = mock.MagicMock()
+        extractor.predictor.named_steps = {'classifier': mock.MagicMock(classes_=[0, 1])}
+        extractor.predictor.predict_proba.side_effect = lambda xs: numpy.array([[0.1, 0.9]] * len(xs))
+        b.extract_facts({u'knows': extractor})
+        born = [e for e, _ in b._scores.items() if e.fact.relation == u'born']
+        b.add_answer(born[0], True)
+        b.filter_evidence(None)
+        b.learn_fact_extractors(Knowledge())
+        self.assertEqual(b._kept_relations, {u'knows'})
+        result = b.extract_facts({})
+        per_relation = Knowledge(result.items()).per_relation()
+        self.assertEqual(len(per_relation[u'knows']), 2)
+        self.assertTrue(all(s == 0.9 for s in per_relation[u'knows'].values()))
+        self.assertTrue(all(s == 0.5 for s in per_relation[u'born'].values()))
+        self.assertEqual(extractor.predictor.predict_proba.call_count, 1)
+
+    def test_full_iteration_learns_facts(self):
+        b = self.build_pipeline([])
+        b.extractor_config['features'] = [bag_of_words, entity_order, number_of_tokens]
+        born = [f for f, _, _, _ in b.knowledge if f.relation == u'born'][0]
+        seed = self.build_segment([u'person', u'location'])
+        seed.tokens = [u'Peter', u'Paris']
+        seed.entities[0].key, seed.entities[1].key = born.e1.key, born.e2.key
+        other = self.build_segment([u'person', u'location'])
+        other.tokens = [u'Mary', u'Rome']
+        segments = [seed, other]
+        manager = b.db_con.segments
+        manager.segments_with_kind_pairs.return_value = segments
+        manager.segments_by_id.side_effect = lambda ids, fields=None: dict(
+            (s.id, s) for s in segments if s.id in ids)
+        manager.segment_ids_with_entity_pairs.side_effect = lambda pairs: [
+            [seed.id] if (e1, e2) == (born.e1, born.e2) else [] for e1, e2 in pairs]
+        b.start()
+        first, = b.questions_available()
+        self.assertEqual(first[0].segment, seed)
+        b.add_answer(first[0], True)
+        b.add_answer(build_evidence(other, 0, 1, u'born'), False)
+        # filter_evidence -> ... -> filter_facts -> generate_questions
+        b.force_process()
+        learnt = [e for e, _ in b.known_facts().items() if e.segment is not None]
+        self.assertEqual([(e.segment, e.o1, e.o2) for e in learnt], [(seed, 0, 1)])
+
+    def test_incremental_mode_updates_extractors_with_new_evidence(self):
+        b = self.build_pipeline([])
+        b.incremental = True
+        b._scores = EvidenceStore(b.db_con.segments)
+        old = EvidenceFactory(fact__relation=u'born')
+        new = EvidenceFactory(fact__relation=u'born')
+        extractor = mock.MagicMock()
+        extractor.supports_partial_fit.return_value = True
+        b.extractors = {u'born': extractor}
+        b._training = {u'born': Knowledge({old: True})}
+        b.add_answer(new, False)
+        b.filter_evidence(None)
+        classifiers = b.learn_fact_extractors(Knowledge({old: True, new: False}))
+        self.assertIs(classifiers[u'born'], extractor)
+        extractor.partial_fit.assert_called_once_with(Knowledge({new: False}))
+
+
+class TestAsynchronousPipeline(unittest.TestCase):
+
+    def build_pipeline(self):
+        seeds = [FactFactory(e1__kind=u'person', e2__kind=u'location', relation=u'born')]
+        b = BootstrappedIEPipeline(mock.MagicMock(), seeds)
+        b.asynchronous = True
+        return b
+
+    def test_questions_available_has_a_version(self):
+        b = self.build_pipeline()
+        questions = b.questions_available()
+        self.assertIsInstance(questions, Questions)
+        self.assertEqual(questions, [])
+        self.assertEqual(questions.version, 0)
+
+    def test_force_process_does_not_block(self):
+        b = self.build_pipeline()
+        started = threading.Event()
+        release = threading.Event()
+
+        def iteration(_):
+            started.set()
+            release.wait()
+            b.generate_questions(EvidenceStore(b.db_con.segments))
+        b.do_iteration = iteration
+        b.force_process()
+        started.wait()
+        self.assertTrue(b.is_processing())
+        self.assertEqual(b.questions_available().version, 0)
+        release.set()
+        b.wait()
+        self.assertFalse(b.is_processing())
+        self.assertEqual(b.questions_available().version, 1)
+
+    def test_force_process_while_processing_runs_again(self):
+        b = self.build_pipeline()
+        release = threading.Event()
+        calls = []
+
+        def iteration(_):
+            calls.append(None)
+            release.wait()
+        b.do_iteration = iteration
+        b.force_process()
+        b.force_process()
+        b.force_process()
+        release.set()
+        b.wait()
+        self.assertEqual(len(calls), 2)
+
+    def test_filter_facts_does_not_change_known_facts_being_read(self):
+        b = self.build_pipeline()
+        b.fact_threshold = 0.5
+        known = b.known_facts()
+        seeds = dict(known)
+        new = EvidenceFactory(fact__relation=u'born')
+        b.filter_facts(Knowledge({new: 0.9}))
+        self.assertEqual(known, seeds)
+        self.assertIn(new, b.known_facts())
+
+    def test_errors_are_raised_on_wait(self):
+        b = self.build_pipeline()
+        b.do_iteration = mock.Mock(side_effect=ValueError)
+        b.force_process()
+        with self.assertRaises(ValueError):
+            b.wait()
+        self.assertFalse(b.is_processing())
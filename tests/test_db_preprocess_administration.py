@@ -4,9 +4,10 @@ try:
 except ImportError:
     import mock
 
-from iepy.db import DocumentManager, TextSegmentManager
+from iepy.db import (DocumentManager, TextSegmentManager, MissingSegmentIndexes,
+                     CANDIDATE_FIELDS, FEATURE_FIELDS)
 from iepy.models import (PreProcessSteps, InvalidPreprocessSteps,
-                         EntityInSegment, Entity)
+                         EntityInSegment, Entity, EntityPairIndex, TextSegment)
 
 from .factories import IEDocFactory, SentencedIEDocFactory, TextSegmentFactory, naive_tkn
 from .manager_case import ManagerTestCase
@@ -249,12 +250,74 @@ class TestSegmentFilters(ManagerTestCase):
 
     def test_both_entities(self):
         # Request for entities A and B, only Segment 2 should be returned
-        ea = Entity(key="A")
-        eb = Entity(key="B")
+        ea = Entity(key="A", kind="person")
+        eb = Entity(key="B", kind="location")
         segments = self.manager.segments_with_both_entities(ea, eb)
         self.assertEqual(len(segments), 1)
         self.assertEqual(segments[0], self.s2)
 
+    def test_both_entities_checks_kinds(self):
+        ea = Entity(key="A", kind="person")
+        eb = Entity(key="B", kind="person")
+        self.assertEqual(self.manager.segments_with_both_entities(ea, eb), [])
+
+    def test_both_entities_in_bulk(self):
+        a = Entity(key="A", kind="person")
+        b = Entity(key="B", kind="location")
+        c = Entity(key="C", kind="location")
+        result = self.manager.segment_ids_with_entity_pairs([(b, a), (a, c), (b, b)])
+        self.assertEqual(result, [[self.s2.id], [], [self.s3.id]])
+
+    def test_pair_index_is_updated_on_save(self):
+        self.s2.entities.pop()
+        self.s2.save()
+        ea = Entity(key="A", kind="person")
+        eb = Entity(key="B", kind="location")
+        self.assertEqual(self.manager.segments_with_both_entities(ea, eb), [])
+
+    def test_pair_index_has_a_document_per_segment(self):
+        self.s2.save()
+        index = EntityPairIndex.objects(segment=self.s2.id)
+        self.assertEqual([(e.key_a, e.key_b) for e in index], [("B", "A")])
+        self.s1.entities.append(self.s2.entities[1])
+        self.s1.save()
+        self.assertEqual(EntityPairIndex.objects(key_a="B", key_b="A").count(), 2)
+
+    def test_pair_index_is_kept_if_entities_did_not_change(self):
+        self.s2.text = u"Other text"
+        with mock.patch.object(EntityPairIndex, 'add_segments') as add_segments:
+            self.s2.save()
+        self.assertFalse(add_segments.called)
+
+    def test_empty_pair_index_raises(self):
+        EntityPairIndex.drop_collection()
+        ea = Entity(key="A", kind="person")
+        eb = Entity(key="B", kind="location")
+        with self.assertRaises(MissingSegmentIndexes):
+            self.manager.segments_with_both_entities(ea, eb)
+
+    def test_segments_with_only_some_fields(self):
+        segments = self.manager.segments_by_id([self.s2.id], fields=CANDIDATE_FIELDS)
+        segment = segments[self.s2.id]
+        self.assertEqual(segment.entities, self.s2.entities)
+        self.assertEqual(segment.tokens, [])
+        segment, = self.manager.segments_with_kind_pairs([("person", "location")],
+                                                         fields=FEATURE_FIELDS)
+        self.assertEqual(segment.tokens, self.s2.tokens)
+        self.assertIsNone(segment.text)
+
+    def test_rebuild_segment_indexes(self):
+        EntityPairIndex.drop_collection()
+        TextSegment.objects.update(unset__kind_pairs=True)
+        with self.assertRaises(MissingSegmentIndexes):
+            self.manager.segments_with_both_kinds("location", "location")
+        self.manager.rebuild_segment_indexes()
+        ea = Entity(key="A", kind="person")
+        eb = Entity(key="B", kind="location")
+        self.assertEqual(self.manager.segments_with_both_entities(ea, eb), [self.s2])
+        segments = self.manager.segments_with_both_kinds("location", "location")
+        self.assertEqual(list(segments), [self.s3])
+
     def test_both_kinds(self):
         # Request for kinds person+location, only Segment 2 should be returned
         segments = self.manager.segments_with_both_kinds("person", "location")
@@ -268,3 +331,18 @@ class TestSegmentFilters(ManagerTestCase):
         segments = self.manager.segments_with_both_kinds("location", "location")
         self.assertEqual(len(segments), 1)
         self.assertEqual(segments[0], self.s3)
+
+    def test_segments_with_kind_pairs(self):
+        pairs = [("location", "location"), ("location", "person")]
+        ids = self.manager.segment_ids_with_kind_pairs(pairs)
+        self.assertEqual(sorted(ids), sorted([self.s2.id, self.s3.id]))
+        segment, = self.manager.segments_with_kind_pairs([("person", "location")],
+                                                         fields=CANDIDATE_FIELDS)
+        self.assertEqual(segment.id, self.s2.id)
+        TextSegment.objects(id=self.s3.id).update(unset__kind_pairs=True)
+        with self.assertRaises(MissingSegmentIndexes):
+            self.manager.segment_ids_with_kind_pairs(pairs)
+
+    def test_both_kinds_is_a_lazy_query(self):
+        segments = self.manager.segments_with_both_kinds("location", "person")
+        self.assertEqual(list(segments.scalar('id')), [self.s2.id])
@@ -0,0 +1,40 @@
+import unittest
+
+from iepy.db import EntityCache
+
+
+class TestEntityCache(unittest.TestCase):
+
+    def test_hits_and_misses_are_counted(self):
+        cache = EntityCache(10)
+        self.assertIsNone(cache.get((u'person', u'A')))
+        cache.put((u'person', u'A'), u'entity A')
+        self.assertEqual(cache.get((u'person', u'A')), u'entity A')
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = EntityCache(2)
+        cache.put(u'a', 1)
+        cache.put(u'b', 2)
+        cache.get(u'a')
+        cache.put(u'c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(u'b'))
+        self.assertEqual(cache.get(u'a'), 1)
+        self.assertEqual(cache.get(u'c'), 3)
+
+    def test_resize_evicts(self):
+        cache = EntityCache(3)
+        for i, k in enumerate(u'abc'):
+            cache.put(k, i)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(u'c'), 2)
+
+    def test_clear(self):
+        cache = EntityCache(3)
+        cache.put(u'a', 1)
+        cache.get(u'a')
+        cache.clear()
+        self.assertEqual(cache.info(), {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 3})
@@ -0,0 +1,131 @@
+import pickle
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from mongoengine.base import ValidationError
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from iepy import db
+from iepy.db import EntityRegistry
+from iepy.models import Entity
+
+from .factories import EntityFactory
+from .manager_case import ManagerTestCase
+
+
+class TestEntityRegistry(ManagerTestCase):
+    ManagerClass = Entity
+
+    def test_missing_entities_are_created(self):
+        registry = EntityRegistry()
+        entities = registry.resolve([(u'Rami Eid', u'person', u'Rami Eid'),
+                                     (u'NY', u'location', u'New York')])
+        self.assertEqual(Entity.objects.count(), 2)
+        ny = Entity.objects.get(key=u'NY', kind=u'location')
+        self.assertEqual(entities[1].id, ny.id)
+        self.assertEqual(ny.canonical_form, u'New York')
+
+    def test_existing_entities_are_reused(self):
+        existing = EntityFactory(key=u'NY', kind=u'location')
+        existing.save()
+        registry = EntityRegistry()
+        entity, = registry.resolve([(u'NY', u'location', u'NY')])
+        self.assertEqual(entity.id, existing.id)
+        self.assertEqual(Entity.objects.count(), 1)
+
+    def test_same_key_different_kind(self):
+        registry = EntityRegistry()
+        a, b = registry.resolve([(u'Washington', u'person', u'Washington'),
+                                 (u'Washington', u'location', u'Washington')])
+        self.assertNotEqual(a.id, b.id)
+        self.assertEqual(Entity.objects.count(), 2)
+
+    def test_kinds_are_validated(self):
+        registry = EntityRegistry()
+        with self.assertRaises(ValidationError):
+            registry.resolve([(u'NY', u'not a kind', u'NY')])
+        self.assertEqual(Entity.objects.count(), 0)
+
+    def test_entities_created_meanwhile_are_fetched(self):
+        existing = EntityFactory(key=u'NY', kind=u'location')
+        existing.save()
+        registry = EntityRegistry()
+        collection = mock.MagicMock()
+        collection.insert.side_effect = DuplicateKeyError('E11000', 11000)
+        fetch = registry._fetch
+        calls = []
+
+        def late_fetch(keys):
+            # The entity is not found at first, as if it was created right after
+            calls.append(keys)
+            if len(calls) > 1:
+                return fetch(keys)
+            return {}
+        with mock.patch.object(registry, '_fetch', side_effect=late_fetch), \
+                mock.patch.object(Entity, '_get_collection', return_value=collection):
+            entity, = registry.resolve([(u'NY', u'location', u'NY')])
+        self.assertEqual(entity.id, existing.id)
+
+    def test_other_write_errors_are_raised(self):
+        registry = EntityRegistry()
+        collection = mock.MagicMock()
+        collection.insert.side_effect = OperationFailure('failed', 121)
+        with mock.patch.object(Entity, '_get_collection', return_value=collection):
+            with self.assertRaises(OperationFailure):
+                registry.resolve([(u'NY', u'location', u'NY')])
+
+    def test_cached_entities_take_no_queries(self):
+        registry = EntityRegistry()
+        registry.resolve([(u'NY', u'location', u'NY')])
+        with mock.patch.object(Entity, 'objects') as mock_objects:
+            entity, = registry.resolve([(u'NY', u'location', u'NY')])
+        self.assertFalse(mock_objects.called)
+        self.assertEqual(entity.key, u'NY')
+
+    def test_warm_up(self):
+        for key in [u'A', u'B']:
+            EntityFactory(key=key, kind=u'person').save()
+        EntityFactory(key=u'C', kind=u'location').save()
+        registry = EntityRegistry()
+        registry.warm_up(kinds=[u'person'])
+        self.assertEqual(len(registry), 2)
+
+    def test_pickled_registries_start_empty(self):
+        registry = EntityRegistry(maxsize=2)
+        registry.resolve([(u'NY', u'location', u'NY')])
+        copy = pickle.loads(pickle.dumps(registry, protocol=2))
+        self.assertEqual(len(copy), 0)
+        self.assertEqual(copy._cache.maxsize, 2)
+        entity, = copy.resolve([(u'NY', u'location', u'NY')])
+        self.assertEqual(entity.key, u'NY')
+
+    def test_cache_is_bounded(self):
+        registry = EntityRegistry(maxsize=2)
+        entities = registry.resolve([(k, u'person', k) for k in [u'A', u'B', u'C']])
+        self.assertEqual([e.key for e in entities], [u'A', u'B', u'C'])
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(Entity.objects.count(), 3)
+
+
+class TestGetEntities(ManagerTestCase):
+    ManagerClass = Entity
+
+    def setUp(self):
+        super(TestGetEntities, self).setUp()
+        db.entity_cache.clear()
+        self.addCleanup(db.entity_cache.clear)
+
+    def test_entities_are_fetched_in_bulk_and_cached(self):
+        for key, kind in [(u'A', u'person'), (u'A', u'location'), (u'B', u'person')]:
+            EntityFactory(key=key, kind=kind).save()
+        keys = [(u'person', u'A'), (u'person', u'B'), (u'person', u'missing')]
+        result = db.get_entities(keys)
+        self.assertEqual(sorted(result), keys[:2])
+        self.assertEqual(result[(u'person', u'A')].kind, u'person')
+        with mock.patch.object(Entity, 'objects') as mock_objects:
+            entity = db.get_entity(u'person', u'B')
+        self.assertFalse(mock_objects.called)
+        self.assertEqual(entity.key, u'B')
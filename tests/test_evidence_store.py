@@ -0,0 +1,158 @@
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+import unittest
+
+from bson.objectid import ObjectId
+import numpy
+
+from iepy.core import Fact, Knowledge
+from iepy.evidence_store import CertaintyRanking, EvidenceStore, sorted_top
+from .factories import EntityFactory, EntityInSegmentFactory, TextSegmentFactory
+
+
+class TestEvidenceStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEvidenceStore, self).setUp()
+        patcher = mock.patch('iepy.db.get_entity')
+        self.mock_get_entity = patcher.start()
+        self.mock_get_entity.side_effect = lambda kind, key: EntityFactory(kind=kind, key=key)
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('iepy.db.get_entities')
+        self.mock_get_entities = patcher.start()
+        self.mock_get_entities.return_value = {}
+        self.addCleanup(patcher.stop)
+        self.segment = TextSegmentFactory(tokens=[u'a', u'b', u'c'], entities=[
+            EntityInSegmentFactory(key=u'A', offset=0, offset_end=1),
+            EntityInSegmentFactory(key=u'B', offset=1, offset_end=2),
+            EntityInSegmentFactory(key=u'C', offset=2, offset_end=3),
+        ])
+        self.segment.id = ObjectId()
+        self.segments = mock.MagicMock()
+        self.segments.segments_by_id.side_effect = lambda ids: {self.segment.id: self.segment}
+        self.store = EvidenceStore(self.segments)
+        sid = self.segment.id
+        A, B, C = [(u'person', x) for x in u'ABC']
+        self.store.add(u'knows', [sid, sid, sid], [0, 0, 1], [1, 2, 2],
+                       [A, A, B], [B, C, C], [0.1, 0.995, 0.7])
+        self.store.add(u'likes', [sid, sid], [2, 1], [0, 0], [C, B], [A, A], [0.999, None])
+
+    def rows(self, store):
+        return [(r, o1, o2, s) for _, o1, o2, r, s in store.compact_items()]
+
+    def test_keeps_compact_keys(self):
+        self.assertEqual(len(self.store), 5)
+        sid = self.segment.id
+        self.assertEqual(list(self.store.compact_items()), [
+            (sid, 0, 1, u'knows', 0.1),
+            (sid, 0, 2, u'knows', 0.995),
+            (sid, 1, 2, u'knows', 0.7),
+            (sid, 2, 0, u'likes', 0.999),
+            (sid, 1, 0, u'likes', None),
+        ])
+        self.assertFalse(self.segments.segments_by_id.called)
+
+    def test_items_are_evidence(self):
+        items = list(self.store.items())
+        self.assertEqual(len(items), 5)
+        e, s = items[1]
+        self.assertEqual(e.segment, self.segment)
+        self.assertEqual((e.o1, e.o2, s), (0, 2, 0.995))
+        self.assertEqual((e.fact.e1.key, e.fact.relation, e.fact.e2.key),
+                         (u'A', u'knows', u'C'))
+        self.assertEqual(self.segments.segments_by_id.call_count, 1)
+
+    def test_above(self):
+        self.assertEqual(self.rows(self.store.above(0.99)),
+                         [(u'knows', 0, 2, 0.995), (u'likes', 2, 0, 0.999)])
+
+    def test_certain(self):
+        self.assertEqual(self.rows(self.store.certain(0.8)),
+                         [(u'knows', 0, 1, 0.1), (u'knows', 0, 2, 0.995),
+                          (u'likes', 2, 0, 0.999)])
+
+    def test_by_certainty_same_as_knowledge(self):
+        result = [(e.fact.relation, e.o1, e.o2, s) for e, s in self.store.by_certainty()]
+        self.assertEqual(result, [(u'likes', 2, 0, 0.999), (u'knows', 0, 2, 0.995),
+                                  (u'knows', 0, 1, 0.1), (u'knows', 1, 2, 0.7),
+                                  (u'likes', 1, 0, None)])
+
+    def test_per_relation(self):
+        groups = self.store.per_relation()
+        self.assertEqual(sorted(groups), [u'knows', u'likes'])
+        self.assertEqual(self.rows(groups[u'likes']),
+                         [(u'likes', 2, 0, 0.999), (u'likes', 1, 0, None)])
+        self.assertEqual(len(groups[u'knows']), 3)
+
+    def test_matching_facts(self):
+        fact = Fact(EntityFactory(key=u'B'), u'knows', EntityFactory(key=u'C'))
+        unknown = Fact(EntityFactory(key=u'Z'), u'knows', EntityFactory(key=u'C'))
+        store = self.store.matching_facts([fact, unknown])
+        self.assertEqual(self.rows(store), [(u'knows', 1, 2, 0.7)])
+
+    def test_without(self):
+        answered = dict(list(self.store.items())[:2])
+        store = self.store.without(Knowledge(answered))
+        self.assertEqual(self.rows(store), [(u'knows', 1, 2, 0.7),
+                                            (u'likes', 2, 0, 0.999),
+                                            (u'likes', 1, 0, None)])
+
+    def test_by_certainty_top_n(self):
+        result = [(e.fact.relation, e.o1, e.o2) for e, s in self.store.by_certainty(2)]
+        self.assertEqual(result, [(u'likes', 2, 0), (u'knows', 0, 2)])
+
+    def test_row_of(self):
+        items = list(self.store.items())
+        self.assertEqual([self.store.row_of(e) for e, _ in items], list(range(5)))
+
+    def test_row_of_evidence_added_later(self):
+        first, _ = next(self.store.items())
+        self.assertEqual(self.store.row_of(first), 0)
+        sid = self.segment.id
+        self.store.add(u'hates', [sid], [1], [2], [(u'person', u'B')],
+                       [(u'person', u'C')], [0.5])
+        last, _ = list(self.store.items())[-1]
+        self.assertEqual(self.store.row_of(last), 5)
+
+
+class TestSortedTop(unittest.TestCase):
+
+    def test_same_as_stable_full_sort(self):
+        rng = numpy.random.RandomState(42)
+        key = rng.randint(0, 20, size=500).astype(float)
+        full = list(numpy.argsort(-key, kind='mergesort'))
+        for n in [0, 1, 7, 20, 499, 500, 501]:
+            self.assertEqual(list(sorted_top(key, n)), full[:n])
+        self.assertEqual(list(sorted_top(key)), full)
+
+
+class TestCertaintyRanking(unittest.TestCase):
+
+    def build_ranking(self, scores, page_size=3):
+        store = EvidenceStore(mock.MagicMock())
+        n = len(scores)
+        store.add(u'rel', [ObjectId() for _ in scores], range(n), range(n),
+                  [(u'person', u'A')] * n, [(u'person', u'B')] * n, scores)
+        ranking = CertaintyRanking(store)
+        ranking.page_size = page_size
+        return ranking
+
+    def test_top(self):
+        ranking = self.build_ranking([0.5, 0.9, 0.05, 0.6, 0.99, None, 0.3])
+        self.assertEqual(list(ranking.top(2)), [4, 2])
+        self.assertEqual(list(ranking.top()), [4, 2, 1, 6, 3, 0, 5])
+
+    def test_removed_rows_are_skipped(self):
+        ranking = self.build_ranking([0.5, 0.9, 0.05, 0.6, 0.99, None, 0.3])
+        ranking.top(2)
+        ranking.remove(4)
+        ranking.remove(1)
+        self.assertEqual(list(ranking.top(4)), [2, 6, 3, 0])
+        self.assertEqual(len(ranking), 5)
+
+    def test_only_needed_rows_are_sorted(self):
+        ranking = self.build_ranking([0.1 * i for i in range(10)], page_size=2)
+        self.assertEqual(list(ranking.top(1)), [0])
+        self.assertEqual(int((~ranking._unranked).sum()), 2)
@@ -27,9 +27,11 @@ from iepy.fact_extractor import (bag_of_words,
                                  verbs_count,
                                  symbols_in_between,
                                  BagOfVerbStems,
-                                 BagOfVerbLemmas
+                                 BagOfVerbLemmas,
+                                 number_of_tokens,
                                  )
-from iepy.fact_extractor import ColumnFilter
+from iepy.fact_extractor import ColumnFilter, FactExtractor
+from iepy.core import Knowledge
 
 
 def _e(markup, **kwargs):
@@ -440,3 +442,30 @@ class TestColumnFilter(TestCase):
         cf = ColumnFilter(6)
         with self.assertRaises(ValueError):
             cf.fit(self.X)
+
+
+class TestPartialFit(TestCase):
+
+    def build(self, classifier):
+        config = {"classifier": classifier, "features": [number_of_tokens]}
+        k = Knowledge()
+        k[_e(u"{Peter|person*} likes {Sarah|person**}")] = True
+        k[_e(u"{Mary|person*} says hi to {John|person**} .")] = False
+        extractor = FactExtractor(config)
+        extractor.fit(k)
+        return extractor
+
+    def test_supported_classifiers(self):
+        self.assertTrue(self.build("sgd").supports_partial_fit())
+        self.assertTrue(self.build("naivebayes_m").supports_partial_fit())
+        self.assertFalse(self.build("dtree").supports_partial_fit())
+
+    def test_partial_fit_updates_the_classifier(self):
+        extractor = self.build("naivebayes_m")
+        classifier = extractor.predictor.steps[-1][1]
+        counts = classifier.class_count_.copy()
+        k = Knowledge()
+        k[_e(u"{Peter|person*} and {Sarah|person**} are friends")] = True
+        extractor.partial_fit(k)
+        self.assertIs(extractor.predictor.steps[-1][1], classifier)
+        self.assertEqual(list(classifier.class_count_ - counts), [0, 1])
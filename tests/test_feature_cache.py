@@ -0,0 +1,155 @@
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from unittest import TestCase
+
+from bson.objectid import ObjectId
+
+from featureforge.feature import make_feature
+
+from iepy.fact_extractor import (FactExtractor, bag_of_words, number_of_tokens,
+                                 entity_distance, BagOfVerbStems)
+from iepy.feature_cache import (FeatureCache, evidence_key, feature_id,
+                                features_hash, evaluate_features,
+                                is_segment_feature, segment_feature)
+from iepy.core import Knowledge
+from iepy.models import EvidenceFeatures
+from .factories import EvidenceFactory
+from .manager_case import ManagerTestCase
+
+
+def _e(markup, saved=True):
+    evidence = EvidenceFactory(markup=markup)
+    if saved:
+        evidence.segment.id = ObjectId()
+    return evidence
+
+
+class TestFeaturesHash(TestCase):
+
+    def test_same_features_same_hash(self):
+        self.assertEqual(features_hash([bag_of_words, number_of_tokens]),
+                         features_hash([bag_of_words, number_of_tokens]))
+
+    def test_different_features_different_hash(self):
+        self.assertNotEqual(features_hash([bag_of_words, number_of_tokens]),
+                            features_hash([bag_of_words]))
+
+    def test_lambdas_do_not_collide(self):
+        a, b = lambda e: 1, lambda e: len(e.segment.tokens)
+        self.assertNotEqual(feature_id(a), feature_id(b))
+        self.assertNotEqual(feature_id(make_feature(a)),
+                            feature_id(make_feature(b)))
+        self.assertEqual(feature_id(bag_of_words),
+                         feature_id(make_feature(bag_of_words)))
+
+    def test_parametrized_features_do_not_collide(self):
+        self.assertNotEqual(feature_id(BagOfVerbStems(in_between=True)),
+                            feature_id(BagOfVerbStems(in_between=False)))
+
+
+class TestSegmentFeatures(TestCase):
+
+    def test_segment_features_are_flagged(self):
+        self.assertTrue(is_segment_feature(bag_of_words))
+        self.assertTrue(is_segment_feature(make_feature(number_of_tokens)))
+        self.assertTrue(is_segment_feature(BagOfVerbStems(in_between=False)))
+        self.assertFalse(is_segment_feature(BagOfVerbStems(in_between=True)))
+        self.assertFalse(is_segment_feature(make_feature(entity_distance)))
+
+    def test_segment_features_are_evaluated_once_per_segment(self):
+        evidence = _e(u"{Peter|person*} tells {Sarah|person**} about {Mary|person}")
+        pairs = [EvidenceFactory(segment=evidence.segment, o1=i, o2=j)
+                 for i, j in [(0, 1), (1, 0), (0, 2), (2, 1)]]
+        calls = []
+
+        @segment_feature
+        def segment(evidence):
+            calls.append('segment')
+            return len(evidence.segment.tokens)
+
+        def pair(evidence):
+            calls.append('pair')
+            return evidence.o1
+
+        values = evaluate_features([segment, pair], pairs)
+        self.assertEqual(values, [(5, 0), (5, 1), (5, 0), (5, 2)])
+        self.assertEqual(calls.count('segment'), 1)
+        self.assertEqual(calls.count('pair'), 4)
+
+
+class TestFeatureCache(TestCase):
+
+    def setUp(self):
+        self.cache = FeatureCache(persistent=False)
+        self.feature = mock.Mock(side_effect=lambda e: len(e.segment.tokens))
+
+    def test_values_are_evaluated_once(self):
+        evidences = [_e(u"{Peter|person*} likes {Sarah|person**}"),
+                     _e(u"{Mary|person*} says hi to {John|person**} .")]
+        first = self.cache.evaluate('cfg', [self.feature], evidences)
+        second = self.cache.evaluate('cfg', [self.feature], evidences)
+        self.assertEqual(first, [(3,), (6,)])
+        self.assertEqual(first, second)
+        self.assertEqual(self.feature.call_count, 2)
+
+    def test_configs_do_not_share_values(self):
+        evidences = [_e(u"{Peter|person*} likes {Sarah|person**}")]
+        self.cache.evaluate('cfg1', [self.feature], evidences)
+        self.cache.evaluate('cfg2', [self.feature], evidences)
+        self.assertEqual(self.feature.call_count, 2)
+
+    def test_changed_segments_are_evaluated_again(self):
+        evidence = _e(u"{Peter|person*} likes {Sarah|person**}")
+        self.cache.evaluate('cfg', [self.feature], [evidence])
+        evidence.segment.tokens = evidence.segment.tokens + [u'.']
+        values = self.cache.evaluate('cfg', [self.feature], [evidence])
+        self.assertEqual(values, [(4,)])
+        self.assertEqual(self.feature.call_count, 2)
+
+    def test_unsaved_segments_are_not_cached(self):
+        evidence = _e(u"{Peter|person*} likes {Sarah|person**}", saved=False)
+        self.assertIsNone(evidence_key(evidence))
+        self.cache.evaluate('cfg', [self.feature], [evidence])
+        self.cache.evaluate('cfg', [self.feature], [evidence])
+        self.assertEqual(self.feature.call_count, 2)
+
+
+class TestFactExtractorWithCache(TestCase):
+
+    def test_training_twice_evaluates_features_once(self):
+        calls = []
+
+        def feature(evidence):
+            calls.append(evidence)
+            return len(evidence.segment.tokens)
+
+        config = {
+            "classifier": "dtree",
+            "features": [feature],
+            "feature_cache": FeatureCache(persistent=False),
+        }
+        k = Knowledge()
+        k[_e(u"{Peter|person*} likes {Sarah|person**}")] = True
+        k[_e(u"{Mary|person*} says hi to {John|person**} .")] = False
+        FactExtractor(config).fit(k)
+        self.assertEqual(len(calls), 2)
+        extractor = FactExtractor(config)
+        extractor.fit(k)
+        self.assertEqual(len(calls), 2)
+        extractor.predict(list(k))
+        self.assertEqual(len(calls), 2)
+
+
+class TestPersistentFeatureCache(ManagerTestCase):
+    ManagerClass = EvidenceFeatures
+
+    def test_values_stored_twice_are_kept_once(self):
+        evidence = _e(u"{Peter|person*} likes {Sarah|person**}")
+        key = evidence_key(evidence)
+        # As done by two processes evaluating the same evidence
+        FeatureCache().store('cfg', {key: (3,)})
+        FeatureCache().store('cfg', {key: (3,)})
+        self.assertEqual(EvidenceFeatures.objects.count(), 1)
+        self.assertEqual(FeatureCache().lookup('cfg', [key]), {key: (3,)})
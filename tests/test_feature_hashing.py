@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import pickle
+from unittest import TestCase
+
+from bson.objectid import ObjectId
+
+from iepy.fact_extractor import (FactExtractor, bag_of_words,
+                                 bag_of_word_bigrams, entity_distance,
+                                 number_of_tokens)
+from iepy.feature_cache import FeatureCache
+from iepy.feature_hashing import HashingVectorizer
+
+from .factories import EvidenceFactory
+
+FEATURES = [bag_of_words, bag_of_word_bigrams, entity_distance, number_of_tokens]
+
+
+class TestHashingVectorizer(TestCase):
+
+    def setUp(self):
+        self.evidences = [
+            EvidenceFactory(markup=u"{Peter|person*} likes {Sarah|person**}"),
+            EvidenceFactory(markup=u"{Mary|person*} says hi to {John|person**} ."),
+        ]
+
+    def test_fixed_number_of_columns(self):
+        vectorizer = HashingVectorizer(FEATURES, buckets=64)
+        matrix = vectorizer.fit_transform(self.evidences)
+        self.assertEqual(matrix.shape, (2, 64))
+        self.assertEqual(vectorizer.transform(self.evidences[:1]).shape, (1, 64))
+
+    def test_no_fit_needed(self):
+        fitted = HashingVectorizer(FEATURES, buckets=64)
+        fitted.fit(self.evidences[:1])
+        other = HashingVectorizer(FEATURES, buckets=64)
+        self.assertEqual((fitted.transform(self.evidences) !=
+                          other.transform(self.evidences)).nnz, 0)
+
+    def test_hashes_survive_pickling(self):
+        vectorizer = HashingVectorizer(FEATURES, buckets=64)
+        clone = pickle.loads(pickle.dumps(vectorizer))
+        self.assertEqual((vectorizer.transform(self.evidences) !=
+                          clone.transform(self.evidences)).nnz, 0)
+
+    def test_values_are_not_negative(self):
+        vectorizer = HashingVectorizer(FEATURES, buckets=8, non_negative=True)
+        matrix = vectorizer.transform(self.evidences)
+        self.assertTrue((matrix.data > 0).all())
+
+    def test_values_are_hashed_with_sign(self):
+        vectorizer = HashingVectorizer([number_of_tokens], buckets=8)
+        matrix = vectorizer.transform(self.evidences)
+        self.assertEqual(sorted(abs(matrix).sum(axis=1).A1), [3.0, 6.0])
+
+    def test_bags_count_each_value(self):
+        vectorizer = HashingVectorizer([bag_of_words], buckets=2 ** 18)
+        matrix = vectorizer.transform(self.evidences)
+        self.assertEqual(abs(matrix[1]).sum(), 6.0)
+
+    def test_feature_cache_is_used(self):
+        cache = FeatureCache(persistent=False)
+        vectorizer = HashingVectorizer(FEATURES, buckets=64, cache=cache)
+        for evidence in self.evidences:
+            evidence.segment.id = ObjectId()
+        vectorizer.transform(self.evidences)
+        self.assertEqual(len(cache._memory[vectorizer.config]), 2)
+
+    def test_fact_extractor_option(self):
+        extractor = FactExtractor({"features": FEATURES, "vectorizer": "hashing",
+                                   "hashing_buckets": 128, "classifier": "sgd"})
+        extractor.fit({self.evidences[0]: True, self.evidences[1]: False})
+        vectorizer = extractor.predictor.steps[0][1]
+        self.assertIsInstance(vectorizer, HashingVectorizer)
+        self.assertEqual(vectorizer.hasher.n_features, 128)
+        self.assertEqual(len(extractor.predict(self.evidences)), 2)
+
+    def test_multinomial_naive_bayes(self):
+        extractor = FactExtractor({"features": FEATURES, "vectorizer": "hashing",
+                                   "hashing_buckets": 128, "hashing_non_negative": True,
+                                   "classifier": "naivebayes_m"})
+        extractor.fit({self.evidences[0]: True, self.evidences[1]: False})
+        self.assertEqual(list(extractor.predict(self.evidences)), [1, 0])
+
+    def test_signed_values_need_a_classifier_that_takes_them(self):
+        config = {"features": FEATURES, "vectorizer": "hashing",
+                  "classifier": "naivebayes_m"}
+        with self.assertRaises(ValueError):
+            FactExtractor(config)
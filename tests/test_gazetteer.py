@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import random
+import tempfile
+from unittest import TestCase
+
+from iepy.gazetteer import Gazetteer, compile_gazetteer
+from iepy.literal_ner import LiteralNER
+from tests.factories import NamedTemporaryFile23
+
+
+class TestGazetteer(TestCase):
+
+    def names_file(self, names):
+        f = NamedTemporaryFile23(mode="w", encoding="utf8")
+        f.write(u'\n'.join(names) + u'\n')
+        f.flush()
+        self.addCleanup(f.close)
+        return f.name
+
+    def compile(self, labels, filenames):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        compile_gazetteer(labels, filenames, path)
+        return path
+
+    def test_same_entities_than_literal_ner(self):
+        files = [self.names_file([u'HIV', u'Hepatitis C', u'brain tumor', u'drooling']),
+                 self.names_file([u'MRI', u'CT scan', u'drooling', u'Ñandú'])]
+        labels = ['DISEASE', 'MEDICAL_TEST']
+        gazetteer = Gazetteer(self.compile(labels, files))
+        literal = LiteralNER(labels, files)
+        for s in [u"Chase notes she's negative for HIV and Hepatitis C",
+                  u"CT scan said HIV MRI Hepatitis C drooling",
+                  u"the Ñandú had a brain scan and a CT",
+                  u""]:
+            self.assertEqual(gazetteer.entities(s.split()), literal.entities(s.split()))
+
+    def test_random_gazetteers(self):
+        rng = random.Random(42)
+        vocabulary = [u'a', u'b', u'c', u'dd', u'eee']
+        for _ in range(20):
+            names = [u' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 4)))
+                     for _ in range(rng.randint(1, 8))]
+            files = [self.names_file(names[::2]), self.names_file(names[1::2])]
+            gazetteer = Gazetteer(self.compile(['X', 'Y'], files))
+            literal = LiteralNER(['X', 'Y'], files)
+            for _ in range(20):
+                sent = [rng.choice(vocabulary + [u'abcdef'])
+                        for _ in range(rng.randint(0, 10))]
+                self.assertEqual(gazetteer.entities(sent), literal.entities(sent))
+
+    def test_pickled_gazetteers_map_the_file_again(self):
+        path = self.compile(['X'], [self.names_file([u'New York'])])
+        data = pickle.dumps(Gazetteer(path))
+        self.assertLess(len(data), 200)
+        gazetteer = pickle.loads(data)
+        self.assertEqual(gazetteer.entities([u'in', u'New', u'York']), [((1, 3), 'X')])
+
+    def test_not_a_gazetteer(self):
+        path = self.names_file([u'HIV'])
+        with self.assertRaises(ValueError):
+            Gazetteer(path)
+
+    def test_vocabulary_is_not_padded(self):
+        long_name = u'x' * 10000
+        names = [long_name] + [u'n%i' % i for i in range(1000)]
+        path = self.compile(['X'], [self.names_file(names)])
+        self.assertLess(os.path.getsize(path), 100000)
+        gazetteer = Gazetteer(path)
+        self.assertEqual(gazetteer.entities([u'n7', long_name]),
+                         [((0, 1), 'X'), ((1, 2), 'X')])
@@ -64,6 +64,25 @@ class TestLiteralNER(TestCase):
                              ((4, 5), 'MEDICAL_TEST'), ((5, 7), 'DISEASE')]
         self.assertEqual(result, expected_entities)
 
+    def test_longest_prefix_must_be_a_name(self):
+        f = NamedTemporaryFile23(mode="w", encoding="utf8")
+        f.write('New York\nNew York City Hall\nYork\n')
+        f.seek(0)
+        tagger = LiteralNER(['LOCATION'], [f.name])
+        result = tagger.entities("New York City Council".split())
+        # "New York City" is not a name, so the match is from "York"
+        self.assertEqual(result, [((1, 2), 'LOCATION')])
+        result = tagger.entities("to New York City Hall".split())
+        self.assertEqual(result, [((1, 5), 'LOCATION')])
+        result = tagger.entities("New York".split())
+        self.assertEqual(result, [((0, 2), 'LOCATION')])
+
+    def test_last_label_is_selected(self):
+        tagger = LiteralNER(NEW_ENTITIES,
+                            [self.tmp_file1.name, self.tmp_file2.name])
+        result = tagger.entities(["drooling"])
+        self.assertEqual(result, [((0, 1), 'MEDICAL_TEST')])
+
 
 class TestLiteralNERRunner(ManagerTestCase):
     ManagerClass = IEDocument
@@ -5,7 +5,18 @@ except ImportError:
 
 from unittest import TestCase
 
-from iepy.preprocess import PreProcessPipeline
+from mongoengine import Document
+
+from iepy.db import EntityRegistry
+from iepy.ner import NERRunner
+from iepy.preprocess import (
+    BaseBatchedPreProcessStepRunner, DocumentWalker, PreProcessPipeline,
+    _init_worker, _process_documents, _worker, tag_in_batches)
+from .factories import IEDocFactory
+
+
+def _no_entities_ner(sentences):
+    return [[(token, 'O') for token in sentence] for sentence in sentences]
 
 
 class TestPreProcessPipeline(TestCase):
@@ -44,7 +55,7 @@ class TestPreProcessPipeline(TestCase):
         runner = mock.Mock(wraps=_runner)
         docs = [object() for i in range(5)]
         p = PreProcessPipeline([runner], docs)
-        p.process_step_in_batch(runner)
+        self.assertEqual(p.process_step_in_batch(runner), [])
         self.assertEqual(runner.call_count, len(docs))
         self.assertEqual(runner.call_args_list, [mock.call(d) for d in docs])
 
@@ -94,3 +105,156 @@ class TestPreProcessPipeline(TestCase):
             self.assertEqual(mock_batch.call_args_list,
                              [mock.call(runner1), mock.call(runner2)])
         self.assertEqual(p.call_order, [runner1, runner2])
+
+
+class TestParallelPreProcessPipeline(TestCase):
+
+    def test_process_documents_isolates_errors(self):
+        def runner(doc):
+            if doc.fail:
+                raise ValueError('broken')
+            doc.processed = True
+        docs = dict((i, mock.Mock(fail=(i == 1))) for i in range(3))
+        documents = mock.MagicMock()
+        documents.documents_by_id.return_value = docs
+        state = {'documents': documents, 'runner': runner}
+        with mock.patch.dict('iepy.preprocess._worker', state):
+            results = _process_documents([0, 1, 2])
+        self.assertEqual(results, [(0, None), (1, 'ValueError: broken'), (2, None)])
+        self.assertTrue(docs[0].processed)
+        self.assertTrue(docs[2].processed)
+
+    def process_in_parallel(self, step_runner, failing=()):
+        """Runs the step with a fake pool, returning the failures and the
+        runner as a worker process gets it"""
+        docs_manager = mock.MagicMock()
+        docs_manager.get_document_ids_lacking_preprocess.return_value = list(range(25))
+        p = PreProcessPipeline([step_runner], docs_manager, processes=4)
+        pool = mock.MagicMock()
+        pool.imap.side_effect = lambda f, chunks: [
+            [(i, 'error' if i in failing else None) for i in chunk] for chunk in chunks]
+        with mock.patch('iepy.preprocess.multiprocessing.Pool', return_value=pool) as mock_pool, \
+                mock.patch('iepy.preprocess.get_db'):
+            failures = p.process_step_in_batch(step_runner)
+        docs_manager.get_document_ids_lacking_preprocess.assert_called_once_with(step_runner.step)
+        self.assertEqual(mock_pool.call_args[0][0], 4)
+        pool.join.assert_called_once_with()
+        initializer, initargs = mock_pool.call_args[0][1:]
+        self.assertIs(initializer, _init_worker)
+        with mock.patch.dict('iepy.preprocess._worker'), \
+                mock.patch('iepy.preprocess.disconnect'), \
+                mock.patch('iepy.db.connect'):
+            _init_worker(*initargs)
+            return failures, _worker['runner']
+
+    def test_process_step_in_parallel_hands_out_document_ids(self):
+        step_runner = NERRunner(_no_entities_ner)
+        failures, _ = self.process_in_parallel(step_runner, failing=[12])
+        self.assertEqual(failures, [(12, 'error')])
+
+    def test_runners_with_entity_registries_are_sent_to_workers(self):
+        registry = EntityRegistry(maxsize=7)
+        registry._cache.put((u'person', u'A'), mock.sentinel.entity)
+        _, runner = self.process_in_parallel(NERRunner(_no_entities_ner, entities=registry))
+        self.assertIsInstance(runner, NERRunner)
+        self.assertIs(runner.ner, _no_entities_ner)
+        # Cached entities are left behind
+        self.assertEqual(len(runner.entities), 0)
+        self.assertEqual(runner.entities._cache.maxsize, 7)
+
+
+class TestStreamingPreProcessPipeline(TestCase):
+
+    def test_process_streaming_walks_each_document_through_all_runners(self):
+        calls = []
+        runner1 = mock.Mock(side_effect=lambda d: calls.append((d, 1)))
+        runner2 = mock.Mock(side_effect=lambda d: calls.append((d, 2)))
+        docs = [mock.MagicMock() for i in range(3)]
+        p = PreProcessPipeline([runner1, runner2], docs)
+        p.process_streaming()
+        self.assertEqual(calls, [(d, i) for d in docs for i in (1, 2)])
+        for d in docs:
+            d.postponed_saves.assert_called_once_with()
+
+    def test_process_streaming_only_reads_documents_lacking_some_step(self):
+        runner1 = mock.MagicMock(step='step1', override=False)
+        runner2 = mock.MagicMock(step='step2', override=False)
+        docs_manager = mock.MagicMock()
+        docs_manager.get_documents_lacking_any_preprocess.return_value = []
+        p = PreProcessPipeline([runner1, runner2], docs_manager)
+        p.process_streaming()
+        docs_manager.get_documents_lacking_any_preprocess.assert_called_once_with(
+            ['step1', 'step2'])
+        self.assertFalse(docs_manager.__iter__.called)
+
+    def test_document_walker_saves_once(self):
+        def runner(doc):
+            doc.tokens = [u'hello']
+            doc.save()
+        doc = IEDocFactory()
+        with mock.patch.object(Document, 'save') as mock_save:
+            DocumentWalker([runner, runner])(doc)
+        self.assertEqual(mock_save.call_count, 1)
+        self.assertEqual(doc.tokens, [u'hello'])
+
+    def test_document_walker_does_not_save_on_errors(self):
+        def runner(doc):
+            doc.save()
+            raise ValueError
+        doc = IEDocFactory()
+        with mock.patch.object(Document, 'save') as mock_save:
+            with self.assertRaises(ValueError):
+                DocumentWalker([runner])(doc)
+        self.assertFalse(mock_save.called)
+
+
+class TestTagInBatches(TestCase):
+
+    def build_doc(self, *sentences):
+        doc = mock.MagicMock()
+        doc.get_sentences.return_value = iter([list(s) for s in sentences])
+        return doc
+
+    def tagger(self, sentences):
+        self.calls.append(len(sentences))
+        return [[(t, t.upper()) for t in s] for s in sentences]
+
+    def setUp(self):
+        self.calls = []
+
+    def test_sentences_of_many_documents_are_tagged_together(self):
+        docs = [self.build_doc('ab', 'c'), self.build_doc('d'), self.build_doc('ef')]
+        result = list(tag_in_batches(docs, self.tagger, lambda d: True, 100, 100))
+        self.assertEqual(self.calls, [4])
+        self.assertEqual([d for d, _ in result], docs)
+        self.assertEqual(result[0][1], [[('a', 'A'), ('b', 'B')], [('c', 'C')]])
+        self.assertEqual(result[1][1], [[('d', 'D')]])
+        self.assertEqual(result[2][1], [[('e', 'E'), ('f', 'F')]])
+
+    def test_budgets_are_respected(self):
+        docs = [self.build_doc('ab', 'c'), self.build_doc('d'), self.build_doc('ef')]
+        list(tag_in_batches(docs, self.tagger, lambda d: True, 2, 100))
+        self.assertEqual(self.calls, [2, 2])
+        self.calls = []
+        docs = [self.build_doc('ab', 'c'), self.build_doc('d'), self.build_doc('ef')]
+        list(tag_in_batches(docs, self.tagger, lambda d: True, 100, 4))
+        self.assertEqual(self.calls, [3, 1])
+
+    def test_unwanted_documents_are_not_tagged(self):
+        docs = [self.build_doc('ab'), self.build_doc('c'), self.build_doc('d')]
+        wanted = lambda d: d is not docs[1]
+        result = list(tag_in_batches(docs, self.tagger, wanted, 100, 100))
+        self.assertEqual(self.calls, [2])
+        self.assertEqual([d for d, _ in result], docs)
+        self.assertIsNone(result[1][1])
+        self.assertFalse(docs[1].get_sentences.called)
+
+    def test_batched_runners_get_all_the_documents(self):
+        runner = mock.MagicMock(spec=BaseBatchedPreProcessStepRunner)
+        runner.process_documents.side_effect = lambda docs: iter(docs)
+        docs = [object() for i in range(5)]
+        p = PreProcessPipeline([runner], docs)
+        del runner.step
+        p.process_step_in_batch(runner)
+        runner.process_documents.assert_called_once_with(docs)
+        self.assertFalse(runner.called)
@@ -1,8 +1,17 @@
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 import unittest
 
-from .factories import IEDocFactory, EntityFactory, TextSegmentFactory
+from mongoengine.queryset import QuerySet
+
+from .factories import IEDocFactory, EntityFactory, EntityInSegmentFactory, TextSegmentFactory
 from .manager_case import ManagerTestCase
-from iepy.models import TextSegment, EntityInSegment, EntityOccurrence
+from iepy.db import TextSegmentManager
+from iepy.segmenter import store_token_ids
+from iepy.models import (TextSegment, EntityInSegment, EntityOccurrence, EntityPairIndex,
+                         IEDocument, PreProcessSteps)
 
 
 class TextSegmentTest(unittest.TestCase):
@@ -32,6 +41,19 @@ class TextSegmentTest(unittest.TestCase):
         self.assertEqual(c.entities, [])
         self.assertEqual(c.text, "CDE")
 
+    def test_compact_segments_do_not_copy_tokens(self):
+        d = self.d
+        d.offsets = range(7)
+        d.tokens = list("ABCDEFG")
+        d.postags = list("NNVANVA")
+        d.text = "ABCDEFG"
+        c = TextSegment.build(d, 2, 5, compact=True)
+        self.assertTrue(c.compact)
+        self.assertEqual((c.offset, c.offset_end), (2, 5))
+        self.assertEqual(c.tokens, [])
+        self.assertEqual(c.postags, [])
+        self.assertEqual(c.text, "CDE")
+
     def test_entities_captured(self):
         e1 = EntityFactory()
         e2 = EntityFactory(kind='location')
@@ -140,6 +162,15 @@ class TextSegmentTest(unittest.TestCase):
         ps = s.entity_occurrence_pairs(e1, e1)
         self.assertEqual(ps, [(0, 1), (1, 0)])
 
+    def test_kind_pairs(self):
+        s = TextSegment(entities=[
+            EntityInSegmentFactory(kind=u'person'),
+            EntityInSegmentFactory(kind=u'location'),
+            EntityInSegmentFactory(kind=u'person'),
+        ])
+        s.update_kind_pairs()
+        self.assertEqual(s.kind_pairs, [u'location|person', u'person|person'])
+
     def test_kind_occurrence_pairs(self):
         e1 = EntityFactory(kind='person')
         e2 = EntityFactory(kind='location')
@@ -285,5 +316,93 @@ class TestDocumentSegmenter(ManagerTestCase):
         self.assertEqual(len(s.tokens), 20)
         self.assertEqual(len(s.entities), 2)
 
+    def test_segments_are_inserted_in_batches(self):
+        self.set_doc_length(100)
+        self.add_entities([1, 2, 22, 23, 61, 80])
+        self.doc.sentences = [0, 20, 50]
+        insert = QuerySet.insert
+        with mock.patch.object(QuerySet, 'insert', autospec=True,
+                               side_effect=insert) as mock_insert:
+            self.doc.build_syntactic_segments(batch_size=2)
+        sizes = [len(args[1]) for args, _ in mock_insert.call_args_list]
+        self.assertEqual(sizes, [2, 1])
+        self.assertEqual(len(TextSegment.objects), 3)
 
-
+    def test_pair_index_gets_the_ids_of_inserted_segments(self):
+        self.set_doc_length(100)
+        self.add_entities([1, 2, 22, 23, 61, 80])
+        self.doc.sentences = [0, 20, 50]
+        insert = QuerySet.insert
+
+        def old_insert(queryset, docs, **kwargs):
+            # mongoengine before 0.16 doesn't set the ids of the documents
+            ids = insert(queryset, docs, **kwargs)
+            for doc in docs:
+                doc.id = None
+            return ids
+        with mock.patch.object(QuerySet, 'insert', autospec=True,
+                               side_effect=old_insert):
+            self.doc.build_syntactic_segments(batch_size=2)
+        indexed = set(e.segment for e in EntityPairIndex.objects)
+        self.assertEqual(indexed, set(TextSegment.objects.scalar('id')))
+        self.assertNotIn(None, indexed)
+
+    def test_segments_are_indexed_by_entity_pair(self):
+        self.set_doc_length(100)
+        e1, e2 = EntityFactory(), EntityFactory()
+        self.doc.entities = [
+            EntityOccurrence(entity=e1, offset=1, offset_end=2, alias="A"),
+            EntityOccurrence(entity=e2, offset=3, offset_end=4, alias="B"),
+        ]
+        self.doc.sentences = [0, 50]
+        self.doc.build_syntactic_segments()
+        segment = TextSegment.objects.get()
+        self.assertEqual(TextSegmentManager().segments_with_both_entities(e2, e1), [segment])
+        self.doc.clear_segments()
+        self.assertEqual(TextSegmentManager().segment_ids_with_entity_pairs([(e1, e2)]), [[]])
+
+    def test_compact_segments_are_expanded_when_loaded(self):
+        self.set_doc_length(10)
+        self.doc.tokens = list("ABCDEFGHIJ")
+        self.add_entities([1, 3])
+        self.doc.sentences = [0, 5]
+        store_token_ids(self.doc)
+        self.doc.build_syntactic_segments(compact=True)
+        stored = TextSegment._get_collection().find_one()
+        self.assertEqual(stored.get('tokens', []), [])
+        segments = TextSegmentManager().segments_by_id([stored['_id']])
+        segment = segments[stored['_id']]
+        self.assertEqual(segment.tokens, list("ABCDE"))
+        self.assertEqual(segment.postags, ["tag"] * 5)
+        segment = TextSegmentManager().get_segment(self.doc.human_identifier, 0)
+        self.assertEqual(segment.tokens, list("ABCDE"))
+
+    def test_documents_with_token_ids_do_not_store_strings(self):
+        self.set_doc_length(3)
+        self.doc.tokens = list("ABC")
+        store_token_ids(self.doc)
+        self.assertEqual(self.doc.tokens, list("ABC"))
+        self.doc.save()
+        stored = IEDocument._get_collection().find_one({'_id': self.doc.id})
+        self.assertEqual(stored.get('tokens', []), [])
+        self.assertEqual(stored.get('postags', []), [])
+        doc = IEDocument.objects.get(id=self.doc.id)
+        self.assertEqual(doc.tokens, list("ABC"))
+        self.assertEqual(doc.postags, ["tag"] * 3)
+
+    def test_rerunning_a_step_on_documents_with_token_ids(self):
+        self.set_doc_length(10)
+        self.doc.tokens = list("ABCDEFGHIJ")
+        self.add_entities([1, 3])
+        self.doc.sentences = [0, 5]
+        store_token_ids(self.doc)
+        self.doc.build_syntactic_segments(compact=True)
+        self.doc.save()
+        self.doc.set_preprocess_result(PreProcessSteps.tagging, ["NN"] * 10)
+        self.doc.save()
+        stored = IEDocument._get_collection().find_one({'_id': self.doc.id})
+        self.assertEqual(stored.get('postags', []), [])
+        doc = IEDocument.objects.get(id=self.doc.id)
+        self.assertEqual(doc.postags, ["NN"] * 10)
+        segment = TextSegmentManager().get_segment(self.doc.human_identifier, 0)
+        self.assertEqual(segment.postags, ["NN"] * 5)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from bson.objectid import ObjectId
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from iepy import db
+from iepy.core import BootstrappedIEPipeline, Evidence, Fact, Knowledge
+from iepy.fact_extractor import bag_of_words, entity_order, number_of_tokens
+from iepy.feature_cache import FeatureCache
+from iepy.snapshot import SnapshotSegmentManager, connect, write_snapshot
+from .factories import EntityFactory, EntityInSegmentFactory, TextSegmentFactory
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'corpus.snapshot')
+        self.document_id = ObjectId()
+        self.s1 = self.build_segment(
+            [u'Rami', u'Eid', u'lives', u'in', u'Ñuñoa'], [u'NNP', u'NNP', u'VBZ', u'IN', u'NNP'],
+            [(u'person', u'Rami Eid', 0, 2), (u'location', u'Ñuñoa', 4, 5)])
+        self.s2 = self.build_segment(
+            [u'Ñuñoa', u'and', u'Lima'], [u'NNP', u'CC', u'NNP'],
+            [(u'location', u'Ñuñoa', 0, 1), (u'location', u'Lima', 2, 3)])
+        self.s3 = self.build_segment(
+            [u'Rami', u'Eid', u'met', u'Rami', u'Eid'], [u'NNP'] * 5,
+            [(u'person', u'Rami Eid', 0, 2), (u'person', u'Rami Eid', 3, 5)])
+        self.entities = {}
+        for s in [self.s1, self.s2, self.s3]:
+            for e in s.entities:
+                entity = EntityFactory(kind=e.kind, key=e.key, canonical_form=e.key)
+                entity.id = ObjectId()
+                self.entities.setdefault((e.kind, e.key), entity)
+        write_snapshot(self.path, [self.s1, self.s2, self.s3], self.get_entities,
+                       lambda ids: dict((i, u'doc') for i in ids))
+        self.manager = SnapshotSegmentManager(self.path)
+
+    def build_segment(self, tokens, postags, entities):
+        segment = TextSegmentFactory(
+            tokens=tokens, postags=postags, text=u' '.join(tokens), sentences=[0],
+            offset=len(getattr(self, '_built', [])) * 10,
+            entities=[EntityInSegmentFactory(kind=kind, key=key, offset=start, offset_end=end)
+                      for kind, key, start, end in entities])
+        segment.id = ObjectId()
+        segment._data['document'] = self.document_id
+        self._built = getattr(self, '_built', []) + [segment]
+        return segment
+
+    def get_entities(self, keys):
+        return dict((k, self.entities[k]) for k in keys if k in self.entities)
+
+    def assertSameSegment(self, a, b):
+        self.assertEqual(a.id, b.id)
+        for field in ['text', 'offset', 'tokens', 'postags', 'sentences']:
+            self.assertEqual(getattr(a, field), getattr(b, field))
+        self.assertEqual(
+            [(e.kind, e.key, e.offset, e.offset_end, e.alias) for e in a.entities],
+            [(e.kind, e.key, e.offset, e.offset_end, e.alias) for e in b.entities])
+
+    def test_segments_by_id(self):
+        segments = self.manager.segments_by_id([self.s2.id, ObjectId(), self.s1.id])
+        self.assertEqual(set(segments), {self.s1.id, self.s2.id})
+        self.assertSameSegment(segments[self.s1.id], self.s1)
+        self.assertSameSegment(segments[self.s2.id], self.s2)
+        self.assertEqual(segments[self.s1.id]._data['document'], self.document_id)
+
+    def test_only_some_fields(self):
+        segment = self.manager.segments_by_id([self.s1.id], fields=db.CANDIDATE_FIELDS)[self.s1.id]
+        self.assertEqual(len(segment.entities), 2)
+        self.assertEqual(segment.tokens, [])
+        self.assertIsNone(segment.text)
+
+    def test_segments_with_both_kinds(self):
+        ids = [s.id for s in self.manager.segments_with_both_kinds(u'location', u'person')]
+        self.assertEqual(ids, [self.s1.id])
+        ids = [s.id for s in self.manager.segments_with_both_kinds(u'location', u'location')]
+        self.assertEqual(ids, [self.s2.id])
+        self.assertEqual(list(self.manager.segments_with_both_kinds(u'organization', u'person')), [])
+
+    def test_segments_with_kind_pairs(self):
+        pairs = [(u'location', u'location'), (u'person', u'person')]
+        ids = self.manager.segment_ids_with_kind_pairs(pairs)
+        self.assertEqual(ids, [self.s2.id, self.s3.id])
+        segments = list(self.manager.segments_with_kind_pairs([(u'person', u'location')]))
+        self.assertEqual([s.id for s in segments], [self.s1.id])
+        self.assertEqual(self.manager.segment_ids_with_kind_pairs([(u'organization', u'person')]), [])
+
+    def test_segments_with_entity_pairs(self):
+        rami = self.entities[(u'person', u'Rami Eid')]
+        nunoa = self.entities[(u'location', u'Ñuñoa')]
+        lima = self.entities[(u'location', u'Lima')]
+        result = self.manager.segment_ids_with_entity_pairs(
+            [(nunoa, rami), (rami, lima), (rami, rami), (lima, nunoa)])
+        self.assertEqual(result, [[self.s1.id], [], [self.s3.id], [self.s2.id]])
+
+    def test_entities(self):
+        found = self.manager.entities([(u'person', u'Rami Eid'), (u'person', u'Lima')])
+        entity, = found.values()
+        self.assertEqual(entity.id, self.entities[(u'person', u'Rami Eid')].id)
+        self.assertEqual(entity.canonical_form, u'Rami Eid')
+
+    def test_get_segment(self):
+        self.assertSameSegment(self.manager.get_segment(u'doc', 10), self.s2)
+
+    def test_pickled_managers_map_the_file_again(self):
+        copy = pickle.loads(pickle.dumps(self.manager))
+        self.assertEqual(copy.path, self.path)
+        self.assertSameSegment(copy.segments_by_id([self.s3.id])[self.s3.id], self.s3)
+
+    def test_extraction_with_no_database(self):
+        connection = connect(self.path)
+        self.addCleanup(db.set_entity_source, None)
+        rami = self.entities[(u'person', u'Rami Eid')]
+        lima = self.entities[(u'location', u'Lima')]
+        pipeline = BootstrappedIEPipeline(connection, [Fact(rami, u'lives in', lima)])
+        result = pipeline.extract_facts({})
+        evidence = sorted((e.segment.id, e.o1, e.o2) for e in result)
+        self.assertEqual(evidence, [(self.s1.id, 0, 1)])
+        e, = result
+        self.assertEqual(e.fact.e2.id, self.entities[(u'location', u'Ñuñoa')].id)
+
+    def test_persistent_feature_cache_is_not_used_offline(self):
+        connection = connect(self.path)
+        self.addCleanup(db.set_entity_source, None)
+        rami = self.entities[(u'person', u'Rami Eid')]
+        nunoa = self.entities[(u'location', u'Ñuñoa')]
+        lima = self.entities[(u'location', u'Lima')]
+        pipeline = BootstrappedIEPipeline(connection, [Fact(rami, u'lives in', lima)])
+        pipeline.extractor_config['features'] = [bag_of_words, entity_order,
+                                                 number_of_tokens]
+        pipeline.extractor_config['feature_cache'] = FeatureCache()
+        segments = connection.segments.segments_by_id([self.s1.id, self.s2.id])
+        answers = Knowledge([
+            (Evidence(Fact(rami, u'lives in', nunoa), segments[self.s1.id], 0, 1), True),
+            (Evidence(Fact(rami, u'lives in', lima), segments[self.s2.id], 0, 1), False),
+        ])
+        # Any use of the persistent cache needs the database
+        with mock.patch('iepy.feature_cache.EvidenceFeatures', None):
+            extractors = pipeline.learn_fact_extractors(answers)
+            for processes in [1, 2]:
+                pipeline.extraction_processes = processes
+                result = pipeline.extract_facts(extractors)
+                self.assertEqual(len(result), 1)
+        self.assertTrue(pipeline.extractor_config['feature_cache'].persistent)
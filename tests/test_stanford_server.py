@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import pickle
+import sys
+from unittest import TestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from iepy.stanford_server import StanfordServer
+
+# A fake tagging process: tags each token with its length, answering each
+# sentence in a line per "." token
+FAKE_SERVER = """
+import sys
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+for line in iter(stdin.readline, b''):
+    tokens = line.decode('utf8').split()
+    answer = u' '.join(u'%s_%i' % (t, len(t)) for t in tokens)
+    answer = answer.replace(u'._1 ', u'._1\\n') + u'\\n'
+    stdout.write(answer.encode('utf8'))
+    stdout.flush()
+"""
+
+
+# A fake process that reads sentences and never answers
+SILENT_SERVER = """
+import sys
+for line in iter(sys.stdin.readline, ''):
+    pass
+"""
+
+
+class TestStanfordServer(TestCase):
+
+    def setUp(self):
+        self.server = StanfordServer([sys.executable, '-c', FAKE_SERVER], '_')
+        self.addCleanup(self.server.stop)
+
+    def test_server_is_started_once(self):
+        result = self.server.batch_tag([[u'Some', u'sentence', u'.'], [u'Indeed', u'!']])
+        self.assertEqual(result, [[(u'Some', u'4'), (u'sentence', u'8'), (u'.', u'1')],
+                                  [(u'Indeed', u'6'), (u'!', u'1')]])
+        process = self.server.process
+        self.server([[u'More']])
+        self.assertIs(self.server.process, process)
+
+    def test_tokens_with_separator(self):
+        result = self.server([[u'snake_case', u'ñandú']])
+        self.assertEqual(result, [[(u'snake_case', u'10'), (u'ñandú', u'5')]])
+
+    def test_tokens_with_whitespace(self):
+        result = self.server([[u'New York', u'', u'.']])
+        self.assertEqual(result, [[(u'New York', u'8'), (u'', u'1'), (u'.', u'1')]])
+
+    def test_empty_sentences_are_not_sent(self):
+        self.assertEqual(self.server([[]]), [[]])
+        self.assertIsNone(self.server.process)
+
+    def test_pickled_servers_start_their_own_process(self):
+        self.server([[u'x']])
+        copy = pickle.loads(pickle.dumps(self.server))
+        self.assertIsNone(copy.process)
+        self.assertEqual(copy.command, self.server.command)
+
+    def test_sentences_answered_in_several_lines(self):
+        result = self.server([[u'A', u'.', u'B'], [u'C']])
+        self.assertEqual(result, [[(u'A', u'1'), (u'.', u'1'), (u'B', u'1')],
+                                  [(u'C', u'1')]])
+
+    def test_big_batches_go_through_the_pipes(self):
+        sentences = [[u'token%i' % i] * 50 for i in range(2000)]
+        result = self.server(sentences)
+        self.assertEqual(len(result), 2000)
+        self.assertEqual(result[-1][0], (u'token1999', u'9'))
+
+    def test_processes_that_do_not_answer_are_stopped(self):
+        server = StanfordServer([sys.executable, '-c', SILENT_SERVER], '_', timeout=0.5)
+        self.addCleanup(server.stop)
+        with self.assertRaises(RuntimeError):
+            server([[u'Hello']])
+        self.assertIsNone(server.process)
+
+    def test_stop_is_registered_at_exit_once(self):
+        with mock.patch('atexit.register') as register:
+            self.server([[u'x']])
+            self.server.stop()
+            self.server([[u'y']])
+        self.assertEqual(register.call_count, 1)
@@ -44,6 +44,21 @@ class TestTaggerRunner(ManagerTestCase):
         postags = doc.get_preprocess_result(PreProcessSteps.tagging)
         self.assertTrue(all(x == 'B' for x in postags))
 
+    def test_tagger_runner_tags_many_documents_at_once(self):
+        docs = [SentencedIEDocFactory(text='Some sentence. And some other.'),
+                SentencedIEDocFactory(text='Indeed!')]
+        calls = []
+
+        def postagger(sents):
+            calls.append(len(sents))
+            return [[(x, 'A') for x in sent] for sent in sents]
+        tag = TaggerRunner(postagger)
+        self.assertEqual(list(tag.process_documents(docs)), docs)
+        self.assertEqual(calls, [3])
+        for doc in docs:
+            postags = doc.get_preprocess_result(PreProcessSteps.tagging)
+            self.assertEqual(postags, ['A'] * len(doc.tokens))
+
 
 class TestStanfordTaggerRunner(ManagerTestCase):
     ManagerClass = IEDocument
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from pymongo.errors import OperationFailure
+
+from iepy.models import VocabularyEntry
+from iepy.vocabulary import Vocabulary, pack_ids, unpack_ids
+
+from .manager_case import ManagerTestCase
+
+
+class TestPacking(unittest.TestCase):
+
+    def test_round_trip(self):
+        ids = [0, 7, 2 ** 32 - 1, 12]
+        self.assertEqual(len(pack_ids(ids)), 16)
+        self.assertEqual(list(unpack_ids(pack_ids(ids))), ids)
+
+    def test_empty(self):
+        self.assertEqual(len(unpack_ids(None)), 0)
+        self.assertEqual(len(unpack_ids(pack_ids([]))), 0)
+
+
+class TestVocabulary(ManagerTestCase):
+    ManagerClass = VocabularyEntry
+
+    def test_new_strings_get_consecutive_ids(self):
+        vocab = Vocabulary(u'tokens')
+        self.assertEqual(vocab.ids([u'a', u'b', u'a']), [0, 1, 0])
+        self.assertEqual(vocab.ids([u'ñandú']), [2])
+
+    def test_ids_are_shared(self):
+        ids = Vocabulary(u'tokens').ids([u'x', u'y'])
+        other = Vocabulary(u'tokens')
+        self.assertEqual(other.values(ids), [u'x', u'y'])
+        self.assertEqual(other.ids([u'y', u'x']), ids[::-1])
+        self.assertEqual(VocabularyEntry.objects.count(), 2)
+
+    def test_vocabularies_are_independent(self):
+        Vocabulary(u'tokens').ids([u'x'])
+        self.assertEqual(Vocabulary(u'postags').ids([u'NN', u'x']), [0, 1])
+
+    def test_other_write_errors_are_raised(self):
+        collection = mock.MagicMock()
+        collection.insert.side_effect = OperationFailure('failed', 121)
+        with mock.patch.object(VocabularyEntry, '_get_collection',
+                               return_value=collection):
+            with self.assertRaises(OperationFailure):
+                Vocabulary(u'tokens').ids([u'x'])